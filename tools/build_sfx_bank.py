@@ -0,0 +1,250 @@
+"""
+Merge short sound effects into one bank resource.
+
+Each effect is a separate resource today, padded out to a 512 byte sector
+and opened on its own. The bank holds them back to back, each as its
+original .wav file image (so the existing WAV parser can read it in place),
+aligned to 4 bytes, after a table of offsets, lengths and formats:
+
+    32 byte header, little-endian uint32 fields:
+        'SBNK', version, entry count, table offset, names offset,
+        data offset, reserved, reserved
+    32 byte entry per effect, little-endian uint32 fields:
+        name offset (from the names offset), offset of the .wav image from
+        the start of the bank, length of the .wav image, sample rate,
+        channels, format (1 = PCM, 0x11 = IMA ADPCM), frames, reserved
+    names: each effect's name (its path without .wav), NUL terminated
+    the .wav images
+
+A JSON manifest and, optionally, a Lua table of the same entries are
+written next to it, and the effects can be swapped for the bank in the
+metadata resource list.
+
+Example:
+    python tools/build_sfx_bank.py --projectdir "IS BUILD FILES" \\
+        sounds/grunt sounds/sword_swing_connect sounds/sword_miss \\
+        sounds/yah sounds/win_level sounds/arg_death1 \\
+        --out sounds/level_sfx.bank --lua sounds/level_sfx.lua
+"""
+import argparse
+import json
+import os
+import struct
+
+BANK_MAGIC = b"SBNK"
+BANK_VERSION = 1
+HEADER_SIZE = 32
+ENTRY_SIZE = 32
+DATA_ALIGNMENT = 4
+SECTOR_SIZE = 512
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IMA_ADPCM = 0x11
+
+
+def read_wav_info(path):
+    """(sample rate, channels, format, frames) from a PCM or IMA ADPCM .wav."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[0:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise SystemExit(f"Not a WAV file: {path}")
+
+    chunks = {}
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk_id = data[pos:pos + 4]
+        length = struct.unpack_from("<I", data, pos + 4)[0]
+        chunks.setdefault(chunk_id, data[pos + 8:pos + 8 + length])
+        pos += 8 + length + (length & 1)
+
+    if b"fmt " not in chunks or b"data" not in chunks:
+        raise SystemExit(f"WAV file without fmt/data chunks: {path}")
+
+    fmt_tag, channels, rate, _, block_align, _ = struct.unpack_from("<HHIIHH", chunks[b"fmt "])
+    if fmt_tag == WAVE_FORMAT_PCM:
+        frames = len(chunks[b"data"]) // block_align
+    elif fmt_tag == WAVE_FORMAT_IMA_ADPCM:
+        if b"fact" in chunks:
+            frames = struct.unpack_from("<I", chunks[b"fact"])[0]
+        else:
+            samples_per_block = struct.unpack_from("<H", chunks[b"fmt "], 18)[0]
+            frames = len(chunks[b"data"]) // block_align * samples_per_block
+    else:
+        raise SystemExit(f"Unsupported WAV format 0x{fmt_tag:x} (PCM or IMA ADPCM only): {path}")
+
+    return rate, channels, fmt_tag, frames
+
+
+def find_short_sounds(project_dir, sound_dir, max_seconds):
+    """Relative paths of the .wav files in sound_dir no longer than max_seconds."""
+    found = []
+    for filename in sorted(os.listdir(os.path.join(project_dir, sound_dir))):
+        if os.path.splitext(filename)[1].lower() != ".wav":
+            continue
+        rel_path = f"{sound_dir}/{filename}"
+        rate, _, _, frames = read_wav_info(os.path.join(project_dir, rel_path))
+        if frames / rate <= max_seconds:
+            found.append(rel_path)
+    return found
+
+
+def build_bank(project_dir, sound_paths):
+    """Returns (bank bytes, manifest entries)."""
+    entries = []
+    names = bytearray()
+    images = []
+    for rel_path in sound_paths:
+        abs_path = os.path.join(project_dir, rel_path)
+        rate, channels, fmt_tag, frames = read_wav_info(abs_path)
+        with open(abs_path, "rb") as f:
+            images.append(f.read())
+        name = os.path.splitext(rel_path)[0]
+        entries.append({
+            "name": name,
+            "file": rel_path,
+            "name_offset": len(names),
+            "sample_rate": rate,
+            "channels": channels,
+            "format": "ima_adpcm" if fmt_tag == WAVE_FORMAT_IMA_ADPCM else "pcm",
+            "format_tag": fmt_tag,
+            "frames": frames,
+            "seconds": round(frames / rate, 3),
+        })
+        names.extend(name.encode("utf-8") + b"\0")
+
+    table_offset = HEADER_SIZE
+    names_offset = table_offset + ENTRY_SIZE * len(entries)
+    data_offset = names_offset + len(names)
+    data_offset += -data_offset % DATA_ALIGNMENT
+
+    data = bytearray()
+    for entry, image in zip(entries, images):
+        entry["offset"] = data_offset + len(data)
+        entry["length"] = len(image)
+        data.extend(image)
+        data.extend(bytes(-len(data) % DATA_ALIGNMENT))
+
+    bank = bytearray(BANK_MAGIC)
+    bank.extend(struct.pack("<7I", BANK_VERSION, len(entries), table_offset, names_offset, data_offset, 0, 0))
+    for entry in entries:
+        bank.extend(struct.pack("<8I", entry["name_offset"], entry["offset"], entry["length"],
+                                entry["sample_rate"], entry["channels"], entry["format_tag"],
+                                entry["frames"], 0))
+    bank.extend(names)
+    bank.extend(bytes(data_offset - len(bank)))
+    bank.extend(data)
+
+    for entry in entries:
+        del entry["name_offset"]
+        del entry["format_tag"]
+
+    return bank, entries
+
+
+def write_lua_manifest(path, bank_path, entries):
+    lines = [
+        "-- Generated by tools/build_sfx_bank.py, do not edit",
+        "-- offset/length: the effect's .wav image within the bank",
+        "SFX_BANK = {",
+        f'    path = "{os.path.splitext(bank_path)[0]}",',
+        "    sounds = {",
+    ]
+    for entry in entries:
+        lines.append(
+            f'        ["{entry["name"]}"] = {{offset = {entry["offset"]}, length = {entry["length"]}, '
+            f'rate = {entry["sample_rate"]}, channels = {entry["channels"]}, '
+            f'format = "{entry["format"]}", frames = {entry["frames"]}}},'
+        )
+    lines.append("    },")
+    lines.append("}")
+    with open(path, "w", newline="\n") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def update_resources(meta_path, bank_path, entries, extra_resources):
+    """Swap the effects for the bank in the metadata resource list."""
+    with open(meta_path, "r", newline="") as f:
+        text = f.read()
+    newline = "\r\n" if "\r\n" in text else "\n"
+    meta = json.loads(text)
+
+    resources = meta.get("resources") or []
+    effects = {entry["file"] for entry in entries}
+    replaced = [r for r in resources if r in effects]
+
+    updated = [r for r in resources if r not in effects]
+    for path in [bank_path] + extra_resources:
+        if path not in updated:
+            updated.append(path)
+
+    meta["resources"] = updated
+    with open(meta_path, "w", newline="") as f:
+        f.write(json.dumps(meta, indent=2).replace("\n", newline) + newline)
+    print(f"Updated {meta_path}: {len(replaced)} sounds replaced by {bank_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge short sound effects into one bank resource")
+    parser.add_argument("sounds", nargs="*", help="Sounds to merge, relative to projectdir, with or without .wav")
+    parser.add_argument("--projectdir", default=os.getcwd(), help="Project root (metadata and resource paths are relative to it)")
+    parser.add_argument("--dir", help="Instead of listing them, merge every .wav in this folder (relative to projectdir) up to --max-seconds long")
+    parser.add_argument("--max-seconds", type=float, default=3.0, help="Longest sound --dir picks up")
+    parser.add_argument("--out", default="sounds/sfx.bank", help="Bank path, relative to projectdir")
+    parser.add_argument("--manifest", help="JSON manifest path, relative to projectdir (default: <out without extension>.json)")
+    parser.add_argument("--lua", help="Also write the manifest as a Lua table to this path, relative to projectdir")
+    parser.add_argument("--meta", help="Metadata file, relative to projectdir, whose resources should list the bank instead of the sounds")
+    parser.add_argument("--dry-run", action="store_true", help="Print what would be built without writing anything")
+    args = parser.parse_args()
+
+    project_dir = args.projectdir
+    out_path = args.out.strip("/")
+
+    if args.dir:
+        sound_dir = args.dir.strip("/")
+        if not os.path.isdir(os.path.join(project_dir, sound_dir)):
+            raise SystemExit(f"Sound folder not found: {os.path.join(project_dir, sound_dir)}")
+        sound_paths = find_short_sounds(project_dir, sound_dir, args.max_seconds)
+    else:
+        sound_paths = [s if s.lower().endswith(".wav") else s + ".wav" for s in args.sounds]
+    if not sound_paths:
+        raise SystemExit("No sounds to merge")
+
+    for rel_path in sound_paths:
+        if not os.path.isfile(os.path.join(project_dir, rel_path)):
+            raise SystemExit(f"Sound not found: {os.path.join(project_dir, rel_path)}")
+
+    bank, entries = build_bank(project_dir, sound_paths)
+    for entry in entries:
+        print(f"{entry['name']}: {entry['length']} bytes @ {entry['offset']}, {entry['format']} "
+              f"{entry['channels']}ch {entry['sample_rate']} Hz, {entry['seconds']}s")
+
+    # every resource is padded out to a whole sector in the pack
+    separate_size = sum(e["length"] + -e["length"] % SECTOR_SIZE for e in entries)
+    bank_size = len(bank) + -len(bank) % SECTOR_SIZE
+    print(f"{len(entries)} sounds -> {out_path}: {bank_size} bytes in the pack vs {separate_size} "
+          f"as separate files, 1 file open instead of {len(entries)}")
+    if args.dry_run:
+        return
+
+    os.makedirs(os.path.dirname(os.path.join(project_dir, out_path)), exist_ok=True)
+    with open(os.path.join(project_dir, out_path), "wb") as f:
+        f.write(bank)
+
+    manifest_path = args.manifest or os.path.splitext(out_path)[0] + ".json"
+    with open(os.path.join(project_dir, manifest_path), "w") as f:
+        json.dump({"bank": out_path, "sounds": entries}, f, indent=2)
+        f.write("\n")
+    print(f"Wrote {manifest_path}")
+
+    extra_resources = []
+    if args.lua:
+        write_lua_manifest(os.path.join(project_dir, args.lua), out_path, entries)
+        extra_resources.append(args.lua)
+        print(f"Wrote {args.lua}")
+
+    if args.meta:
+        update_resources(os.path.join(project_dir, args.meta), out_path, entries, extra_resources)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+Pack numbered animation frames into uniform-cell sprite sheet strips.
+
+Frames are grouped by name: warrior_walk1.png, warrior_walk2.png, ... become
+one sheet, warrior_walk1_r.png, warrior_walk2_r.png, ... another. Each frame
+keeps its bottom-center anchor (feet on a shared baseline), cells are sized
+to fit every frame of the animation, and the sheet is written as
+<name>-table-<cell width>-<cell height>.png so vmupro.sprite.newSheet can
+load it directly.
+
+A manifest of frame counts, cell sizes and anchors is written as JSON and,
+optionally, as a Lua table, and the frames can be swapped for their sheets
+in the metadata resource list.
+
+Example:
+    python tools/build_sprite_sheets.py --projectdir "IS BUILD FILES" \\
+        --sprites sprites/level1 --meta metadata_level1.json \\
+        --lua sprites/level1/sheets.lua
+"""
+import argparse
+import json
+import os
+import re
+from PIL import Image
+
+FRAME_NAME = re.compile(r"^(.*?[A-Za-z_])(\d+)(_[A-Za-z]+)?$")
+IMAGE_TYPES = (".png", ".bmp")
+
+
+def find_animations(project_dir, sprite_dir, min_frames):
+    """Group numbered frames in sprite_dir into {name: [relative paths in frame order]}."""
+    groups = {}
+    for filename in sorted(os.listdir(os.path.join(project_dir, sprite_dir))):
+        stem, ext = os.path.splitext(filename)
+        if ext.lower() not in IMAGE_TYPES:
+            continue
+        # Sheets from a previous run
+        if "-table-" in stem:
+            continue
+        match = FRAME_NAME.match(stem)
+        if not match:
+            continue
+        prefix, number, suffix = match.group(1), int(match.group(2)), match.group(3) or ""
+        name = prefix.rstrip("_") + suffix
+        groups.setdefault(name, []).append((number, f"{sprite_dir}/{filename}"))
+
+    animations = {}
+    for name, frames in sorted(groups.items()):
+        if len(frames) < min_frames:
+            continue
+        animations[name] = [path for _, path in sorted(frames)]
+    return animations
+
+
+def build_sheet(project_dir, frame_paths, trim):
+    """
+    Lay frames out left to right in equal cells, each bottom-center
+    anchored like the original file. Returns (sheet, cell_w, cell_h, anchor_x, baseline_y).
+    """
+    frames = [Image.open(os.path.join(project_dir, p)).convert("RGBA") for p in frame_paths]
+
+    cell_w = max(f.width for f in frames)
+    cell_h = max(f.height for f in frames)
+    # Where each frame's bottom-center lands in the cell
+    anchor_x = cell_w // 2
+    baseline_y = cell_h
+    placements = [(anchor_x - f.width // 2, baseline_y - f.height) for f in frames]
+
+    left, top, right, bottom = 0, 0, cell_w, cell_h
+    if trim:
+        # Crop the cell to the union of every frame's visible pixels,
+        # the frames don't move relative to each other
+        boxes = []
+        for frame, (x, y) in zip(frames, placements):
+            box = frame.getchannel("A").getbbox()
+            if box:
+                boxes.append((box[0] + x, box[1] + y, box[2] + x, box[3] + y))
+        if boxes:
+            left = min(b[0] for b in boxes)
+            top = min(b[1] for b in boxes)
+            right = max(b[2] for b in boxes)
+            bottom = max(b[3] for b in boxes)
+
+    cell_w, cell_h = right - left, bottom - top
+    sheet = Image.new("RGBA", (cell_w * len(frames), cell_h), (0, 0, 0, 0))
+    for i, (frame, (x, y)) in enumerate(zip(frames, placements)):
+        cell = Image.new("RGBA", (cell_w, cell_h), (0, 0, 0, 0))
+        cell.paste(frame, (x - left, y - top))
+        sheet.paste(cell, (i * cell_w, 0))
+
+    return sheet, cell_w, cell_h, anchor_x - left, baseline_y - top
+
+
+def write_lua_manifest(path, sheets):
+    lines = [
+        "-- Generated by tools/build_sprite_sheets.py, do not edit",
+        "-- path: for vmupro.sprite.newSheet, anchorX/baselineY: the frames'",
+        "-- original bottom-center within each cell",
+        "SPRITE_SHEETS = {",
+    ]
+    for sheet in sheets:
+        lines.append(
+            f'    ["{sheet["name"]}"] = {{path = "{sheet["path"]}", frameWidth = {sheet["frame_width"]}, '
+            f'frameHeight = {sheet["frame_height"]}, frameCount = {sheet["frame_count"]}, '
+            f'anchorX = {sheet["anchor_x"]}, baselineY = {sheet["baseline_y"]}}},'
+        )
+    lines.append("}")
+    with open(path, "w", newline="\n") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def update_resources(meta_path, sheets, extra_resources):
+    """Swap each sheet's frames for the sheet in the metadata resource list."""
+    with open(meta_path, "r", newline="") as f:
+        text = f.read()
+    newline = "\r\n" if "\r\n" in text else "\n"
+    meta = json.loads(text)
+
+    resources = meta.get("resources") or []
+    replaced = set()
+    for sheet in sheets:
+        listed = [p for p in sheet["frames"] if p in resources]
+        if not listed:
+            print(f"  {sheet['name']}: frames not listed individually in {meta_path}, adding the sheet only")
+        replaced.update(listed)
+
+    updated = [r for r in resources if r not in replaced]
+    for path in [s["file"] for s in sheets] + extra_resources:
+        if path not in updated:
+            updated.append(path)
+
+    meta["resources"] = updated
+    with open(meta_path, "w", newline="") as f:
+        f.write(json.dumps(meta, indent=2).replace("\n", newline) + newline)
+    print(f"Updated {meta_path}: {len(replaced)} frames replaced by {len(sheets)} sheets")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack numbered animation frames into sprite sheet strips")
+    parser.add_argument("--projectdir", default=os.getcwd(), help="Project root (metadata and resource paths are relative to it)")
+    parser.add_argument("--sprites", required=True, help="Folder with the frames, relative to projectdir, e.g. sprites/level1")
+    parser.add_argument("--out", help="Folder for the sheets, relative to projectdir (default: the sprites folder)")
+    parser.add_argument("--min-frames", type=int, default=2, help="Only build sheets for animations with at least this many frames")
+    parser.add_argument("--only", nargs="*", help="Only build these animations (names as printed, e.g. warrior_walk_r)")
+    parser.add_argument("--no-trim", action="store_true", help="Keep cells the size of the largest frame instead of cropping empty margins")
+    parser.add_argument("--manifest", help="JSON manifest path, relative to projectdir (default: <out>/sheets.json)")
+    parser.add_argument("--lua", help="Also write the manifest as a Lua table to this path, relative to projectdir")
+    parser.add_argument("--meta", help="Metadata file, relative to projectdir, whose resources should list the sheets instead of the frames")
+    parser.add_argument("--dry-run", action="store_true", help="Print what would be built without writing anything")
+    args = parser.parse_args()
+
+    project_dir = args.projectdir
+    sprite_dir = args.sprites.strip("/")
+    out_dir = (args.out or sprite_dir).strip("/")
+
+    if not os.path.isdir(os.path.join(project_dir, sprite_dir)):
+        raise SystemExit(f"Sprite folder not found: {os.path.join(project_dir, sprite_dir)}")
+
+    animations = find_animations(project_dir, sprite_dir, args.min_frames)
+    if args.only:
+        animations = {k: v for k, v in animations.items() if k in args.only}
+    if not animations:
+        raise SystemExit("No numbered animations found")
+
+    if not args.dry_run:
+        os.makedirs(os.path.join(project_dir, out_dir), exist_ok=True)
+
+    sheets = []
+    for name, frame_paths in animations.items():
+        sheet, cell_w, cell_h, anchor_x, baseline_y = build_sheet(project_dir, frame_paths, not args.no_trim)
+        sheet_path = f"{out_dir}/{name}-table-{cell_w}-{cell_h}"
+        print(f"{name}: {len(frame_paths)} frames -> {sheet_path}.png ({sheet.width}x{sheet.height})")
+        if not args.dry_run:
+            # Remove sheets from an earlier run with a different cell size
+            for old in os.listdir(os.path.join(project_dir, out_dir)):
+                if old.startswith(f"{name}-table-") and old != f"{name}-table-{cell_w}-{cell_h}.png":
+                    os.remove(os.path.join(project_dir, out_dir, old))
+            sheet.save(os.path.join(project_dir, sheet_path + ".png"), optimize=True)
+        sheets.append({
+            "name": name,
+            "path": sheet_path,
+            "file": sheet_path + ".png",
+            "frame_width": cell_w,
+            "frame_height": cell_h,
+            "frame_count": len(frame_paths),
+            "anchor_x": anchor_x,
+            "baseline_y": baseline_y,
+            "frames": frame_paths,
+        })
+
+    total_frames = sum(s["frame_count"] for s in sheets)
+    print(f"{total_frames} frame files -> {len(sheets)} sheets")
+    if args.dry_run:
+        return
+
+    manifest_path = args.manifest or f"{out_dir}/sheets.json"
+    with open(os.path.join(project_dir, manifest_path), "w") as f:
+        json.dump({"sheets": sheets}, f, indent=2)
+        f.write("\n")
+    print(f"Wrote {manifest_path}")
+
+    extra_resources = []
+    if args.lua:
+        write_lua_manifest(os.path.join(project_dir, args.lua), sheets)
+        extra_resources.append(args.lua)
+        print(f"Wrote {args.lua}")
+
+    if args.meta:
+        update_resources(os.path.join(project_dir, args.meta), sheets, extra_resources)
+
+
+if __name__ == "__main__":
+    main()
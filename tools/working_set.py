@@ -0,0 +1,331 @@
+"""
+Estimate the decoded RAM each level of the game needs.
+
+File size isn't what runs out on the device, decoded assets are: every
+sprite, sheet and wall texture is held as RGB565 (width x height x 2 bytes)
+and every sample as 16 bit PCM (frames x channels x 2 bytes), whatever its
+size in the pack.
+
+A manifest describes what the game's loaders load (loadMenuSprites,
+loadLevelSprites, loadWallTextures, loadLevelAudio, ...) as named groups,
+which groups are resident in each state (the title screen, each level),
+and the order the loads and frees happen in when moving between states:
+
+    {
+        "budget_kb": 1024,
+        "asset_budget_kb": 256,
+        "groups": {
+            "level_sprites": {"loader": "loadLevelSprites", "assets": ["{base}warrior_front", ...]},
+            ...
+        },
+        "states": {
+            "level1": {"base": "sprites/level1/", "groups": ["level_sprites", ...]},
+            ...
+        },
+        "transitions": [
+            {"from": "title", "to": "level1",
+             "steps": ["free title_music", "free menu_sprites", "load level_sprites", ...]}
+        ]
+    }
+
+Asset paths are relative to the project, with or without their extension
+(as the game passes them to vmupro.sprite.new), "{base}" is replaced by
+the state's "base", and a folder stands for every image and sound in it.
+After a transition's steps, any group of the new state that isn't loaded
+yet is loaded, then any group the new state doesn't have is freed; a
+transition without steps is the worst case, everything loaded first.
+
+Without a manifest, each --meta file is a state that holds all of its
+resources, with a worst case transition from each one to the next.
+
+For every state and transition the peak is checked against the budget,
+assets over the per-asset budget are flagged, and downscale targets
+(image sizes, sample rates) that would bring it back under are suggested.
+
+Example:
+    python tools/working_set.py --projectdir "IS BUILD FILES" \\
+        --manifest working_set.json --json working_set_report.json
+    python tools/working_set.py --projectdir "IS BUILD FILES" \\
+        --meta metadata_level1.json metadata_level2.json --budget-kb 768
+"""
+import argparse
+import json
+import math
+import os
+from PIL import Image
+
+from build_sfx_bank import read_wav_info
+
+IMAGE_TYPES = (".png", ".bmp")
+SOUND_TYPES = (".wav",)
+BYTES_PER_PIXEL = 2
+BYTES_PER_SAMPLE = 2
+DEFAULT_BUDGET_KB = 1024
+
+# Tracks at least this long can be streamed instead (see the packer's --stream-music)
+STREAM_MIN_SECONDS = 4
+# Images aren't suggested below this fraction of their size, sounds below this fraction of their rate
+MIN_SCALE = 0.5
+
+
+def resolve_asset(project_dir, path):
+    """Relative paths of the files an asset path stands for."""
+    abs_path = os.path.join(project_dir, path)
+    if os.path.isdir(abs_path):
+        found = []
+        for root, dirs, files in os.walk(abs_path):
+            dirs.sort()
+            for filename in sorted(files):
+                if os.path.splitext(filename)[1].lower() in IMAGE_TYPES + SOUND_TYPES:
+                    rel_path = os.path.relpath(os.path.join(root, filename), project_dir)
+                    found.append(rel_path.replace("\\", "/"))
+        return found
+    if os.path.isfile(abs_path):
+        return [path]
+    for ext in IMAGE_TYPES + SOUND_TYPES:
+        if os.path.isfile(abs_path + ext):
+            return [path + ext]
+    raise SystemExit(f"Asset not found: {abs_path}")
+
+
+def decoded_size(project_dir, rel_path, cache):
+    """Decoded bytes of one asset, with what they were worked out from."""
+    if rel_path in cache:
+        return cache[rel_path]
+
+    abs_path = os.path.join(project_dir, rel_path)
+    ext = os.path.splitext(rel_path)[1].lower()
+    if ext in IMAGE_TYPES:
+        with Image.open(abs_path) as image:
+            width, height = image.size
+        info = {"path": rel_path, "kind": "image", "width": width, "height": height,
+                "bytes": width * height * BYTES_PER_PIXEL}
+    elif ext in SOUND_TYPES:
+        rate, channels, _, frames = read_wav_info(abs_path)
+        info = {"path": rel_path, "kind": "sound", "sample_rate": rate, "channels": channels,
+                "seconds": round(frames / rate, 2), "bytes": frames * channels * BYTES_PER_SAMPLE}
+    else:
+        # scripts and data are loaded as they are
+        info = {"path": rel_path, "kind": "file", "bytes": os.path.getsize(abs_path)}
+
+    cache[rel_path] = info
+    return info
+
+
+def load_manifest(path):
+    with open(path) as f:
+        manifest = json.load(f)
+
+    groups = manifest.get("groups") or {}
+    states = manifest.get("states") or {}
+    if not states:
+        raise SystemExit(f"{path}: no states")
+    for name, state in states.items():
+        for group in state.get("groups", []):
+            if group not in groups:
+                raise SystemExit(f"{path}: state {name} has unknown group {group}")
+    for transition in manifest.get("transitions", []):
+        for key in ("from", "to"):
+            if transition.get(key) not in states:
+                raise SystemExit(f"{path}: transition {key} unknown state {transition.get(key)}")
+        for step in transition.get("steps", []):
+            action, _, group = step.partition(" ")
+            if action not in ("load", "free") or group not in groups:
+                raise SystemExit(f"{path}: bad transition step '{step}' (expected 'load <group>' or 'free <group>')")
+    return manifest
+
+
+def manifest_from_metadata(project_dir, meta_paths):
+    """One state per metadata file holding all of its resources, worst case transitions between them."""
+    manifest = {"groups": {}, "states": {}, "transitions": []}
+    for meta_path in meta_paths:
+        with open(os.path.join(project_dir, meta_path)) as f:
+            resources = json.load(f).get("resources") or []
+        name = os.path.splitext(os.path.basename(meta_path))[0]
+        assets = []
+        for resource in resources:
+            assets.extend(p for p in resolve_asset(project_dir, resource)
+                          if os.path.splitext(p)[1].lower() in IMAGE_TYPES + SOUND_TYPES)
+        manifest["groups"][name] = {"loader": meta_path, "assets": assets}
+        manifest["states"][name] = {"groups": [name]}
+    names = list(manifest["states"])
+    for from_name, to_name in zip(names, names[1:]):
+        manifest["transitions"].append({"from": from_name, "to": to_name})
+    return manifest
+
+
+def resolve_group(project_dir, manifest, group, state, cache):
+    """(group, decoded assets) of a group as loaded in a state."""
+    base = manifest["states"][state].get("base", "")
+    assets = []
+    for path in manifest["groups"][group].get("assets", []):
+        for rel_path in resolve_asset(project_dir, path.replace("{base}", base)):
+            assets.append(decoded_size(project_dir, rel_path, cache))
+    return group, assets
+
+
+def group_bytes(loaded):
+    return sum(asset["bytes"] for asset in loaded[1])
+
+
+def assets_key(loaded):
+    return loaded[0], tuple(asset["path"] for asset in loaded[1])
+
+
+def simulate_transition(project_dir, manifest, transition, cache):
+    """Resident bytes after every step of a transition, and the peak."""
+    from_state = transition["from"]
+    to_state = transition["to"]
+    resident = [resolve_group(project_dir, manifest, g, from_state, cache)
+                for g in manifest["states"][from_state]["groups"]]
+    timeline = [("start", sum(group_bytes(r) for r in resident))]
+
+    wanted = [resolve_group(project_dir, manifest, g, to_state, cache)
+              for g in manifest["states"][to_state]["groups"]]
+
+    def apply(step):
+        action, _, group = step.partition(" ")
+        if action == "load":
+            resident.append(resolve_group(project_dir, manifest, group, to_state, cache))
+        else:
+            for i, loaded in enumerate(resident):
+                if loaded[0] == group:
+                    del resident[i]
+                    break
+        timeline.append((step, sum(group_bytes(r) for r in resident)))
+
+    for step in transition.get("steps", []):
+        apply(step)
+    # then whatever the new state still needs, then free what it doesn't
+    for loaded in wanted:
+        if assets_key(loaded) not in [assets_key(r) for r in resident]:
+            apply(f"load {loaded[0]}")
+    wanted_keys = [assets_key(w) for w in wanted]
+    for loaded in list(resident):
+        if assets_key(loaded) not in wanted_keys:
+            apply(f"free {loaded[0]}")
+
+    peak_step, peak = max(timeline, key=lambda t: t[1])
+    return {"from": from_state, "to": to_state, "peak": peak, "peak_after": peak_step,
+            "timeline": [{"step": step, "bytes": used} for step, used in timeline]}
+
+
+def fit_asset(asset, target_bytes):
+    """Suggested smaller version of one asset, at most target_bytes decoded (never below MIN_SCALE)."""
+    if asset["kind"] == "image":
+        scale = max(MIN_SCALE, math.sqrt(max(target_bytes, 0) / asset["bytes"]))
+        width = max(1, int(asset["width"] * scale))
+        height = max(1, int(asset["height"] * scale))
+        new_bytes = width * height * BYTES_PER_PIXEL
+        how = f"downscale {asset['width']}x{asset['height']} to {width}x{height}"
+    elif asset["kind"] == "sound":
+        scale = max(MIN_SCALE, max(target_bytes, 0) / asset["bytes"])
+        rate = int(asset["sample_rate"] * scale)
+        new_bytes = int(asset["bytes"] * rate / asset["sample_rate"])
+        how = f"resample {asset['sample_rate']} Hz to {rate} Hz"
+        if asset["seconds"] >= STREAM_MIN_SECONDS:
+            how += " or stream it"
+    else:
+        return None
+    return {"path": asset["path"], "how": how, "bytes": asset["bytes"], "new_bytes": new_bytes,
+            "saved": asset["bytes"] - new_bytes}
+
+
+def downscale_targets(assets, over):
+    """Shrink the biggest assets first until over bytes are saved."""
+    suggestions = []
+    seen = set()
+    for asset in sorted(assets, key=lambda a: -a["bytes"]):
+        if over <= 0:
+            break
+        if asset["path"] in seen:
+            continue
+        seen.add(asset["path"])
+        suggestion = fit_asset(asset, asset["bytes"] - over)
+        if suggestion is None or suggestion["saved"] <= 0:
+            continue
+        suggestions.append(suggestion)
+        over -= suggestion["saved"]
+    return suggestions, over
+
+
+def kb(num_bytes):
+    return f"{num_bytes / 1024:,.1f} KB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate the decoded RAM each state of the game needs")
+    parser.add_argument("--projectdir", default=os.getcwd(), help="Project root (asset paths are relative to it)")
+    parser.add_argument("--manifest", help="Manifest of loader groups, states and transitions, relative to projectdir")
+    parser.add_argument("--meta", nargs="+", help="Without a manifest: metadata files, relative to projectdir, one state each")
+    parser.add_argument("--budget-kb", type=float, help=f"RAM available for assets (default: the manifest's, or {DEFAULT_BUDGET_KB})")
+    parser.add_argument("--asset-budget-kb", type=float, help="Flag any single asset bigger than this (default: the manifest's, or none)")
+    parser.add_argument("--json", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    project_dir = args.projectdir
+    if args.manifest:
+        manifest = load_manifest(os.path.join(project_dir, args.manifest))
+    elif args.meta:
+        manifest = manifest_from_metadata(project_dir, args.meta)
+    else:
+        raise SystemExit("Give a --manifest or --meta files")
+
+    budget = int((args.budget_kb or manifest.get("budget_kb") or DEFAULT_BUDGET_KB) * 1024)
+    asset_budget_kb = args.asset_budget_kb or manifest.get("asset_budget_kb")
+    asset_budget = int(asset_budget_kb * 1024) if asset_budget_kb else None
+
+    cache = {}
+    report = {"budget": budget, "asset_budget": asset_budget, "states": {}, "transitions": [],
+              "over_budget_assets": []}
+
+    print(f"Budget {kb(budget)}" + (f", {kb(asset_budget)} per asset" if asset_budget else ""))
+    for name, state in manifest["states"].items():
+        groups = [resolve_group(project_dir, manifest, g, name, cache) for g in state.get("groups", [])]
+        total = sum(group_bytes(g) for g in groups)
+        over = total - budget
+        print(f"\n{name}: {kb(total)}" + (f"  OVER BUDGET by {kb(over)}" if over > 0 else ""))
+        for group, assets in groups:
+            loader = manifest["groups"][group].get("loader", "")
+            images = sum(a["bytes"] for a in assets if a["kind"] == "image")
+            sounds = sum(a["bytes"] for a in assets if a["kind"] == "sound")
+            print(f"  {group:<20} {loader:<24} {len(assets):>4} assets {kb(group_bytes((group, assets))):>12}"
+                  f"  (images {kb(images)}, sounds {kb(sounds)})")
+
+        state_report = {"bytes": total, "groups": {g: group_bytes((g, a)) for g, a in groups}}
+        if over > 0:
+            suggestions, left = downscale_targets([a for _, assets in groups for a in assets], over)
+            state_report["suggestions"] = suggestions
+            for s in suggestions:
+                print(f"    {s['path']}: {s['how']}, saves {kb(s['saved'])}")
+            if left > 0:
+                print(f"    still {kb(left)} over, even with every asset at its smallest suggested size")
+        report["states"][name] = state_report
+
+    if manifest.get("transitions"):
+        print("\nTransitions:")
+    for transition in manifest.get("transitions", []):
+        result = simulate_transition(project_dir, manifest, transition, cache)
+        over = result["peak"] - budget
+        print(f"  {result['from']} -> {result['to']}: peak {kb(result['peak'])} after {result['peak_after']}"
+              + (f"  OVER BUDGET by {kb(over)}" if over > 0 else ""))
+        report["transitions"].append(result)
+
+    if asset_budget:
+        flagged = sorted((a for a in cache.values() if a["bytes"] > asset_budget), key=lambda a: -a["bytes"])
+        print(f"\nAssets over {kb(asset_budget)}: {len(flagged)}")
+        for asset in flagged:
+            suggestion = fit_asset(asset, asset_budget)
+            report["over_budget_assets"].append({"asset": asset, "suggestion": suggestion})
+            print(f"  {asset['path']}: {kb(asset['bytes'])}" + (f", {suggestion['how']}" if suggestion else ""))
+
+    if args.json:
+        report["assets"] = sorted(cache.values(), key=lambda a: a["path"])
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"\nWrote {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# 8BM Copyright/License notice
+# Optional resource alignment policy for the LUA packer
+#
+# By default every resource starts on a 512 byte SD sector boundary,
+# which wastes most of a sector on each small file. Enabled with
+# --tight-packing, or by adding an "alignment" policy to the "build"
+# section of metadata.json:
+#
+#   "build": {
+#       "alignment": {
+#           "small_threshold": 4096,
+#           "small_alignment": 4,
+#           "types": { ".wav": 512 },
+#           "files": { "data/levels.lua": 512 }
+#       }
+#   }
+#
+# Files smaller than small_threshold bytes are packed tightly, aligned to
+# small_alignment, sharing sectors with their neighbours. Everything else
+# starts on a sector boundary as before. "types" and "files" set the
+# alignment for file extensions / individual resource paths regardless
+# of size. A tightly packed file is still moved to the next sector if it
+# would otherwise span more sectors than its size needs, so reading it
+# never costs an extra sector.
+
+import os
+from typing import Any, Dict, Optional
+
+
+SECTOR_SIZE = 512
+
+DEFAULT_POLICY = {
+    "small_threshold": 4096,
+    "small_alignment": 4,
+    "types": {},
+    "files": {},
+}
+
+
+class AlignmentPolicyError(Exception):
+    pass
+
+
+def IsValidAlignment(val):
+    # type: (Any) -> bool
+    """
+    Powers of two up to a sector, so any aligned
+    offset is also aligned within its sector
+    """
+    return isinstance(val, int) and 1 <= val <= SECTOR_SIZE and (val & (val - 1)) == 0
+
+
+def LoadAlignmentPolicy(inPolicy):
+    # type: (Optional[Dict[str, Any]]) -> Dict[str, Any]
+    """
+    Merge an "alignment" block from metadata.json over the defaults
+    and sanity check it. None gives the default policy.
+    """
+
+    policy = dict(DEFAULT_POLICY)
+    policy["types"] = {}
+    policy["files"] = {}
+
+    if inPolicy is None:
+        return policy
+
+    if not isinstance(inPolicy, dict):
+        raise AlignmentPolicyError("Expected 'alignment' to be an object")
+
+    for key, val in inPolicy.items():
+        if key not in policy:
+            raise AlignmentPolicyError("Unknown alignment option '{}'".format(key))
+        policy[key] = val
+
+    if not isinstance(policy["small_threshold"], int) or policy["small_threshold"] < 0:
+        raise AlignmentPolicyError("Expected alignment 'small_threshold' to be 0 or more")
+
+    if not IsValidAlignment(policy["small_alignment"]):
+        raise AlignmentPolicyError("Expected alignment 'small_alignment' to be a power of 2 up to {}".format(SECTOR_SIZE))
+
+    for key in ("types", "files"):
+        if not isinstance(policy[key], dict):
+            raise AlignmentPolicyError("Expected alignment '{}' to be an object".format(key))
+        for name, val in policy[key].items():
+            if not IsValidAlignment(val):
+                raise AlignmentPolicyError("Expected the alignment for '{}' to be a power of 2 up to {}".format(
+                    name, SECTOR_SIZE))
+
+    policy["types"] = {ext.lower(): val for ext, val in policy["types"].items()}
+
+    return policy
+
+
+def GetResourceAlignment(policy, relativePath, size):
+    # type: (Optional[Dict[str, Any]], str, int) -> int
+
+    if policy is None:
+        return SECTOR_SIZE
+
+    alignment = policy["files"].get(relativePath)
+    if alignment is None:
+        alignment = policy["types"].get(os.path.splitext(relativePath)[1].lower())
+    if alignment is None:
+        alignment = policy["small_alignment"] if size < policy["small_threshold"] else SECTOR_SIZE
+
+    return alignment
+
+
+def GetAlignedOffset(offset, size, alignment):
+    # type: (int, int, int) -> int
+    """
+    Where a resource of this size and alignment should start, given the
+    blob currently ends at offset
+    """
+
+    start = (offset + alignment - 1) // alignment * alignment
+    if alignment >= SECTOR_SIZE or size == 0:
+        return start
+
+    # don't let a small file straddle more sectors than it has to
+    minSectors = (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+    spanned = (start + size - 1) // SECTOR_SIZE - start // SECTOR_SIZE + 1
+    if spanned > minSectors:
+        start = (offset + SECTOR_SIZE - 1) // SECTOR_SIZE * SECTOR_SIZE
+
+    return start
@@ -0,0 +1,452 @@
+# 8BM Copyright/License notice
+# Optional build-time WAV resampling and IMA ADPCM encoding for the LUA packer
+#
+# Enabled with --adpcm, or by adding an "audio" policy to the "build"
+# section of metadata.json:
+#
+#   "build": {
+#       "audio": {
+#           "codec": "adpcm",
+#           "rate": 22050,
+#           "block_size": 1024,
+#           "files": {
+#               "sounds/Intro_45sec.wav": { "rate": 11025 },
+#               "sounds/win_level.wav": { "codec": "keep" }
+#           }
+#       }
+#   }
+#
+# Every 8 or 16 bit PCM .wav resource, mono or stereo, is resampled down
+# to "rate" if it's above it (never up, the device resamples everything
+# to its mix rate on playback anyway) and stored as:
+#   "adpcm": 4 bit IMA ADPCM (WAVE_FORMAT_IMA_ADPCM, as written by most
+#            audio tools) in block_size byte blocks, about 1/4 of 16 bit PCM
+#   "pcm":   16 bit PCM, only resampled
+#   "keep":  left as it is
+# "files" overrides "codec" and/or "rate" for individual resource paths.
+# WAVs in any other format (e.g. already ADPCM) are left as they are.
+#
+# Converted sounds are still ordinary .wav files that vmupro.sound.sample.new
+# loads as before, and keep their resource path.
+#
+# Converted entries in resource_index get the fields:
+#   "audio_codec": "ima_adpcm" or "pcm", "sample_rate"
+
+import math
+import os
+import struct
+import sys
+import wave
+from array import array
+from fractions import Fraction
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+AUDIO_VERSION = 1
+
+WAVE_FORMAT_IMA_ADPCM = 0x11
+
+AUDIO_CODECS = ("adpcm", "pcm", "keep")
+
+DEFAULT_POLICY = {
+    "codec": "adpcm",
+    "rate": 22050,
+    "block_size": 1024,
+    "files": {},
+}
+
+# Resampling filter half width, in zero crossings of the sinc
+RESAMPLE_ZERO_CROSSINGS = 8
+
+IMA_STEP_TABLE = [
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+    253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+    1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+    3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442,
+    11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794,
+    32767,
+]
+
+IMA_INDEX_TABLE = [-1, -1, -1, -1, 2, 4, 6, 8]
+
+
+class AudioPolicyError(Exception):
+    pass
+
+
+def LoadAudioPolicy(inPolicy):
+    # type: (Optional[Dict[str, Any]]) -> Dict[str, Any]
+    """
+    Merge an "audio" block from metadata.json over the defaults
+    and sanity check it. None gives the default policy.
+    """
+
+    policy = dict(DEFAULT_POLICY)
+    policy["files"] = {}
+
+    if inPolicy is None:
+        return policy
+
+    if not isinstance(inPolicy, dict):
+        raise AudioPolicyError("Expected 'audio' to be an object")
+
+    for key, val in inPolicy.items():
+        if key not in policy:
+            raise AudioPolicyError("Unknown audio option '{}'".format(key))
+        policy[key] = val
+
+    CheckAudioSettings(policy, "audio")
+
+    blockSize = policy["block_size"]
+    # room for the stereo block headers, and whole 4 byte chunks per channel
+    if not isinstance(blockSize, int) or blockSize < 64 or blockSize > 0x8000 or blockSize % 8 != 0:
+        raise AudioPolicyError("Expected audio 'block_size' to be a multiple of 8 between 64 and 32768")
+
+    if not isinstance(policy["files"], dict):
+        raise AudioPolicyError("Expected audio 'files' to be an object")
+
+    for name, override in policy["files"].items():
+        if not isinstance(override, dict):
+            raise AudioPolicyError("Expected the audio settings for '{}' to be an object".format(name))
+        for key in override:
+            if key not in ("codec", "rate"):
+                raise AudioPolicyError("Unknown audio option '{}' for '{}'".format(key, name))
+        CheckAudioSettings(override, "audio settings for '{}'".format(name))
+
+    return policy
+
+
+def CheckAudioSettings(settings, label):
+    # type: (Dict[str, Any], str) -> None
+
+    if "codec" in settings and settings["codec"] not in AUDIO_CODECS:
+        raise AudioPolicyError("Expected 'codec' in the {} to be one of: {}".format(label, ", ".join(AUDIO_CODECS)))
+
+    if "rate" in settings:
+        rate = settings["rate"]
+        if not isinstance(rate, int) or rate < 4000 or rate > 192000:
+            raise AudioPolicyError("Expected 'rate' in the {} to be between 4000 and 192000".format(label))
+
+
+def GetAudioStage(policy, relativePath):
+    # type: (Dict[str, Any], str) -> Optional[Tuple[str, Callable[[str, str], Optional[Dict[str, Any]]]]]
+    """
+    Packer transform stage (key, function) for this resource,
+    or None if it isn't a WAV or the policy keeps it as it is
+    """
+
+    if os.path.splitext(relativePath)[1].lower() != ".wav":
+        return None
+
+    override = policy["files"].get(relativePath, {})
+    codec = override.get("codec", policy["codec"])
+    rate = override.get("rate", policy["rate"])
+    blockSize = policy["block_size"]
+
+    if codec == "keep":
+        return None
+
+    # everything that changes the output goes in the key
+    key = "{}v{}r{}".format(codec, AUDIO_VERSION, rate)
+    if codec == "adpcm":
+        key += "b{}".format(blockSize)
+
+    def AudioStage(absSrcPath, absDstPath):
+        # type: (str, str) -> Optional[Dict[str, Any]]
+        return ConvertWav(absSrcPath, absDstPath, codec, rate, blockSize)
+
+    return (key, AudioStage)
+
+
+def ReadPcmWav(absSrcPath):
+    # type: (str) -> Optional[Tuple[List[array], int]]
+    """
+    ([samples per channel as signed 16 bit], rate) for an 8 or 16 bit
+    PCM mono/stereo WAV, or None if it's anything else
+    """
+
+    try:
+        with wave.open(str(absSrcPath), "rb") as w:
+            numChannels = w.getnchannels()
+            sampleWidth = w.getsampwidth()
+            rate = w.getframerate()
+            frames = w.readframes(w.getnframes())
+    except (wave.Error, EOFError):
+        # compressed, float, extensible...
+        return None
+
+    if numChannels not in (1, 2) or sampleWidth not in (1, 2):
+        return None
+
+    if sampleWidth == 1:
+        interleaved = array("h", ((b - 128) << 8 for b in frames))
+    else:
+        interleaved = array("h")
+        interleaved.frombytes(frames[:len(frames) & ~1])
+        if sys.byteorder != "little":
+            interleaved.byteswap()
+
+    channels = [interleaved[c::numChannels] for c in range(numChannels)]
+    return channels, rate
+
+
+def MakeResampleKernels(srcRate, dstRate):
+    # type: (int, int) -> Tuple[int, int, int, List[List[float]]]
+    """
+    Windowed sinc low pass, one kernel per output phase:
+    (L, M, half width, kernels) for a dstRate / srcRate of L / M
+    """
+
+    ratio = Fraction(dstRate, srcRate)
+    upFactor, downFactor = ratio.numerator, ratio.denominator
+
+    # cut off just under the new Nyquist frequency
+    cutoff = min(1.0, dstRate / srcRate) * 0.95
+    halfWidth = int(math.ceil(RESAMPLE_ZERO_CROSSINGS / cutoff))
+
+    kernels = []
+    for phase in range(upFactor):
+        frac = phase / upFactor
+        kernel = []
+        for k in range(-halfWidth + 1, halfWidth + 1):
+            x = k - frac
+            if x == 0:
+                val = cutoff
+            else:
+                val = math.sin(math.pi * cutoff * x) / (math.pi * x)
+            # Hann window
+            val *= 0.5 + 0.5 * math.cos(math.pi * x / halfWidth) if abs(x) < halfWidth else 0.0
+            kernel.append(val)
+        total = sum(kernel)
+        kernels.append([v / total for v in kernel])
+
+    return upFactor, downFactor, halfWidth, kernels
+
+
+def Resample(samples, srcRate, dstRate):
+    # type: (array, int, int) -> array
+    """
+    Band-limited resampling of one channel of 16 bit samples
+    """
+
+    upFactor, downFactor, halfWidth, kernels = MakeResampleKernels(srcRate, dstRate)
+
+    padded = [0] * halfWidth + list(samples) + [0] * halfWidth
+    numOut = (len(samples) * upFactor + downFactor - 1) // downFactor
+
+    out = array("h", bytes(2 * numOut))
+    for i in range(numOut):
+        base, phase = divmod(i * downFactor, upFactor)
+        # taps base - halfWidth + 1 .. base + halfWidth, shifted by the padding
+        window = padded[base + 1:base + 2 * halfWidth + 1]
+        val = int(round(sum(map(float.__mul__, kernels[phase], window))))
+        out[i] = max(-32768, min(32767, val))
+
+    return out
+
+
+def EncodeImaChannel(samples, start, count, state):
+    # type: (array, int, int, List[int]) -> Tuple[List[int], int]
+    """
+    IMA ADPCM nibbles for samples[start:start + count], starting from and
+    updating state [predicted, step index]. Returns (nibbles, squared error).
+    """
+
+    predicted, index = state
+    nibbles = []
+    errorSum = 0
+
+    for n in range(start, start + count):
+        sample = samples[n]
+        step = IMA_STEP_TABLE[index]
+        diff = sample - predicted
+        nibble = 0
+        if diff < 0:
+            nibble = 8
+            diff = -diff
+
+        # same sum the decoder will make, so the prediction tracks it exactly
+        delta = step >> 3
+        if diff >= step:
+            nibble |= 4
+            diff -= step
+            delta += step
+        step >>= 1
+        if diff >= step:
+            nibble |= 2
+            diff -= step
+            delta += step
+        step >>= 1
+        if diff >= step:
+            nibble |= 1
+            delta += step
+
+        predicted = predicted - delta if nibble & 8 else predicted + delta
+        predicted = max(-32768, min(32767, predicted))
+
+        index = max(0, min(88, index + IMA_INDEX_TABLE[nibble & 7]))
+
+        nibbles.append(nibble)
+        errorSum += (sample - predicted) ** 2
+
+    state[0] = predicted
+    state[1] = index
+    return nibbles, errorSum
+
+
+def EncodeImaAdpcm(channels, blockSize):
+    # type: (List[array], int) -> Tuple[bytearray, int, int, float]
+    """
+    Microsoft IMA ADPCM data in blockSize byte blocks:
+    (data, samples per block, number of sample frames, SNR in dB)
+    """
+
+    numChannels = len(channels)
+    numFrames = len(channels[0])
+    # each block: a 4 byte header per channel holding the first sample,
+    # then 8 samples per 4 byte chunk per channel
+    samplesPerBlock = (blockSize - 4 * numChannels) * 2 // numChannels + 1
+
+    # fill out the last block with its final sample, the fact chunk has the real length
+    numBlocks = max(1, (numFrames + samplesPerBlock - 1) // samplesPerBlock)
+    paddedFrames = numBlocks * samplesPerBlock
+    padded = []
+    for samples in channels:
+        last = samples[-1] if len(samples) > 0 else 0
+        padded.append(samples + array("h", [last] * (paddedFrames - numFrames)))
+
+    states = [[0, 0] for _ in range(numChannels)]
+    errorSum = 0
+    data = bytearray()
+
+    for block in range(numBlocks):
+        start = block * samplesPerBlock
+
+        blockNibbles = []
+        for c in range(numChannels):
+            first = padded[c][start]
+            states[c][0] = first
+            data.extend(struct.pack("<hBB", first, states[c][1], 0))
+            nibbles, channelError = EncodeImaChannel(padded[c], start + 1, samplesPerBlock - 1, states[c])
+            blockNibbles.append(nibbles)
+            errorSum += channelError
+
+        # channels interleaved in 4 byte (8 sample) chunks, low nibble first
+        for chunk in range(0, samplesPerBlock - 1, 8):
+            for c in range(numChannels):
+                nibbles = blockNibbles[c]
+                for i in range(chunk, chunk + 8, 2):
+                    data.append(nibbles[i] | (nibbles[i + 1] << 4))
+
+    signalSum = sum(s * s for samples in channels for s in samples)
+    # the padding's error counts as if it were signal, close enough for a report
+    snr = 10 * math.log10(signalSum / errorSum) if errorSum > 0 and signalSum > 0 else float("inf")
+
+    return data, samplesPerBlock, numFrames, snr
+
+
+def DecodeImaAdpcm(data, numChannels, blockAlign, numFrames):
+    # type: (bytes, int, int, int) -> List[array]
+    """
+    Samples per channel from Microsoft IMA ADPCM blocks,
+    the inverse of EncodeImaAdpcm
+    """
+
+    channels = [array("h") for _ in range(numChannels)]
+
+    for blockStart in range(0, len(data) - 4 * numChannels + 1, blockAlign):
+        block = data[blockStart:blockStart + blockAlign]
+        states = []
+        for c in range(numChannels):
+            first, index, _ = struct.unpack_from("<hBB", block, 4 * c)
+            states.append([first, min(88, index)])
+            channels[c].append(first)
+
+        for chunkStart in range(4 * numChannels, len(block) - 4 * numChannels + 1, 4 * numChannels):
+            for c in range(numChannels):
+                state = states[c]
+                chunk = block[chunkStart + 4 * c:chunkStart + 4 * c + 4]
+                for byte in chunk:
+                    for nibble in (byte & 0x0F, byte >> 4):
+                        step = IMA_STEP_TABLE[state[1]]
+                        delta = step >> 3
+                        if nibble & 4:
+                            delta += step
+                        if nibble & 2:
+                            delta += step >> 1
+                        if nibble & 1:
+                            delta += step >> 2
+                        predicted = state[0] - delta if nibble & 8 else state[0] + delta
+                        state[0] = max(-32768, min(32767, predicted))
+                        state[1] = max(0, min(88, state[1] + IMA_INDEX_TABLE[nibble & 7]))
+                        channels[c].append(state[0])
+
+    return [samples[:numFrames] for samples in channels]
+
+
+def MakeWavFile(formatChunk, chunks):
+    # type: (bytes, List[Tuple[bytes, bytes]]) -> bytearray
+
+    body = bytearray(b"WAVE")
+    for chunkId, chunkData in [(b"fmt ", formatChunk)] + chunks:
+        body.extend(chunkId)
+        body.extend(struct.pack("<I", len(chunkData)))
+        body.extend(chunkData)
+        if len(chunkData) & 1:
+            body.append(0)
+
+    return bytearray(b"RIFF") + struct.pack("<I", len(body)) + body
+
+
+def ConvertWav(absSrcPath, absDstPath, codec, maxRate, blockSize):
+    # type: (str, str, str, int, int) -> Optional[Dict[str, Any]]
+    """
+    Write the resampled / ADPCM encoded WAV to absDstPath.
+    Returns the resource_index fields, or None to keep the file
+    because it isn't a PCM WAV or there's nothing to do.
+    """
+
+    pcm = ReadPcmWav(absSrcPath)
+    if pcm is None:
+        return None
+
+    channels, srcRate = pcm
+    rate = min(srcRate, maxRate)
+    numChannels = len(channels)
+
+    if codec == "pcm" and rate == srcRate:
+        return None
+
+    if rate != srcRate:
+        channels = [Resample(samples, srcRate, rate) for samples in channels]
+
+    report = {"source_size": os.path.getsize(absSrcPath)}
+    if rate != srcRate:
+        report["resampled"] = "{}->{}".format(srcRate, rate)
+
+    if codec == "adpcm":
+        data, samplesPerBlock, numFrames, snr = EncodeImaAdpcm(channels, blockSize)
+        formatChunk = struct.pack("<HHIIHHHH", WAVE_FORMAT_IMA_ADPCM, numChannels, rate,
+                                  rate * blockSize // samplesPerBlock, blockSize, 4, 2, samplesPerBlock)
+        wav = MakeWavFile(formatChunk, [(b"fact", struct.pack("<I", numFrames)), (b"data", data)])
+        report["snr_db"] = round(snr, 1)
+        audioCodec = "ima_adpcm"
+    else:
+        interleaved = array("h", bytes(2 * numChannels * len(channels[0])))
+        for c in range(numChannels):
+            interleaved[c::numChannels] = channels[c]
+        if sys.byteorder != "little":
+            interleaved.byteswap()
+        formatChunk = struct.pack("<HHIIHH", 1, numChannels, rate, rate * 2 * numChannels, 2 * numChannels, 16)
+        wav = MakeWavFile(formatChunk, [(b"data", interleaved.tobytes())])
+        audioCodec = "pcm"
+
+    with open(absDstPath, "wb") as f:
+        f.write(wav)
+
+    return {
+        "audio_codec": audioCodec,
+        "sample_rate": rate,
+        "report": report,
+    }
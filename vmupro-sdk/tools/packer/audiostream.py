@@ -0,0 +1,241 @@
+# 8BM Copyright/License notice
+# Optional chunked, stream-friendly layout for long music tracks in the LUA packer
+#
+# Enabled with --stream-music, or by adding a "streaming" policy to the
+# "build" section of metadata.json:
+#
+#   "build": {
+#       "streaming": {
+#           "paths": ["sounds/Intro_45sec.wav", "sounds/inner_sanctum_44k1_adpcm_stereo.wav"],
+#           "min_seconds": 4,
+#           "chunk_size": 8192,
+#           "block_size": 512
+#       }
+#   }
+#
+# Every PCM or IMA ADPCM .wav resource at least min_seconds long (and
+# whose path starts with one of "paths", if there are any) is re-laid out
+# so it can be read a chunk at a time instead of being loaded whole:
+#   - the sample data starts on a 512 byte boundary, the header is padded
+#     out with a standard "JUNK" chunk, so it's still an ordinary WAV that
+#     vmupro.sound.sample.new can load
+#   - the data is split into chunk_size byte chunks (a multiple of 512) of
+#     whole ADPCM blocks or PCM frames, so every chunk is sector aligned
+#     and decodes without the ones before it
+#   - ADPCM whose blocks don't fit a chunk evenly is re-encoded in
+#     block_size byte blocks
+# Streamed tracks are never compressed, and always start on a sector.
+#
+# Converted entries in resource_index get a "stream" object:
+#   "codec": "ima_adpcm" or "pcm", "channels", "sample_rate",
+#   "block_align", "samples_per_block" (1 for PCM), "frames",
+#   "data_offset": where the sample data starts within the resource,
+#   "chunk_size", "chunks": [offset within the resource, first frame]
+#   per chunk; every chunk is chunk_size bytes except the last
+
+import os
+import struct
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from audioconvert import (WAVE_FORMAT_IMA_ADPCM, DecodeImaAdpcm, EncodeImaAdpcm,
+                          MakeWavFile)
+
+
+STREAM_VERSION = 1
+
+SECTOR_SIZE = 512
+
+WAVE_FORMAT_PCM = 1
+
+DEFAULT_POLICY = {
+    "paths": [],
+    "min_seconds": 4,
+    "chunk_size": 8192,
+    "block_size": 512,
+}
+
+
+class StreamPolicyError(Exception):
+    pass
+
+
+def LoadStreamPolicy(inPolicy):
+    # type: (Optional[Dict[str, Any]]) -> Dict[str, Any]
+    """
+    Merge a "streaming" block from metadata.json over the defaults
+    and sanity check it. None gives the default policy.
+    """
+
+    policy = dict(DEFAULT_POLICY)
+    policy["paths"] = []
+
+    if inPolicy is None:
+        return policy
+
+    if not isinstance(inPolicy, dict):
+        raise StreamPolicyError("Expected 'streaming' to be an object")
+
+    for key, val in inPolicy.items():
+        if key not in policy:
+            raise StreamPolicyError("Unknown streaming option '{}'".format(key))
+        policy[key] = val
+
+    if not isinstance(policy["paths"], list) or not all(isinstance(p, str) for p in policy["paths"]):
+        raise StreamPolicyError("Expected streaming 'paths' to be a list of path prefixes")
+
+    if not isinstance(policy["min_seconds"], (int, float)) or policy["min_seconds"] < 0:
+        raise StreamPolicyError("Expected streaming 'min_seconds' to be 0 or more")
+
+    chunkSize = policy["chunk_size"]
+    if not isinstance(chunkSize, int) or chunkSize < SECTOR_SIZE or chunkSize % SECTOR_SIZE != 0:
+        raise StreamPolicyError("Expected streaming 'chunk_size' to be a multiple of {}".format(SECTOR_SIZE))
+
+    blockSize = policy["block_size"]
+    if (not isinstance(blockSize, int) or blockSize < 64 or blockSize % 8 != 0
+            or chunkSize % blockSize != 0):
+        raise StreamPolicyError("Expected streaming 'block_size' to be a multiple of 8, at least 64, that divides 'chunk_size'")
+
+    return policy
+
+
+def WantsStreaming(policy, relativePath):
+    # type: (Dict[str, Any], str) -> bool
+
+    if os.path.splitext(relativePath)[1].lower() != ".wav":
+        return False
+
+    return not policy["paths"] or any(relativePath.startswith(p) for p in policy["paths"])
+
+
+def GetStreamStage(policy, relativePath):
+    # type: (Dict[str, Any], str) -> Optional[Tuple[str, Callable[[str, str], Optional[Dict[str, Any]]]]]
+    """
+    Packer transform stage (key, function) for this resource,
+    or None if it isn't one of the policy's tracks
+    """
+
+    if not WantsStreaming(policy, relativePath):
+        return None
+
+    # everything that changes the output goes in the key
+    key = "streamv{}c{}b{}m{}".format(STREAM_VERSION, policy["chunk_size"],
+                                       policy["block_size"], policy["min_seconds"])
+
+    def StreamStage(absSrcPath, absDstPath):
+        # type: (str, str) -> Optional[Dict[str, Any]]
+        return LayOutStream(absSrcPath, absDstPath, policy["min_seconds"],
+                            policy["chunk_size"], policy["block_size"])
+
+    return (key, StreamStage)
+
+
+def ReadWavChunks(data):
+    # type: (bytes) -> Optional[List[Tuple[bytes, bytes]]]
+    """
+    The (id, data) chunks of a RIFF WAVE file in order,
+    or None if it isn't one
+    """
+
+    if len(data) < 12 or data[0:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+
+    chunks = []
+    pos = 12
+    while pos + 8 <= len(data):
+        chunkId = data[pos:pos + 4]
+        chunkLen = struct.unpack_from("<I", data, pos + 4)[0]
+        chunks.append((chunkId, data[pos + 8:pos + 8 + chunkLen]))
+        pos += 8 + chunkLen + (chunkLen & 1)
+
+    return chunks
+
+
+def LayOutStream(absSrcPath, absDstPath, minSeconds, chunkSize, blockSize):
+    # type: (str, str, float, int, int) -> Optional[Dict[str, Any]]
+    """
+    Write the chunked track to absDstPath.
+    Returns the resource_index fields, or None to keep the file
+    because it's too short or not in a format that can be chunked.
+    """
+
+    with open(absSrcPath, "rb") as f:
+        chunks = ReadWavChunks(f.read())
+    if chunks is None:
+        return None
+
+    chunksById = dict(chunks)
+    if b"fmt " not in chunksById or b"data" not in chunksById or len(chunksById[b"fmt "]) < 16:
+        return None
+
+    formatChunk = chunksById[b"fmt "]
+    data = chunksById[b"data"]
+    formatTag, numChannels, rate, _, blockAlign, bitsPerSample = struct.unpack_from("<HHIIHH", formatChunk)
+
+    if formatTag == WAVE_FORMAT_PCM and bitsPerSample in (8, 16):
+        codec = "pcm"
+        samplesPerBlock = 1
+        numFrames = len(data) // blockAlign
+    elif formatTag == WAVE_FORMAT_IMA_ADPCM and bitsPerSample == 4 and len(formatChunk) >= 20:
+        codec = "ima_adpcm"
+        samplesPerBlock = struct.unpack_from("<H", formatChunk, 18)[0]
+        if b"fact" in chunksById:
+            numFrames = struct.unpack_from("<I", chunksById[b"fact"])[0]
+        else:
+            numFrames = len(data) // blockAlign * samplesPerBlock
+    else:
+        return None
+
+    if numChannels not in (1, 2) or rate == 0 or numFrames / rate < minSeconds:
+        return None
+
+    report = {}
+    if codec == "ima_adpcm" and chunkSize % blockAlign != 0:
+        # blocks would straddle chunks, re-encode them to fit
+        samples = DecodeImaAdpcm(data, numChannels, blockAlign, numFrames)
+        data, samplesPerBlock, numFrames, snr = EncodeImaAdpcm(samples, blockSize)
+        blockAlign = blockSize
+        formatChunk = struct.pack("<HHIIHHHH", WAVE_FORMAT_IMA_ADPCM, numChannels, rate,
+                                  rate * blockSize // samplesPerBlock, blockSize, 4, 2, samplesPerBlock)
+        report["reencoded_block_size"] = blockSize
+        report["reencode_snr_db"] = round(snr, 1)
+
+    # only whole blocks / frames are played
+    data = data[:len(data) // blockAlign * blockAlign]
+
+    headerChunks = [(b"fmt ", formatChunk)]
+    if codec == "ima_adpcm":
+        headerChunks.append((b"fact", struct.pack("<I", numFrames)))
+
+    # RIFF header, the chunks, the JUNK and data chunk headers,
+    # then pad with JUNK so the sample data starts on a sector
+    headerLen = 12 + sum(8 + len(c) + (len(c) & 1) for _, c in headerChunks) + 8 + 8
+    junkLen = (SECTOR_SIZE - headerLen % SECTOR_SIZE) % SECTOR_SIZE
+    dataOffset = headerLen + junkLen
+
+    wav = MakeWavFile(formatChunk, headerChunks[1:] + [(b"JUNK", bytes(junkLen)), (b"data", data)])
+
+    with open(absDstPath, "wb") as f:
+        f.write(wav)
+
+    framesPerChunk = chunkSize // blockAlign * samplesPerBlock
+    chunkList = []
+    for i, offset in enumerate(range(0, len(data), chunkSize)):
+        chunkList.append([dataOffset + offset, i * framesPerChunk])
+
+    report["chunks"] = len(chunkList)
+    report["seconds"] = round(numFrames / rate, 1)
+
+    return {
+        "stream": {
+            "codec": codec,
+            "channels": numChannels,
+            "sample_rate": rate,
+            "block_align": blockAlign,
+            "samples_per_block": samplesPerBlock,
+            "frames": numFrames,
+            "data_offset": dataOffset,
+            "chunk_size": chunkSize,
+            "chunks": chunkList,
+        },
+        "report": report,
+    }
@@ -0,0 +1,292 @@
+# 8BM Copyright/License notice
+# Persistent build cache for the LUA packer
+#
+# Remembers what went into the last .vmupack for a given project/app name
+# so that the next run can skip the work for inputs that haven't changed:
+# - resources are keyed by path + (size, mtime); a match means the content
+#   hash recorded last time is still valid and the padded block can be
+#   copied straight out of the previous pack instead of re-reading the file
+# - the encoded icon section is stored as-is and reused when the icon file
+#   and transparency setting are unchanged
+# - transformed (e.g. compressed) resources are kept in an objects folder
+#   named by source hash + transform, so they're only re-encoded when the
+#   source or the settings change
+# - when the new pack has exactly the same section layout as the previous
+#   one, the packer only rewrites the byte ranges that changed, in place
+
+import os
+import json
+import hashlib
+from typing import Any, Dict, List, Optional, Tuple
+from pathlib import Path
+
+
+CACHE_VERSION = 2
+CACHE_DIR_NAME = "vmupacker_cache"
+
+
+def GetCacheDir(absProjectDir, appName):
+    # type: (Path, str) -> Path
+    return Path(absProjectDir) / CACHE_DIR_NAME / appName
+
+
+def FileStamp(absPath):
+    # type: (Path) -> Tuple[int, int]
+    """
+    Cheap change detection: (size, mtime in ns)
+    """
+    st = os.stat(absPath)
+    return (st.st_size, st.st_mtime_ns)
+
+
+def HashBytes(data):
+    # type: (bytes) -> str
+    return hashlib.sha1(data).hexdigest()
+
+
+def NewBuildCache():
+    # type: () -> Dict[str, Any]
+    return {
+        "cache_version": CACHE_VERSION,
+        "pack": None,
+        "inputs_sha1": None,
+        "icon": None,
+        "resources": {},
+    }
+
+
+def LoadBuildCache(absProjectDir, appName):
+    # type: (Path, str) -> Dict[str, Any]
+    """
+    Load the cache manifest from a previous build.
+    A missing or unreadable manifest just means a cold build.
+    """
+
+    absManifestPath = GetCacheDir(absProjectDir, appName) / "manifest.json"
+
+    if not os.path.isfile(absManifestPath):
+        print("  No build cache at {}, doing a full build".format(absManifestPath))
+        return NewBuildCache()
+
+    try:
+        with open(absManifestPath, "r") as f:
+            cache = json.load(f)
+    except Exception as e:
+        print("  Ignoring unreadable build cache {}: {}".format(absManifestPath, e))
+        return NewBuildCache()
+
+    if cache.get("cache_version") != CACHE_VERSION:
+        print("  Build cache version mismatch, doing a full build")
+        return NewBuildCache()
+
+    print("  Loaded build cache with {} resources from {}".format(
+        len(cache["resources"]), absManifestPath))
+    return cache
+
+
+def SaveBuildCache(absProjectDir, appName, cache):
+    # type: (Path, str, Dict[str, Any]) -> None
+    """
+    Persist the manifest for the next run.
+    Failure is non fatal; the next build will simply be a cold one.
+    """
+
+    absCacheDir = GetCacheDir(absProjectDir, appName)
+    absManifestPath = absCacheDir / "manifest.json"
+
+    try:
+        if not os.path.isdir(absCacheDir):
+            os.makedirs(absCacheDir)
+        with open(absManifestPath, "w") as f:
+            json.dump(cache, f, indent=1)
+        print("  Saved build cache to {}".format(absManifestPath))
+    except Exception as e:
+        print("  Couldn't save build cache (non fatal error)")
+        print("  Exception: {}".format(e))
+
+
+def GetObjectsDir(absProjectDir, appName):
+    # type: (Path, str) -> Path
+    return GetCacheDir(absProjectDir, appName) / "objects"
+
+
+def LookupResource(cache, relativePath, stamp, transform):
+    # type: (Dict[str, Any], str, Tuple[int, int], Optional[str]) -> Optional[Dict[str, Any]]
+    """
+    Returns the previous entry for this resource if the file on disk
+    still has the same (size, mtime) stamp and would be transformed
+    the same way, else None.
+    """
+
+    entry = cache["resources"].get(relativePath)
+    if entry is None:
+        return None
+
+    if entry["size"] != stamp[0] or entry["mtime_ns"] != stamp[1]:
+        return None
+
+    if entry["transform"] != transform:
+        return None
+
+    return entry
+
+
+def RecordResource(entries, block):
+    # type: (Dict[str, Any], Dict[str, Any]) -> None
+    """
+    Record where a resource landed in the pack that's about to be written.
+    The block's stamp should be taken before the file is read so that an
+    edit made mid-build is picked up next time.
+    """
+
+    entries[block["path"]] = {
+        "size": block["stamp"][0],
+        "mtime_ns": block["stamp"][1],
+        # of the data as stored in the pack
+        "sha1": block["sha1"],
+        "stored_size": block["size"],
+        # of the file on disk
+        "source_sha1": block["source_sha1"],
+        # transform attempted (even if it had no benefit) and the
+        # resource_index fields it added
+        "transform": block["transform"],
+        "fields": block["fields"],
+        "report": block["report"],
+        "offset": block["offset"],
+        "padding": block["padding"],
+    }
+
+
+def PruneObjects(cache, absObjectsDir):
+    # type: (Dict[str, Any], Path) -> None
+    """
+    Remove transformed resources no longer referenced by the cache
+    """
+
+    if not os.path.isdir(absObjectsDir):
+        return
+
+    keep = set()
+    for entry in cache["resources"].values():
+        if entry["transform"] is not None:
+            name = "{}.{}".format(entry["source_sha1"], entry["transform"])
+            keep.add(name)
+            keep.add(name + ".json")
+
+    for name in os.listdir(absObjectsDir):
+        if name not in keep:
+            try:
+                os.remove(os.path.join(absObjectsDir, name))
+            except OSError:
+                pass
+
+
+def GetPreviousResourceOffset(cache, absOutPath):
+    # type: (Dict[str, Any], Path) -> Optional[int]
+    """
+    Offset of the resource section in the previous pack.
+    Returns None if the pack has been modified or removed since it was
+    recorded, in which case none of the cached blocks can be trusted.
+    """
+
+    packInfo = cache.get("pack")
+    if packInfo is None or not os.path.isfile(absOutPath):
+        return None
+
+    size, mtime = FileStamp(absOutPath)
+    if packInfo["size"] != size or packInfo["mtime_ns"] != mtime:
+        print("  Previous pack {} changed outside the packer, ignoring cached blocks".format(absOutPath))
+        return None
+
+    return packInfo["resource_offset"]
+
+
+def LoadCachedIcon(cache, absProjectDir, appName, absIconPath, transparentBit):
+    # type: (Dict[str, Any], Path, str, str, bool) -> Optional[bytes]
+    """
+    Returns the previously encoded (unpadded) icon section if the icon
+    file and transparency flag are unchanged
+    """
+
+    iconInfo = cache.get("icon")
+    if iconInfo is None:
+        return None
+
+    try:
+        size, mtime = FileStamp(absIconPath)
+    except OSError:
+        return None
+
+    if (iconInfo["path"] != str(absIconPath) or iconInfo["size"] != size
+            or iconInfo["mtime_ns"] != mtime or iconInfo["transparency"] != transparentBit):
+        return None
+
+    absIconBinPath = GetCacheDir(absProjectDir, appName) / "icon.bin"
+    try:
+        with open(absIconBinPath, "rb") as f:
+            data = f.read()
+    except Exception:
+        return None
+
+    if HashBytes(data) != iconInfo["sha1"]:
+        return None
+
+    return data
+
+
+def StoreCachedIcon(cache, absProjectDir, appName, absIconPath, transparentBit, iconData):
+    # type: (Dict[str, Any], Path, str, str, bool, bytes) -> None
+
+    absCacheDir = GetCacheDir(absProjectDir, appName)
+    try:
+        if not os.path.isdir(absCacheDir):
+            os.makedirs(absCacheDir)
+        with open(absCacheDir / "icon.bin", "wb") as f:
+            f.write(iconData)
+    except Exception as e:
+        print("    Couldn't cache encoded icon (non fatal error): {}".format(e))
+        return
+
+    size, mtime = FileStamp(absIconPath)
+    cache["icon"] = {
+        "path": str(absIconPath),
+        "size": size,
+        "mtime_ns": mtime,
+        "transparency": transparentBit,
+        "sha1": HashBytes(iconData),
+    }
+
+
+def CanPatchPreviousPack(cache, absOutPath, sectionTable, totalSize):
+    # type: (Dict[str, Any], Path, List[Tuple[int, int]], int) -> bool
+    """
+    True if the pack on disk is the one we recorded and has exactly
+    the same size and section offsets/lengths as the new one
+    """
+
+    packInfo = cache.get("pack")
+    if packInfo is None or not os.path.isfile(absOutPath):
+        return False
+
+    size, mtime = FileStamp(absOutPath)
+    if packInfo["size"] != size or packInfo["mtime_ns"] != mtime:
+        return False
+
+    if size != totalSize:
+        return False
+
+    return [list(s) for s in sectionTable] == packInfo["sections"]
+
+
+def RecordPack(cache, absOutPath, sectionTable, resourceOffset, resourceLength, inputsSha1):
+    # type: (Dict[str, Any], Path, List[Tuple[int, int]], int, int, str) -> None
+
+    size, mtime = FileStamp(absOutPath)
+    cache["pack"] = {
+        "size": size,
+        "mtime_ns": mtime,
+        "sections": [list(s) for s in sectionTable],
+        "resource_offset": resourceOffset,
+        "resource_length": resourceLength,
+    }
+    cache["inputs_sha1"] = inputsSha1
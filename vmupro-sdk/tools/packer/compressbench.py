@@ -0,0 +1,238 @@
+# 8BM Copyright/License notice
+# Host-side benchmark for per-resource compression
+#
+# For every resource in a project's metadata.json, compress it with each
+# codec and model how long the device takes to get it into RAM:
+#
+#   raw        = open/seek + stored sectors / SD throughput
+#   compressed = open/seek + fewer sectors / SD throughput
+#                + original size / device inflate throughput
+#
+# The SD and inflate rates are rough defaults for an ESP32-class device
+# reading over SPI, calibrate them with timings from your own hardware.
+# Host inflate speed is measured and printed for reference only.
+#
+# Usage:
+#   python3 compressbench.py --projectdir ../../examples/nested_example --meta metadata.json
+#   python3 compressbench.py --projectdir . --meta metadata.json --sd-mbps 2.5 --json bench.json
+
+import sys
+import argparse
+import os
+import json
+import time
+import zlib
+from typing import Any, Dict, List, Tuple
+from pathlib import Path
+
+from compression import CODECS, DEFAULT_POLICY
+
+
+SECTOR_SIZE = 512
+
+
+def CollectResources(absProjectDir, resources):
+    # type: (Path, List[str]) -> List[Tuple[str, Path]]
+    """
+    Same file/folder expansion as the packer, without the per-file output
+    """
+
+    files = []
+    for r in resources:
+        absResPath = (absProjectDir / r).resolve()
+        if os.path.isfile(absResPath):
+            files.append((r, absResPath))
+        elif os.path.isdir(absResPath):
+            for root, _, filenames in os.walk(absResPath):
+                for filename in filenames:
+                    absFilePath = Path(root) / filename
+                    relativePath = str(absFilePath.relative_to(absProjectDir.resolve())).replace('\\', '/')
+                    files.append((relativePath, absFilePath))
+        else:
+            print("Resource {} is neither file nor folder at {}".format(r, absResPath))
+            sys.exit(1)
+
+    return files
+
+
+def ModelReadTime(numBytes, args):
+    # type: (int, argparse.Namespace) -> float
+    """
+    Modelled device time in ms to read numBytes, padded to whole sectors
+    """
+
+    numSectors = (numBytes + SECTOR_SIZE - 1) // SECTOR_SIZE
+    transferMs = numSectors * SECTOR_SIZE / (args.sd_mbps * 1000.0)
+    return args.sd_seek_ms + transferMs
+
+
+def TimeInflate(codec, data, repeats):
+    # type: (str, bytes, int) -> float
+    """
+    Best of n host decompression times in ms
+    """
+
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        zlib.decompress(data, CODECS[codec])
+        elapsed = (time.perf_counter() - start) * 1000.0
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def BenchFile(relativePath, absPath, args):
+    # type: (str, Path, argparse.Namespace) -> Dict[str, Any]
+
+    with open(absPath, "rb") as f:
+        data = f.read()
+
+    rawMs = ModelReadTime(len(data), args)
+    result = {
+        "path": relativePath,
+        "type": os.path.splitext(relativePath)[1].lower(),
+        "size": len(data),
+        "raw_ms": rawMs,
+        "codecs": {},
+        "best": "none",
+    }
+
+    bestMs = rawMs
+    for codec in sorted(CODECS):
+        compressor = zlib.compressobj(args.level, zlib.DEFLATED, CODECS[codec])
+        packed = compressor.compress(data) + compressor.flush()
+        inflateMs = len(data) / (args.inflate_mbps * 1000.0)
+        totalMs = ModelReadTime(len(packed), args) + inflateMs
+
+        result["codecs"][codec] = {
+            "size": len(packed),
+            "ratio": len(packed) / float(len(data)) if len(data) > 0 else 1.0,
+            "host_inflate_ms": TimeInflate(codec, packed, args.repeats),
+            "device_inflate_ms": inflateMs,
+            "total_ms": totalMs,
+        }
+
+        if totalMs < bestMs and len(packed) + args.min_saved_bytes <= len(data):
+            bestMs = totalMs
+            result["best"] = codec
+
+    return result
+
+
+def SummariseTypes(results):
+    # type: (List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]
+    """
+    Totals per file type, and whether the type as a whole loads
+    faster compressed with zlib
+    """
+
+    types = {}
+    for r in results:
+        t = types.setdefault(r["type"], {
+            "files": 0, "size": 0, "zlib_size": 0, "raw_ms": 0.0, "zlib_ms": 0.0, "files_won": 0})
+        t["files"] += 1
+        t["size"] += r["size"]
+        t["zlib_size"] += r["codecs"]["zlib"]["size"]
+        t["raw_ms"] += r["raw_ms"]
+        t["zlib_ms"] += r["codecs"]["zlib"]["total_ms"]
+        if r["best"] != "none":
+            t["files_won"] += 1
+
+    for t in types.values():
+        t["recommend"] = "zlib" if t["zlib_ms"] < t["raw_ms"] else "none"
+
+    return types
+
+
+def main():
+
+    print("\n")
+    print("8BM VMUPro compression benchmark")
+    print("\n")
+
+    parser = argparse.ArgumentParser(
+        description="Model SD read time against decompression cost for each resource")
+    parser.add_argument("--projectdir", required=True,
+                        help="Root folder containing your LUA app")
+    parser.add_argument("--meta", required=True,
+                        help="Relative path .JSON metadata for your package: metadata.json from projectdir")
+    parser.add_argument("--level", type=int, required=False, default=DEFAULT_POLICY["level"],
+                        help="zlib compression level 0-9")
+    parser.add_argument("--min-saved-bytes", type=int, required=False,
+                        default=DEFAULT_POLICY["min_saved_bytes"],
+                        help="Only count compression as a win if it saves at least this much")
+    parser.add_argument("--sd-mbps", type=float, required=False, default=1.5,
+                        help="Device SD read throughput in MB/s")
+    parser.add_argument("--sd-seek-ms", type=float, required=False, default=2.0,
+                        help="Device cost in ms to open/seek to a resource")
+    parser.add_argument("--inflate-mbps", type=float, required=False, default=6.0,
+                        help="Device decompression throughput in MB/s of output")
+    parser.add_argument("--repeats", type=int, required=False, default=3,
+                        help="Host inflate timings are the best of this many runs")
+    parser.add_argument("--json", required=False,
+                        help="Also write the full results to this JSON file")
+
+    args = parser.parse_args()
+
+    absProjectDir = Path(args.projectdir).resolve()
+    absMetaPath = absProjectDir / args.meta
+
+    try:
+        with open(absMetaPath, "r") as f:
+            resources = json.load(f).get("resources") or []
+    except Exception as e:
+        print("Failed to read {}: {}".format(absMetaPath, e))
+        sys.exit(1)
+
+    files = CollectResources(absProjectDir, resources)
+    print("Benchmarking {} files (SD {} MB/s + {} ms seek, inflate {} MB/s)\n".format(
+        len(files), args.sd_mbps, args.sd_seek_ms, args.inflate_mbps))
+
+    results = [BenchFile(rel, absPath, args) for rel, absPath in files]
+
+    print("{:<48} {:>10} {:>10} {:>6} {:>9} {:>9} {:>8}".format(
+        "Resource", "Raw", "zlib", "Ratio", "Raw ms", "zlib ms", "Best"))
+    for r in results:
+        z = r["codecs"]["zlib"]
+        print("{:<48} {:>10,} {:>10,} {:>6.2f} {:>9.2f} {:>9.2f} {:>8}".format(
+            r["path"][-48:], r["size"], z["size"], z["ratio"], r["raw_ms"], z["total_ms"], r["best"]))
+
+    types = SummariseTypes(results)
+    print("\nPer file type:")
+    print("{:<8} {:>6} {:>12} {:>12} {:>10} {:>10} {:>6} {:>10}".format(
+        "Type", "Files", "Raw", "zlib", "Raw ms", "zlib ms", "Wins", "Policy"))
+    for ext in sorted(types):
+        t = types[ext]
+        print("{:<8} {:>6} {:>12,} {:>12,} {:>10.1f} {:>10.1f} {:>6} {:>10}".format(
+            ext or "(none)", t["files"], t["size"], t["zlib_size"],
+            t["raw_ms"], t["zlib_ms"], t["files_won"], t["recommend"]))
+
+    totalRaw = sum(r["raw_ms"] for r in results)
+    totalBest = sum(r["codecs"][r["best"]]["total_ms"] if r["best"] != "none" else r["raw_ms"]
+                    for r in results)
+    print("\nModelled load time for every resource: {:.1f} ms raw, {:.1f} ms with the best codec per file".format(
+        totalRaw, totalBest))
+
+    suggested = {ext: "zlib" for ext, t in sorted(types.items()) if t["recommend"] == "zlib" and ext}
+    print("\nSuggested metadata policy:")
+    print(json.dumps({"build": {"compression": {"level": args.level, "types": suggested}}}, indent=4))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "model": {
+                    "sd_mbps": args.sd_mbps,
+                    "sd_seek_ms": args.sd_seek_ms,
+                    "inflate_mbps": args.inflate_mbps,
+                    "level": args.level,
+                },
+                "files": results,
+                "types": types,
+            }, f, indent=4)
+        print("\nWrote {}".format(args.json))
+
+
+if __name__ == "__main__":
+    main()
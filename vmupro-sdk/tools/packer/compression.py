@@ -0,0 +1,186 @@
+# 8BM Copyright/License notice
+# Optional per-resource compression for the LUA packer
+#
+# Enabled with --compress, or by adding a "compression" policy to the
+# "build" section of metadata.json:
+#
+#   "build": {
+#       "compression": {
+#           "level": 9,
+#           "min_saved_bytes": 512,
+#           "types": { ".lua": "zlib", ".wav": "zlib" },
+#           "files": { "sounds/Intro_45sec.wav": "none" }
+#       }
+#   }
+#
+# "types" maps file extensions to a codec, "files" overrides individual
+# resource paths. A file is only stored compressed if that saves at
+# least min_saved_bytes (one SD sector by default), otherwise it's
+# stored raw as usual.
+#
+# Compressed entries in resource_index get two extra fields:
+#   "codec": e.g. "zlib"
+#   "original_size": size after decompression
+# with "size" / "padded_size" describing the stored (compressed) data.
+
+import os
+import zlib
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+# codec name -> zlib wbits
+# zlib: 2 byte header + adler32 trailer, deflate: raw stream, no checks
+CODECS = {
+    "zlib": zlib.MAX_WBITS,
+    "deflate": -zlib.MAX_WBITS,
+}
+
+COMPRESSION_VERSION = 1
+
+DEFAULT_POLICY = {
+    "level": 9,
+    "min_saved_bytes": 512,
+    "types": {
+        ".lua": "zlib",
+        ".wav": "zlib",
+        ".bmp": "zlib",
+        ".json": "zlib",
+        ".txt": "zlib",
+        ".mid": "zlib",
+    },
+    "files": {},
+}
+
+
+class CompressionPolicyError(Exception):
+    pass
+
+
+def LoadCompressionPolicy(inPolicy):
+    # type: (Optional[Dict[str, Any]]) -> Dict[str, Any]
+    """
+    Merge a "compression" block from metadata.json over the defaults
+    and sanity check it. None gives the default policy.
+    """
+
+    policy = {
+        "level": DEFAULT_POLICY["level"],
+        "min_saved_bytes": DEFAULT_POLICY["min_saved_bytes"],
+        "types": dict(DEFAULT_POLICY["types"]),
+        "files": {},
+    }
+
+    if inPolicy is None:
+        return policy
+
+    if not isinstance(inPolicy, dict):
+        raise CompressionPolicyError("Expected 'compression' to be an object")
+
+    for key, val in inPolicy.items():
+        if key not in policy:
+            raise CompressionPolicyError("Unknown compression option '{}'".format(key))
+        if key in ("types", "files"):
+            if not isinstance(val, dict):
+                raise CompressionPolicyError("Expected compression '{}' to be an object".format(key))
+            # given types replace the defaults entirely
+            policy[key] = dict(val)
+        else:
+            policy[key] = val
+
+    if not isinstance(policy["level"], int) or policy["level"] < 0 or policy["level"] > 9:
+        raise CompressionPolicyError("Expected compression 'level' between 0 and 9")
+
+    if not isinstance(policy["min_saved_bytes"], int) or policy["min_saved_bytes"] < 0:
+        raise CompressionPolicyError("Expected compression 'min_saved_bytes' to be 0 or more")
+
+    for key in ("types", "files"):
+        for name, codec in policy[key].items():
+            if codec != "none" and codec not in CODECS:
+                raise CompressionPolicyError("Unknown codec '{}' for '{}', expected one of: none, {}".format(
+                    codec, name, ", ".join(sorted(CODECS))))
+
+    # extensions are matched case insensitively
+    policy["types"] = {ext.lower(): codec for ext, codec in policy["types"].items()}
+
+    return policy
+
+
+def GetCodecForPath(policy, relativePath):
+    # type: (Dict[str, Any], str) -> Optional[str]
+    """
+    Codec the policy picks for this resource, or None to store it raw
+    """
+
+    codec = policy["files"].get(relativePath)
+    if codec is None:
+        ext = os.path.splitext(relativePath)[1].lower()
+        codec = policy["types"].get(ext)
+
+    if codec is None or codec == "none":
+        return None
+
+    return codec
+
+
+def GetTransformKey(policy, codec):
+    # type: (Dict[str, Any], str) -> str
+    """
+    Short string identifying the exact encoding, so cached output is only
+    reused when the codec, level and min_saved_bytes match
+    """
+
+    # everything that changes the output goes in the key
+    return "{}v{}l{}m{}".format(codec, COMPRESSION_VERSION, policy["level"], policy["min_saved_bytes"])
+
+
+def GetCompressionStage(policy, relativePath, chunkSize):
+    # type: (Dict[str, Any], str, int) -> Optional[Tuple[str, Callable[[str, str], Optional[Dict[str, Any]]]]]
+    """
+    Packer transform stage (key, function) for this resource,
+    or None if the policy leaves it raw
+    """
+
+    codec = GetCodecForPath(policy, relativePath)
+    if codec is None:
+        return None
+
+    def CompressStage(absSrcPath, absDstPath):
+        # type: (str, str) -> Optional[Dict[str, Any]]
+        srcSize = os.path.getsize(absSrcPath)
+        dstSize = CompressFile(absSrcPath, absDstPath, codec, policy["level"], chunkSize)
+        # not worth the decompression if it doesn't save a sector or so
+        if dstSize + policy["min_saved_bytes"] > srcSize:
+            return None
+        return {"codec": codec, "original_size": srcSize}
+
+    return (GetTransformKey(policy, codec), CompressStage)
+
+
+def CompressFile(absSrcPath, absDstPath, codec, level, chunkSize):
+    # type: (str, str, str, int, int) -> int
+    """
+    Stream-compress a file to absDstPath, one chunk at a time
+    Returns the compressed size
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, CODECS[codec])
+    written = 0
+
+    with open(absSrcPath, "rb") as src, open(absDstPath, "wb") as dst:
+        while True:
+            chunk = src.read(chunkSize)
+            if not chunk:
+                break
+            out = compressor.compress(chunk)
+            dst.write(out)
+            written += len(out)
+        out = compressor.flush()
+        dst.write(out)
+        written += len(out)
+
+    return written
+
+
+def DecompressBytes(codec, data):
+    # type: (str, bytes) -> bytes
+    return zlib.decompress(data, CODECS[codec])
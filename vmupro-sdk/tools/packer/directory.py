@@ -0,0 +1,156 @@
+# 8BM Copyright/License notice
+# Optional binary resource directory for the LUA packer
+#
+# The JSON metadata lists every resource, but resolving a path from it
+# means parsing the whole string at boot and searching a list per lookup.
+# Enabled with --directory, or by adding to the "build" section of
+# metadata.json:
+#
+#   "build": {
+#       "directory": true
+#   }
+#
+# the packer also writes a hash table of the resource_index between the
+# metadata and resource sections, so a path resolves to its offset and size
+# with a hash and (usually) one probe. Its offset and length are in the
+# header at 0x68 / 0x6C, both 0 if there isn't one.
+#
+#   32 byte header, little-endian fields:
+#     'VDIR', version, entries, slots (a power of 2), hash (0 = FNV-1a 32),
+#     slot table offset, names offset, names length
+#   slot table, one 20 byte slot per entry, little-endian fields:
+#     path hash, name offset (from the start of the names), resource offset
+#     (within the resource section, as in resource_index), size, flags
+#   names: each path as UTF-8, NUL terminated
+#
+# A path goes in slot (hash & (slots - 1)), or the next free one after it
+# (wrapping around), and at most half the slots are used. To look one up,
+# start at the same slot and step forward until the hash and name match,
+# or until an empty slot (flags 0) means it isn't in the pack.
+#
+# Flags:
+#   0x1 used, 0x2 compressed ("codec" in resource_index),
+#   0x4 converted ("format" in resource_index), 0x8 alias of another path
+# Anything beyond the flags (codec, width, palette, ...) is still only
+# in the JSON metadata.
+
+from typing import Any, Dict, List
+
+
+DIRECTORY_MAGIC = b'VDIR'
+DIRECTORY_VERSION = 1
+DIRECTORY_HEADER_SIZE = 32
+DIRECTORY_SLOT_SIZE = 20
+
+HASH_FNV1A_32 = 0
+
+FNV_OFFSET_BASIS = 0x811C9DC5
+FNV_PRIME = 0x01000193
+
+FLAG_USED = 0x1
+FLAG_COMPRESSED = 0x2
+FLAG_CONVERTED = 0x4
+FLAG_ALIAS = 0x8
+
+
+def HashPath(path):
+    # type: (str) -> int
+    """
+    32 bit FNV-1a of the UTF-8 path, cheap to match on the device
+    """
+
+    val = FNV_OFFSET_BASIS
+    for b in path.encode("utf-8"):
+        val = ((val ^ b) * FNV_PRIME) & 0xFFFFFFFF
+
+    return val
+
+
+def GetEntryFlags(entry):
+    # type: (Dict[str, Any]) -> int
+
+    flags = FLAG_USED
+    if "codec" in entry:
+        flags |= FLAG_COMPRESSED
+    if "format" in entry:
+        flags |= FLAG_CONVERTED
+    if "alias_of" in entry:
+        flags |= FLAG_ALIAS
+
+    return flags
+
+
+def GetNumSlots(numEntries):
+    # type: (int) -> int
+    """
+    Smallest power of 2 that keeps the table at most half full
+    """
+
+    numSlots = 1
+    while numSlots < numEntries * 2:
+        numSlots *= 2
+
+    return numSlots
+
+
+def BuildDirectory(resourceIndex):
+    # type: (List[Dict[str, Any]]) -> bytearray
+    """
+    The directory section for these resource_index entries,
+    unpadded. Returns the section bytes.
+    """
+
+    numSlots = GetNumSlots(len(resourceIndex))
+    slots = [None] * numSlots
+
+    names = bytearray()
+    for entry in resourceIndex:
+        path = entry["path"]
+        pathHash = HashPath(path)
+        nameOffset = len(names)
+        names.extend(path.encode("utf-8"))
+        names.append(0)
+
+        # open addressing, linear probing
+        slot = pathHash & (numSlots - 1)
+        while slots[slot] is not None:
+            slot = (slot + 1) & (numSlots - 1)
+        slots[slot] = (pathHash, nameOffset, entry["offset"], entry["size"], GetEntryFlags(entry))
+
+    slotTableOffset = DIRECTORY_HEADER_SIZE
+    namesOffset = slotTableOffset + numSlots * DIRECTORY_SLOT_SIZE
+
+    section = bytearray(DIRECTORY_MAGIC)
+    for val in (DIRECTORY_VERSION, len(resourceIndex), numSlots, HASH_FNV1A_32,
+                slotTableOffset, namesOffset, len(names)):
+        section.extend(val.to_bytes(4, byteorder='little'))
+
+    for slotVals in slots:
+        for val in slotVals or (0, 0, 0, 0, 0):
+            section.extend(val.to_bytes(4, byteorder='little'))
+
+    section.extend(names)
+
+    return section
+
+
+def GetMaxProbes(section):
+    # type: (bytearray) -> int
+    """
+    Longest run of slots a lookup in this directory has to check,
+    for the build report
+    """
+
+    numSlots = int.from_bytes(section[12:16], byteorder='little')
+    slotTableOffset = int.from_bytes(section[20:24], byteorder='little')
+
+    maxProbes = 0
+    for slot in range(numSlots):
+        pos = slotTableOffset + slot * DIRECTORY_SLOT_SIZE
+        if int.from_bytes(section[pos + 16:pos + 20], byteorder='little') == 0:
+            continue
+        pathHash = int.from_bytes(section[pos:pos + 4], byteorder='little')
+        home = pathHash & (numSlots - 1)
+        maxProbes = max(maxProbes, ((slot - home) & (numSlots - 1)) + 1)
+
+    return maxProbes
@@ -0,0 +1,33 @@
+# 8BM Copyright/License notice
+# Image encoding helpers shared by the packer and other build tools
+#
+# Everything here works on whole PIL images using Pillow's C-level
+# point/chops/merge operations, so there's no per-pixel Python loop.
+
+from PIL import Image, ImageChops
+
+
+# Lookup tables for splitting 8 bit channels into the two bytes
+# of a big-endian RGB565 pixel: RRRRRGGG GGGBBBBB
+_HI_RED = [v & 0xF8 for v in range(256)]
+_HI_GREEN = [v >> 5 for v in range(256)]
+_LO_GREEN = [(v << 3) & 0xE0 for v in range(256)]
+_LO_BLUE = [v >> 3 for v in range(256)]
+
+
+def encode_rgb565(image):
+    # type: (Image.Image) -> bytes
+    """
+    Encode a PIL image as big-endian RGB565, row by row, 2 bytes per pixel.
+    Any alpha channel or palette is flattened by converting to RGB first.
+    """
+
+    red, green, blue = image.convert("RGB").split()
+
+    # Red and green bits don't overlap within each byte,
+    # so a (clamped) add is the same as a bitwise or
+    hiBytes = ImageChops.add(red.point(_HI_RED), green.point(_HI_GREEN))
+    loBytes = ImageChops.add(green.point(_LO_GREEN), blue.point(_LO_BLUE))
+
+    # A two-band image serialises its bands interleaved: hi, lo, hi, lo...
+    return Image.merge("LA", (hiBytes, loBytes)).tobytes()
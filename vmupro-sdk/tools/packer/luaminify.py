@@ -0,0 +1,676 @@
+# 8BM Copyright/License notice
+# Optional Lua minification for release builds in the LUA packer
+#
+# Enabled with --minify-lua, or by adding a "lua" policy to the "build"
+# section of metadata.json:
+#
+#   "build": {
+#       "lua": {
+#           "paths": ["app_full.lua"],
+#           "exclude": [],
+#           "constants": { "DEBUG_TEXTURE_LOG": false, "DEBUG_CYCLE_VIEW": false },
+#           "drop_functions": ["wallQuadLog"]
+#       }
+#   }
+#
+# Every .lua resource whose path starts with one of "paths" (all of them
+# if it's empty) and none of "exclude" is stored with its comments and
+# indentation removed and only the spaces Lua needs between tokens.
+# Names are never renamed and every statement stays on its original line,
+# so error messages and stack traces still point at the source.
+#
+# "constants" are globals that are fixed for this build. An if/elseif
+# whose condition is one of them (or "not" one of them, or an and/or
+# chain that one of them decides) is folded: dead branches are dropped
+# and a branch that's always taken becomes a do ... end block. A constant
+# the script assigns more than once (e.g. from a debug menu) isn't folded.
+#
+# "drop_functions" are debug-only functions: their body is removed, so
+# they do nothing and return nothing, and statements that just call them
+# are removed along with their arguments. A function that returns a value
+# can't be dropped, its callers would get nil.
+#
+# Minified entries in resource_index get the field:
+#   "minified": true
+
+import hashlib
+import json
+import os
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+LUA_MINIFY_VERSION = 2
+
+DEFAULT_POLICY = {
+    "paths": [],
+    "exclude": [],
+    "constants": {},
+    "drop_functions": [],
+}
+
+KEYWORDS = {
+    "and", "break", "do", "else", "elseif", "end", "false", "for", "function",
+    "goto", "if", "in", "local", "nil", "not", "or", "repeat", "return", "then",
+    "true", "until", "while",
+}
+
+# longest first, so e.g. "..." isn't read as ".." + "."
+OPERATORS = [
+    "...", "..", "==", "~=", "<=", ">=", "//", "::", "<<", ">>",
+    "+", "-", "*", "/", "%", "^", "#", "&", "~", "|", "<", ">", "=",
+    "(", ")", "{", "}", "[", "]", ";", ":", ",", ".",
+]
+
+# character pairs that would lex as something else if written together
+JOINED_OPERATORS = {"==", "~=", "<=", ">=", "//", "..", "::", "<<", ">>", "--", "[[", "[="}
+
+# tokens after which a name starts a new statement, not part of an expression
+EXPRESSION_TOKENS = {
+    "and", "or", "not", "return", "if", "elseif", "while", "until", "in", "local",
+    "function", "for", "goto",
+}
+
+# block openers / closers, for finding where an if or function ends
+BLOCK_OPEN = {"if", "function", "do", "repeat"}
+BLOCK_CLOSE = {"end", "until"}
+
+NAME_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+NUMBER_RE = re.compile(r"0[xX][0-9a-fA-F]*(?:\.[0-9a-fA-F]*)?(?:[pP][+-]?[0-9]+)?"
+                       r"|(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?")
+LONG_BRACKET_RE = re.compile(r"\[(=*)\[")
+
+# token kinds
+NAME = 0
+KEYWORD = 1
+NUMBER = 2
+STRING = 3
+OPERATOR = 4
+
+
+class LuaPolicyError(Exception):
+    pass
+
+
+class LuaSyntaxError(Exception):
+    pass
+
+
+def LoadLuaPolicy(inPolicy):
+    # type: (Optional[Dict[str, Any]]) -> Dict[str, Any]
+    """
+    Merge a "lua" block from metadata.json over the defaults
+    and sanity check it. None gives the default policy.
+    """
+
+    policy = dict(DEFAULT_POLICY)
+    policy["paths"] = []
+    policy["exclude"] = []
+    policy["constants"] = {}
+    policy["drop_functions"] = []
+
+    if inPolicy is None:
+        return policy
+
+    if not isinstance(inPolicy, dict):
+        raise LuaPolicyError("Expected 'lua' to be an object")
+
+    for key, val in inPolicy.items():
+        if key not in policy:
+            raise LuaPolicyError("Unknown lua option '{}'".format(key))
+        policy[key] = val
+
+    for key in ("paths", "exclude", "drop_functions"):
+        if not isinstance(policy[key], list) or not all(isinstance(p, str) for p in policy[key]):
+            raise LuaPolicyError("Expected lua '{}' to be a list of strings".format(key))
+
+    if not isinstance(policy["constants"], dict):
+        raise LuaPolicyError("Expected lua 'constants' to be an object")
+
+    for name, val in policy["constants"].items():
+        if not NAME_RE.fullmatch(name) or name in KEYWORDS:
+            raise LuaPolicyError("'{}' isn't a Lua name".format(name))
+        if val is not None and not isinstance(val, (bool, int, float, str)):
+            raise LuaPolicyError("Expected the constant '{}' to be true, false, null, a number or a string".format(name))
+
+    for name in policy["drop_functions"]:
+        if not NAME_RE.fullmatch(name) or name in KEYWORDS:
+            raise LuaPolicyError("'{}' isn't a Lua name".format(name))
+
+    return policy
+
+
+def GetLuaStage(policy, relativePath):
+    # type: (Dict[str, Any], str) -> Optional[Tuple[str, Callable[[str, str], Optional[Dict[str, Any]]]]]
+    """
+    Packer transform stage (key, function) for this resource,
+    or None if it isn't one of the policy's scripts
+    """
+
+    if os.path.splitext(relativePath)[1].lower() != ".lua":
+        return None
+
+    if any(relativePath.startswith(p) for p in policy["exclude"]):
+        return None
+
+    if policy["paths"] and not any(relativePath.startswith(p) for p in policy["paths"]):
+        return None
+
+    # everything that changes the output goes in the key
+    key = "luav{}".format(LUA_MINIFY_VERSION)
+    if policy["constants"] or policy["drop_functions"]:
+        options = json.dumps([policy["constants"], sorted(policy["drop_functions"])], sort_keys=True)
+        key += "c" + hashlib.sha1(options.encode("utf-8")).hexdigest()[:12]
+
+    def LuaStage(absSrcPath, absDstPath):
+        # type: (str, str) -> Optional[Dict[str, Any]]
+        return MinifyLuaFile(absSrcPath, absDstPath, policy["constants"], set(policy["drop_functions"]))
+
+    return (key, LuaStage)
+
+
+def Tokenize(source):
+    # type: (str) -> List[Tuple[int, str, int]]
+    """
+    Split Lua source into (kind, text, line) tokens, dropping
+    comments and whitespace. Strings are kept exactly as written.
+    """
+
+    tokens = []
+    pos = 0
+    line = 1
+    end = len(source)
+
+    # "#!..." on the first line is skipped by the Lua loader
+    if source.startswith("#"):
+        pos = source.find("\n")
+        if pos < 0:
+            return tokens
+
+    while pos < end:
+        c = source[pos]
+
+        if c == "\n":
+            line += 1
+            pos += 1
+            continue
+
+        if c in " \t\r\f\v":
+            pos += 1
+            continue
+
+        if source.startswith("--", pos):
+            match = LONG_BRACKET_RE.match(source, pos + 2)
+            if match:
+                close = source.find("]" + match.group(1) + "]", match.end())
+                if close < 0:
+                    raise LuaSyntaxError("line {}: unfinished long comment".format(line))
+                stop = close + len(match.group(1)) + 2
+            else:
+                stop = source.find("\n", pos)
+                if stop < 0:
+                    stop = end
+            line += source.count("\n", pos, stop)
+            pos = stop
+            continue
+
+        match = LONG_BRACKET_RE.match(source, pos)
+        if match:
+            close = source.find("]" + match.group(1) + "]", match.end())
+            if close < 0:
+                raise LuaSyntaxError("line {}: unfinished long string".format(line))
+            stop = close + len(match.group(1)) + 2
+            tokens.append((STRING, source[pos:stop], line))
+            line += source.count("\n", pos, stop)
+            pos = stop
+            continue
+
+        if c == "\"" or c == "'":
+            stop = pos + 1
+            while True:
+                if stop >= end or source[stop] == "\n":
+                    raise LuaSyntaxError("line {}: unfinished string".format(line))
+                if source[stop] == "\\":
+                    # the escaped char may be a newline
+                    stop += 2
+                    if source.startswith("\r\n", stop - 1):
+                        stop += 1
+                    continue
+                if source[stop] == c:
+                    break
+                stop += 1
+            stop += 1
+            tokens.append((STRING, source[pos:stop], line))
+            line += source.count("\n", pos, stop)
+            pos = stop
+            continue
+
+        if c.isdigit() or (c == "." and pos + 1 < end and source[pos + 1].isdigit()):
+            match = NUMBER_RE.match(source, pos)
+            tokens.append((NUMBER, match.group(0), line))
+            pos = match.end()
+            continue
+
+        match = NAME_RE.match(source, pos)
+        if match:
+            text = match.group(0)
+            tokens.append((KEYWORD if text in KEYWORDS else NAME, text, line))
+            pos = match.end()
+            continue
+
+        for op in OPERATORS:
+            if source.startswith(op, pos):
+                tokens.append((OPERATOR, op, line))
+                pos += len(op)
+                break
+        else:
+            raise LuaSyntaxError("line {}: unexpected character '{}'".format(line, c))
+
+    return tokens
+
+
+def NeedsSpace(prev, token):
+    # type: (Tuple[int, str, int], Tuple[int, str, int]) -> bool
+    """
+    Whether two tokens on the same line need a space between them
+    to still be read as two tokens
+    """
+
+    prevWordy = prev[0] in (NAME, KEYWORD, NUMBER)
+    if prevWordy and (token[0] in (NAME, KEYWORD, NUMBER)):
+        return True
+
+    # "1 .." would read as a malformed number
+    if prev[0] == NUMBER and token[1].startswith("."):
+        return True
+
+    return (prev[1][-1] + token[1][0]) in JOINED_OPERATORS
+
+
+def FindBlockEnd(tokens, start):
+    # type: (List[Tuple[int, str, int]], int) -> int
+    """
+    Index of the "end" closing the block opened just before start
+    """
+
+    depth = 0
+    for i in range(start, len(tokens)):
+        kind, text, _ = tokens[i]
+        if kind != KEYWORD:
+            continue
+        if text in BLOCK_OPEN:
+            depth += 1
+        elif text in BLOCK_CLOSE:
+            if depth == 0:
+                return i
+            depth -= 1
+
+    raise LuaSyntaxError("line {}: missing 'end'".format(tokens[start - 1][2]))
+
+
+def FindMatchingParen(tokens, start):
+    # type: (List[Tuple[int, str, int]], int) -> int
+    """
+    Index of the ")" matching the "(" at start
+    """
+
+    depth = 0
+    for i in range(start, len(tokens)):
+        if tokens[i][0] != OPERATOR:
+            continue
+        if tokens[i][1] in ("(", "{", "["):
+            depth += 1
+        elif tokens[i][1] in (")", "}", "]"):
+            depth -= 1
+            if depth == 0:
+                return i
+
+    raise LuaSyntaxError("line {}: missing ')'".format(tokens[start][2]))
+
+
+def GetFunctionName(tokens, i):
+    # type: (List[Tuple[int, str, int]], int) -> Optional[str]
+    """
+    Name defined by the "function" keyword at i: the last part of
+    "function a.b.name(" or "name = function(", or None if anonymous
+    """
+
+    if i + 1 < len(tokens) and tokens[i + 1][0] == NAME:
+        j = i + 1
+        while j + 2 < len(tokens) and tokens[j + 1][1] in (".", ":") and tokens[j + 2][0] == NAME:
+            j += 2
+        return tokens[j][1]
+
+    if i >= 2 and tokens[i - 1][1] == "=" and tokens[i - 2][0] == NAME:
+        # not "t[k] = function" or "a, b = x, function"
+        if i < 3 or tokens[i - 3][1] not in ("]", ","):
+            return tokens[i - 2][1]
+
+    return None
+
+
+def StartsStatement(tokens, i):
+    # type: (List[Tuple[int, str, int]], int) -> bool
+    """
+    Whether the name at i begins a statement rather than
+    continuing an expression or a definition
+    """
+
+    if i == 0:
+        return True
+
+    kind, text, _ = tokens[i - 1]
+    if kind == KEYWORD:
+        return text not in EXPRESSION_TOKENS
+    if kind == OPERATOR:
+        return text in (")", "]", "}", ";", "::")
+
+    # a name, number or string ends the previous statement
+    return True
+
+
+def ReturnsValue(tokens, start, end):
+    # type: (List[Tuple[int, str, int]], int, int) -> Optional[int]
+    """
+    Line of the first "return <expr>" between start and end,
+    skipping nested functions, or None if there isn't one
+    """
+
+    i = start
+    while i < end:
+        kind, text, line = tokens[i]
+        if kind == KEYWORD and text == "function":
+            openParen = i + 1
+            while tokens[openParen][1] != "(":
+                openParen += 1
+            i = FindBlockEnd(tokens, FindMatchingParen(tokens, openParen) + 1) + 1
+            continue
+        if kind == KEYWORD and text == "return" and tokens[i + 1][1] not in ("end", "else", "elseif", "until", ";"):
+            return line
+        i += 1
+
+    return None
+
+
+def DropDebugFunctions(tokens, names, counts):
+    # type: (List[Tuple[int, str, int]], set, Dict[str, int]) -> List[Tuple[int, str, int]]
+    """
+    Empty the bodies of the named functions and remove
+    the statements that do nothing but call them
+    """
+
+    out = []
+    i = 0
+    while i < len(tokens):
+        kind, text, _ = tokens[i]
+
+        if kind == KEYWORD and text == "function" and GetFunctionName(tokens, i) in names:
+            openParen = i + 1
+            while tokens[openParen][1] != "(":
+                openParen += 1
+            closeParen = FindMatchingParen(tokens, openParen)
+            blockEnd = FindBlockEnd(tokens, closeParen + 1)
+            returnLine = ReturnsValue(tokens, closeParen + 1, blockEnd)
+            if returnLine is not None:
+                raise LuaPolicyError("line {}: '{}' returns a value, its callers would get nil if it was dropped".format(
+                    returnLine, GetFunctionName(tokens, i)))
+            out.extend(tokens[i:closeParen + 1])
+            out.append(tokens[blockEnd])
+            counts["stubbed"] += 1
+            i = blockEnd + 1
+            continue
+
+        if (kind == NAME and text in names and i + 1 < len(tokens) and tokens[i + 1][1] == "("
+                and StartsStatement(tokens, i)):
+            closeParen = FindMatchingParen(tokens, i + 1)
+            # the result isn't used, indexed or called again
+            following = tokens[closeParen + 1] if closeParen + 1 < len(tokens) else None
+            if following is None or not (following[0] == STRING or following[1] in ("(", ".", ":", "[", "{")):
+                counts["dropped_calls"] += 1
+                i = closeParen + 1
+                continue
+
+        out.append(tokens[i])
+        i += 1
+
+    return out
+
+
+def EvalOperand(tokens, constants):
+    # type: (List[Tuple[int, str, int]], Dict[str, Any]) -> Optional[bool]
+    """
+    Truthiness of a simple operand: a constant, a literal, or "not" one
+    of them. None if it isn't known at build time.
+    """
+
+    negate = False
+    while len(tokens) > 1 and tokens[0][1] == "not":
+        negate = not negate
+        tokens = tokens[1:]
+
+    if len(tokens) != 1:
+        return None
+
+    kind, text, _ = tokens[0]
+    if kind == NAME and text in constants:
+        val = constants[text]
+        truthy = val is not None and val is not False
+    elif kind == KEYWORD and text in ("true", "false", "nil"):
+        truthy = text == "true"
+    else:
+        return None
+
+    return truthy != negate
+
+
+def EvalCondition(tokens, constants):
+    # type: (List[Tuple[int, str, int]], Dict[str, Any]) -> Optional[bool]
+    """
+    Truthiness of an if condition, if a chain of "and"s or "or"s is
+    decided by its constants. None if it depends on run time values.
+    """
+
+    operands = [[]]
+    ops = set()
+    depth = 0
+    for token in tokens:
+        if token[0] == KEYWORD and token[1] == "function":
+            return None
+        if token[0] == OPERATOR and token[1] in ("(", "{", "["):
+            depth += 1
+        elif token[0] == OPERATOR and token[1] in (")", "}", "]"):
+            depth -= 1
+        if depth == 0 and token[0] == KEYWORD and token[1] in ("and", "or"):
+            ops.add(token[1])
+            operands.append([])
+            continue
+        operands[-1].append(token)
+
+    # mixed and/or needs precedence, not worth it
+    if len(ops) > 1:
+        return None
+
+    values = [EvalOperand(operand, constants) for operand in operands]
+
+    # any false in an "and" chain, any true in an "or" chain decides it
+    decider = "or" in ops
+    if decider in values:
+        return decider
+    if all(v is not None for v in values):
+        return not decider
+
+    return None
+
+
+def FoldConstantBranches(tokens, constants, counts):
+    # type: (List[Tuple[int, str, int]], Dict[str, Any], Dict[str, int]) -> List[Tuple[int, str, int]]
+    """
+    Drop the branches of each if statement that can never run, and turn
+    a branch that always runs into a do ... end block
+    """
+
+    out = []
+    i = 0
+    while i < len(tokens):
+        kind, text, line = tokens[i]
+        if kind != KEYWORD or text != "if":
+            out.append(tokens[i])
+            i += 1
+            continue
+
+        # split the statement into (keyword, condition, then, body) branches
+        branches = []
+        keyword = tokens[i]
+        pos = i + 1
+        while True:
+            condition = []
+            thenToken = None
+            if keyword[1] != "else":
+                while not (tokens[pos][0] == KEYWORD and tokens[pos][1] == "then"):
+                    condition.append(tokens[pos])
+                    pos += 1
+                    if pos >= len(tokens):
+                        raise LuaSyntaxError("line {}: missing 'then'".format(keyword[2]))
+                thenToken = tokens[pos]
+                pos += 1
+
+            bodyStart = pos
+            depth = 0
+            while True:
+                if pos >= len(tokens):
+                    raise LuaSyntaxError("line {}: missing 'end'".format(keyword[2]))
+                bKind, bText, _ = tokens[pos]
+                if bKind == KEYWORD:
+                    if bText in BLOCK_OPEN:
+                        depth += 1
+                    elif bText in BLOCK_CLOSE and depth > 0:
+                        depth -= 1
+                    elif depth == 0 and bText in ("elseif", "else", "end"):
+                        break
+                pos += 1
+
+            body = FoldConstantBranches(tokens[bodyStart:pos], constants, counts)
+            branches.append((keyword, condition, thenToken, body))
+            keyword = tokens[pos]
+            pos += 1
+            if keyword[1] == "end":
+                break
+
+        endToken = keyword
+        i = pos
+
+        kept = []
+        for keyword, condition, thenToken, body in branches:
+            value = True if keyword[1] == "else" else EvalCondition(condition, constants)
+            if value is False:
+                continue
+            kept.append((keyword, condition if value is None else None, thenToken, body))
+            if value is True:
+                break
+
+        if len(kept) < len(branches) or any(c is None and k[1] != "else" for k, c, _, _ in kept):
+            counts["folded"] += 1
+
+        if len(kept) == 0:
+            continue
+
+        # always taken, still a block of its own for its locals and returns
+        if kept[0][1] is None:
+            out.append((KEYWORD, "do", kept[0][0][2]))
+            out.extend(kept[0][3])
+            out.append(endToken)
+            continue
+
+        for n, (keyword, condition, thenToken, body) in enumerate(kept):
+            if condition is None:
+                out.append((KEYWORD, "else", keyword[2]))
+            else:
+                out.append((KEYWORD, "if" if n == 0 else "elseif", keyword[2]))
+                out.extend(condition)
+                out.append(thenToken)
+            out.extend(body)
+        out.append(endToken)
+
+    return out
+
+
+def FindReassignedConstants(tokens, constants):
+    # type: (List[Tuple[int, str, int]], Dict[str, Any]) -> List[str]
+    """
+    Constants this script assigns more than once, folding
+    them would change what the script does so they're left alone
+    """
+
+    assignments = {}
+    for i in range(len(tokens) - 1):
+        kind, text, _ = tokens[i]
+        if kind == NAME and text in constants and tokens[i + 1][1] == "=":
+            if i == 0 or tokens[i - 1][1] not in (".", ":"):
+                assignments[text] = assignments.get(text, 0) + 1
+
+    return sorted(name for name, count in assignments.items() if count > 1)
+
+
+def WriteTokens(tokens):
+    # type: (List[Tuple[int, str, int]]) -> str
+    """
+    Put each token back on its original line,
+    with a space between tokens only where needed
+    """
+
+    parts = []
+    curLine = 1
+    prev = None
+    for token in tokens:
+        if token[2] > curLine:
+            parts.append("\n" * (token[2] - curLine))
+            curLine = token[2]
+        elif prev is not None and NeedsSpace(prev, token):
+            parts.append(" ")
+        parts.append(token[1])
+        curLine += token[1].count("\n")
+        prev = token
+
+    parts.append("\n")
+    return "".join(parts)
+
+
+def MinifyLuaFile(absSrcPath, absDstPath, constants, dropFunctions):
+    # type: (str, str, Dict[str, Any], set) -> Dict[str, Any]
+    """
+    Write the minified script to absDstPath
+    Returns the resource_index fields
+    """
+
+    with open(absSrcPath, "rb") as f:
+        # Lua strings are bytes, keep any that aren't UTF-8 as they are
+        source = f.read().decode("latin-1")
+
+    counts = {"folded": 0, "stubbed": 0, "dropped_calls": 0}
+
+    try:
+        tokens = Tokenize(source)
+        reassigned = FindReassignedConstants(tokens, constants)
+        constants = {name: val for name, val in constants.items() if name not in reassigned}
+        if dropFunctions:
+            tokens = DropDebugFunctions(tokens, dropFunctions, counts)
+        if constants:
+            tokens = FoldConstantBranches(tokens, constants, counts)
+    except LuaPolicyError as e:
+        raise LuaPolicyError("Can't minify {}: {}".format(absSrcPath, e))
+    except (LuaSyntaxError, IndexError) as e:
+        raise LuaSyntaxError("Can't minify {}: {}".format(absSrcPath, e or "unexpected end of file"))
+
+    minified = WriteTokens(tokens).encode("latin-1")
+    with open(absDstPath, "wb") as f:
+        f.write(minified)
+
+    report = {"source_size": os.path.getsize(absSrcPath)}
+    report.update((k, v) for k, v in counts.items() if v > 0)
+    if reassigned:
+        report["reassigned_constants"] = ", ".join(reassigned)
+
+    return {
+        "minified": True,
+        "report": report,
+    }
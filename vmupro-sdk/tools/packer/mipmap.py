@@ -0,0 +1,232 @@
+# 8BM Copyright/License notice
+# Optional mipmap chain generation for wall textures in the LUA packer
+#
+# Enabled by adding a "mipmaps" policy to the "build" section of
+# metadata.json:
+#
+#   "build": {
+#       "mipmaps": {
+#           "paths": ["sprites/wall_textures/"],
+#           "exclude": ["sprites/wall_textures/wall-1-tile-table-1-128.png"],
+#           "filter": "gamma",
+#           "gamma": 2.2,
+#           "min_size": 8
+#       }
+#   }
+#
+# Every PNG or BMP whose path starts with one of "paths" (and none of
+# "exclude") is replaced by its whole mip chain, halving down to
+# min_size pixels on the shorter side. Each level is filtered straight
+# from the full size image, either a plain box average or a box average
+# in linear light ("gamma"), which keeps distant walls from darkening.
+#
+# Textures keep their resource path, but the data is stored as:
+#
+#   32 byte header, little-endian fields:
+#     'SMIP', version, width, height, levels, filter (0 box, 1 gamma),
+#     pixel format (0 = RGB565), reserved
+#   level table, one 16 byte entry per level, largest first:
+#     offset from the start of the resource, width, height, size
+#   each level as 16 bit big-endian RGB565 pixels, row by row (as the icon)
+#
+# Textures are treated as opaque, any alpha channel is dropped.
+#
+# Converted entries in resource_index get the fields:
+#   "format": "mipmap", "width", "height", "levels"
+
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from imagecodec import encode_rgb565
+
+
+MIPMAP_MAGIC = b'SMIP'
+MIPMAP_VERSION = 1
+MIPMAP_HEADER_SIZE = 32
+MIPMAP_LEVEL_ENTRY_SIZE = 16
+
+MIPMAP_FILTERS = {
+    "box": 0,
+    "gamma": 1,
+}
+
+PIXEL_FORMAT_RGB565 = 0
+
+# linear light is held as 0..LINEAR_SCALE, the largest
+# table Image.point takes for going back to 8 bit
+LINEAR_SCALE = 65535
+
+IMAGE_TYPES = (".png", ".bmp")
+
+DEFAULT_POLICY = {
+    "paths": [],
+    "exclude": [],
+    "filter": "box",
+    "gamma": 2.2,
+    "min_size": 8,
+}
+
+
+class MipmapPolicyError(Exception):
+    pass
+
+
+def LoadMipmapPolicy(inPolicy):
+    # type: (Optional[Dict[str, Any]]) -> Dict[str, Any]
+    """
+    Merge a "mipmaps" block from metadata.json over the defaults
+    and sanity check it
+    """
+
+    policy = dict(DEFAULT_POLICY)
+    policy["paths"] = []
+    policy["exclude"] = []
+
+    if inPolicy is None:
+        return policy
+
+    if not isinstance(inPolicy, dict):
+        raise MipmapPolicyError("Expected 'mipmaps' to be an object")
+
+    for key, val in inPolicy.items():
+        if key not in policy:
+            raise MipmapPolicyError("Unknown mipmaps option '{}'".format(key))
+        policy[key] = val
+
+    for key in ("paths", "exclude"):
+        if not isinstance(policy[key], list) or not all(isinstance(p, str) for p in policy[key]):
+            raise MipmapPolicyError("Expected mipmaps '{}' to be a list of path prefixes".format(key))
+
+    if policy["filter"] not in MIPMAP_FILTERS:
+        raise MipmapPolicyError("Expected mipmaps 'filter' to be one of: {}".format(", ".join(sorted(MIPMAP_FILTERS))))
+
+    if not isinstance(policy["gamma"], (int, float)) or policy["gamma"] <= 0:
+        raise MipmapPolicyError("Expected mipmaps 'gamma' to be a positive number")
+
+    minSize = policy["min_size"]
+    if not isinstance(minSize, int) or minSize < 1:
+        raise MipmapPolicyError("Expected mipmaps 'min_size' to be 1 or more")
+
+    return policy
+
+
+def WantsMipmaps(policy, relativePath):
+    # type: (Dict[str, Any], str) -> bool
+
+    if os.path.splitext(relativePath)[1].lower() not in IMAGE_TYPES:
+        return False
+
+    if any(relativePath.startswith(p) for p in policy["exclude"]):
+        return False
+
+    return any(relativePath.startswith(p) for p in policy["paths"])
+
+
+def GetMipmapStage(policy, relativePath):
+    # type: (Dict[str, Any], str) -> Optional[Tuple[str, Callable[[str, str], Optional[Dict[str, Any]]]]]
+    """
+    Packer transform stage (key, function) for this resource,
+    or None if it isn't one of the policy's textures
+    """
+
+    if not WantsMipmaps(policy, relativePath):
+        return None
+
+    # everything that changes the output goes in the key
+    key = "mip{}v{}m{}".format(policy["filter"], MIPMAP_VERSION, policy["min_size"])
+    if policy["filter"] == "gamma":
+        key += "g{}s{}".format(policy["gamma"], LINEAR_SCALE)
+
+    def MipmapStage(absSrcPath, absDstPath):
+        # type: (str, str) -> Optional[Dict[str, Any]]
+        return EncodeMipmapChain(absSrcPath, absDstPath, policy["filter"], policy["gamma"], policy["min_size"])
+
+    return (key, MipmapStage)
+
+
+def GetLevelSizes(width, height, minSize):
+    # type: (int, int, int) -> List[Tuple[int, int]]
+    """
+    (width, height) of each level, largest first, halving (rounding up)
+    until the next level would be smaller than minSize on its shorter side
+    """
+
+    sizes = [(width, height)]
+    while min(width, height) // 2 >= minSize:
+        width = (width + 1) // 2
+        height = (height + 1) // 2
+        sizes.append((width, height))
+
+    return sizes
+
+
+def MakeLevels(rgb, numLevels, filterName, gamma):
+    # type: (Image.Image, int, str, float) -> List[Image.Image]
+    """
+    Box filter each level straight from the full size image,
+    so rounding doesn't build up down the chain
+    """
+
+    if filterName == "box":
+        return [rgb] + [rgb.reduce(1 << level) for level in range(1, numLevels)]
+
+    # average in linear light, then back to gamma space, using lookup
+    # tables rather than ImageMath so any Pillow version will do
+    toLinear = [(i / 255.0) ** gamma * LINEAR_SCALE for i in range(256)]
+    toGamma = [int((i / LINEAR_SCALE) ** (1.0 / gamma) * 255.0 + 0.5) for i in range(LINEAR_SCALE + 1)]
+    linear = [c.point(toLinear, "F") for c in rgb.split()]
+
+    levels = [rgb]
+    for level in range(1, numLevels):
+        channels = []
+        for c in linear:
+            # round to the nearest table entry
+            reduced = c.reduce(1 << level).point(lambda v: v + 0.5).convert("I")
+            channels.append(reduced.point(toGamma, "L"))
+        levels.append(Image.merge("RGB", channels))
+
+    return levels
+
+
+def EncodeMipmapChain(absSrcPath, absDstPath, filterName, gamma, minSize):
+    # type: (str, str, str, float, int) -> Dict[str, Any]
+    """
+    Write the texture's mip chain to absDstPath
+    Returns the resource_index fields
+    """
+
+    with Image.open(absSrcPath) as im:
+        rgb = im.convert("RGB")
+
+    width, height = rgb.size
+    sizes = GetLevelSizes(width, height, minSize)
+    levels = MakeLevels(rgb, len(sizes), filterName, gamma)
+
+    header = bytearray(MIPMAP_MAGIC)
+    for val in (MIPMAP_VERSION, width, height, len(levels), MIPMAP_FILTERS[filterName], PIXEL_FORMAT_RGB565, 0):
+        header.extend(val.to_bytes(4, byteorder='little'))
+
+    levelTable = bytearray()
+    levelData = []
+    offset = MIPMAP_HEADER_SIZE + MIPMAP_LEVEL_ENTRY_SIZE * len(levels)
+    for level in levels:
+        pixels = encode_rgb565(level)
+        for val in (offset, level.size[0], level.size[1], len(pixels)):
+            levelTable.extend(val.to_bytes(4, byteorder='little'))
+        levelData.append(pixels)
+        offset += len(pixels)
+
+    with open(absDstPath, "wb") as f:
+        f.write(header)
+        f.write(levelTable)
+        for pixels in levelData:
+            f.write(pixels)
+
+    return {
+        "format": "mipmap",
+        "width": width,
+        "height": height,
+        "levels": len(levels),
+    }
@@ -0,0 +1,470 @@
+# 8BM Copyright/License notice
+# Throughput and memory benchmark for the LUA packer
+#
+# Generates synthetic projects of a configurable shape, packs each one with
+# packer.py in a fresh process and records:
+#
+#   wall time    = end to end, including interpreter start up
+#   step timings = from the packer's --stats output (validate, metadata,
+#                  resources, layout, icon, header, write, ...)
+#   peak RSS     = of the packer process, where the OS reports it
+#
+# The scenarios stress different parts of the packer:
+#
+#   pngs  = many small PNG sprites, each listed in the metadata
+#   wavs  = a few long PCM WAV tracks
+#   tree  = a deep folder tree, listed as one folder and scanned recursively
+#   lua   = one large Lua entry point
+#   mixed = all of the above in one project
+#
+# The generated files are deterministic, so results from different
+# checkouts of the packer can be compared. Save a run with --json and
+# pass it back with --baseline to see what a change did.
+#
+# Usage:
+#   python3 packbench.py --json bench.json
+#   python3 packbench.py --scenarios pngs tree --pngs 2000 --baseline bench.json
+#   python3 packbench.py --packer-args="--compress --jobs 1" --json compress.json
+
+import sys
+import argparse
+import os
+import json
+import math
+import platform
+import random
+import shlex
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+from pathlib import Path
+
+from buildcache import CACHE_DIR_NAME
+
+
+PACKER_PATH = Path(__file__).resolve().parent / "packer.py"
+
+ICON_PATH = Path(__file__).resolve().parent / "default_icon.bmp"
+
+SCENARIOS = ("pngs", "wavs", "tree", "lua", "mixed")
+
+BENCH_VERSION = 1
+
+
+def WritePng(absPath, width, height, rng):
+    # type: (Path, int, int, random.Random) -> None
+    """
+    RGBA PNG with a gradient and some noise, so it
+    compresses about as well as a real sprite
+    """
+
+    rows = bytearray()
+    for y in range(height):
+        rows.append(0)
+        for x in range(width):
+            noise = rng.randrange(32)
+            alpha = 0 if (x + y) % 7 == 0 else 255
+            rows.extend((x * 255 // width ^ noise, y * 255 // height, noise * 4, alpha))
+
+    def Chunk(chunkType, data):
+        # type: (bytes, bytes) -> bytes
+        return (struct.pack(">I", len(data)) + chunkType + data
+                + struct.pack(">I", zlib.crc32(chunkType + data) & 0xFFFFFFFF))
+
+    with open(absPath, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(Chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+        f.write(Chunk(b"IDAT", zlib.compress(bytes(rows), 6)))
+        f.write(Chunk(b"IEND", b""))
+
+
+def WriteWav(absPath, seconds, rate, rng):
+    # type: (Path, float, int, random.Random) -> None
+    """
+    16 bit mono PCM tone with noise on top
+    """
+
+    numFrames = int(seconds * rate)
+    freq = rng.choice((220.0, 330.0, 440.0))
+    samples = bytearray()
+    for i in range(numFrames):
+        value = 8000 * math.sin(2 * math.pi * freq * i / rate) + rng.randrange(-600, 600)
+        samples.extend(struct.pack("<h", int(value)))
+
+    formatChunk = struct.pack("<HHIIHH", 1, 1, rate, rate * 2, 2, 16)
+    with open(absPath, "wb") as f:
+        f.write(b"RIFF" + struct.pack("<I", 4 + 8 + len(formatChunk) + 8 + len(samples)) + b"WAVE")
+        f.write(b"fmt " + struct.pack("<I", len(formatChunk)) + formatChunk)
+        f.write(b"data" + struct.pack("<I", len(samples)) + samples)
+
+
+def WriteLua(absPath, targetBytes, rng):
+    # type: (Path, int, random.Random) -> None
+    """
+    Plausible Lua of roughly targetBytes: functions, tables, comments and strings
+    """
+
+    lines = ["-- Generated by packbench.py", "local M = {}", ""]
+    size = 0
+    n = 0
+    while size < targetBytes:
+        block = [
+            "-- Update entity {} and its children".format(n),
+            "-- (comments and indentation are left in, like a real script)",
+            "function M.update_{}(entity, dt)".format(n),
+            "    local speed = {} * dt".format(rng.randrange(1, 200)),
+            "    if entity.state == \"state_{}\" then".format(rng.randrange(10)),
+            "        entity.x = entity.x + speed",
+            "        entity.frames = {{ {} }}".format(", ".join(str(rng.randrange(64)) for _ in range(8))),
+            "    else",
+            "        entity.y = entity.y - speed  -- fall back",
+            "    end",
+            "    return entity",
+            "end",
+            "",
+        ]
+        n += 1
+        size += sum(len(line) + 1 for line in block)
+        lines.extend(block)
+
+    lines.append("return M")
+    with open(absPath, "w", newline="\n") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def WriteTree(absDir, depth, fanout, filesPerFolder, rng):
+    # type: (Path, int, int, int, random.Random) -> int
+    """
+    Folder tree depth levels deep, fanout folders per level,
+    with a few small files in every folder. Returns the file count.
+    """
+
+    os.makedirs(absDir, exist_ok=True)
+    numFiles = 0
+    for i in range(filesPerFolder):
+        ext = (".lua", ".json", ".bin")[i % 3]
+        with open(absDir / "file_{}{}".format(i, ext), "wb") as f:
+            f.write(bytes(rng.randrange(256) for _ in range(rng.randrange(64, 2048))))
+        numFiles += 1
+
+    if depth > 1:
+        for i in range(fanout):
+            numFiles += WriteTree(absDir / "dir_{}".format(i), depth - 1, fanout, filesPerFolder, rng)
+
+    return numFiles
+
+
+def GenerateProject(absProjectDir, scenario, args):
+    # type: (Path, str, argparse.Namespace) -> Dict[str, Any]
+    """
+    Write the scenario's files and metadata.json into absProjectDir
+    """
+
+    rng = random.Random(args.seed)
+    os.makedirs(absProjectDir, exist_ok=True)
+    shutil.copyfile(ICON_PATH, absProjectDir / "icon.bmp")
+
+    resources = ["app.lua"]
+    luaBytes = args.lua_kb * 1024 if scenario in ("lua", "mixed") else 2048
+    WriteLua(absProjectDir / "app.lua", luaBytes, rng)
+
+    if scenario in ("pngs", "mixed"):
+        os.makedirs(absProjectDir / "sprites", exist_ok=True)
+        for i in range(args.pngs):
+            relPath = "sprites/sprite_{:05d}.png".format(i)
+            WritePng(absProjectDir / relPath, args.png_size, args.png_size, rng)
+            resources.append(relPath)
+
+    if scenario in ("wavs", "mixed"):
+        os.makedirs(absProjectDir / "sounds", exist_ok=True)
+        for i in range(args.wavs):
+            relPath = "sounds/track_{}.wav".format(i)
+            WriteWav(absProjectDir / relPath, args.wav_seconds, args.wav_rate, rng)
+            resources.append(relPath)
+
+    if scenario in ("tree", "mixed"):
+        WriteTree(absProjectDir / "data", args.depth, args.fanout, args.folder_files, rng)
+        resources.append("data")
+
+    meta = {
+        "metadata_version": 1,
+        "app_name": "Bench {}".format(scenario),
+        "app_author": "8BitMods",
+        "app_version": "1.0.0",
+        "app_entry_point": "app.lua",
+        "app_mode": 1,
+        "app_environment": "lua",
+        "icon_transparency": False,
+        "resources": resources,
+    }
+    with open(absProjectDir / "metadata.json", "w") as f:
+        json.dump(meta, f, indent=2)
+
+    numFiles = 0
+    inputBytes = 0
+    for root, dirs, files in os.walk(absProjectDir):
+        for name in files:
+            if name not in ("icon.bmp", "metadata.json"):
+                numFiles += 1
+                inputBytes += os.path.getsize(os.path.join(root, name))
+
+    return {"files": numFiles, "input_bytes": inputBytes}
+
+
+def CleanProject(absProjectDir, appName):
+    # type: (Path, str) -> None
+    """
+    Remove the previous run's pack and build cache, so every run packs from scratch
+    """
+
+    for name in (appName + ".vmupack", appName + ".vmupack.tmp"):
+        if os.path.exists(absProjectDir / name):
+            os.remove(absProjectDir / name)
+    shutil.rmtree(absProjectDir / CACHE_DIR_NAME, ignore_errors=True)
+
+
+def RunPacker(absProjectDir, appName, packerArgs, absStatsPath, absLogPath):
+    # type: (Path, str, List[str], Path, Path) -> Tuple[int, float, Optional[int]]
+    """
+    Pack the project in a new process.
+    Returns the exit code, the wall time in seconds and the peak RSS in bytes
+    (None where the OS can't report it for a single child process)
+    """
+
+    cmd = [sys.executable, str(PACKER_PATH),
+           "--projectdir", str(absProjectDir),
+           "--appname", appName,
+           "--meta", "metadata.json",
+           "--icon", "icon.bmp",
+           "--quiet",
+           "--stats", str(absStatsPath)] + packerArgs
+
+    with open(absLogPath, "w") as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+
+        if not hasattr(os, "wait4"):
+            exitCode = proc.wait()
+            return exitCode, time.perf_counter() - start, None
+
+        # wait4 gives the usage of just this child
+        _, status, usage = os.wait4(proc.pid, 0)
+        wallSeconds = time.perf_counter() - start
+
+    exitCode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    proc.returncode = exitCode
+
+    # kilobytes on Linux, bytes on macOS
+    peakRss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+    return exitCode, wallSeconds, peakRss
+
+
+def BenchScenario(absWorkDir, scenario, args):
+    # type: (Path, str, argparse.Namespace) -> Dict[str, Any]
+
+    absProjectDir = absWorkDir / scenario
+    appName = "bench_" + scenario
+
+    print("Generating '{}' project...".format(scenario))
+    result = GenerateProject(absProjectDir, scenario, args)
+    print("  {} files, {:,} bytes".format(result["files"], result["input_bytes"]))
+
+    runs = []
+    for i in range(args.repeats):
+        CleanProject(absProjectDir, appName)
+        absStatsPath = absWorkDir / "{}_stats.json".format(scenario)
+        absLogPath = absWorkDir / "{}.log".format(scenario)
+
+        exitCode, wallSeconds, peakRss = RunPacker(
+            absProjectDir, appName, shlex.split(args.packer_args), absStatsPath, absLogPath)
+        if exitCode != 0:
+            print("  Packer failed with exit code {}, see {}".format(exitCode, absLogPath))
+            sys.exit(1)
+
+        with open(absStatsPath, "r") as f:
+            stats = json.load(f)
+
+        runs.append({
+            "wall_seconds": wallSeconds,
+            "peak_rss": peakRss,
+            "timings": stats["timings"],
+        })
+        print("  Run {}: {:.3f}s, packer total {:.3f}s{}".format(
+            i + 1, wallSeconds, stats["timings"]["total"],
+            "" if peakRss is None else ", peak RSS {:.1f} MB".format(peakRss / 1048576.0)))
+
+    # steps are reported from the fastest run, memory is the worst seen
+    best = min(runs, key=lambda r: r["wall_seconds"])
+    rssValues = [r["peak_rss"] for r in runs if r["peak_rss"] is not None]
+
+    result.update({
+        "pack_size": stats["pack_size"],
+        "padding_bytes": stats["padding_bytes"],
+        "resources": stats["resources"]["count"],
+        "wall_seconds": best["wall_seconds"],
+        "median_wall_seconds": sorted(r["wall_seconds"] for r in runs)[len(runs) // 2],
+        "mb_per_second": result["input_bytes"] / 1048576.0 / best["timings"]["total"]
+                         if best["timings"]["total"] > 0 else 0.0,
+        "peak_rss": max(rssValues) if rssValues else None,
+        "timings": best["timings"],
+        "runs": runs,
+    })
+
+    return result
+
+
+def PrintResults(results):
+    # type: (Dict[str, Dict[str, Any]]) -> None
+
+    print("\n{:<8} {:>7} {:>13} {:>13} {:>9} {:>9} {:>8} {:>9}".format(
+        "Scenario", "Files", "Input", "Pack", "Wall s", "Median s", "MB/s", "RSS MB"))
+    for scenario, r in results.items():
+        print("{:<8} {:>7} {:>13,} {:>13,} {:>9.3f} {:>9.3f} {:>8.1f} {:>9}".format(
+            scenario, r["files"], r["input_bytes"], r["pack_size"], r["wall_seconds"],
+            r["median_wall_seconds"], r["mb_per_second"],
+            "-" if r["peak_rss"] is None else "{:.1f}".format(r["peak_rss"] / 1048576.0)))
+
+    steps = []
+    for r in results.values():
+        steps.extend(step for step in r["timings"] if step not in steps)
+
+    print("\nPacker steps, ms (fastest run):")
+    print("{:<8} ".format("Scenario") + " ".join("{:>9}".format(step) for step in steps))
+    for scenario, r in results.items():
+        print("{:<8} ".format(scenario) + " ".join(
+            "{:>9.1f}".format(r["timings"].get(step, 0) * 1000.0) for step in steps))
+
+
+def CompareToBaseline(results, baseline):
+    # type: (Dict[str, Dict[str, Any]], Dict[str, Any]) -> None
+    """
+    Print how the wall time, the packer steps and peak RSS moved
+    since the baseline, for the scenarios both runs have
+    """
+
+    def Change(new, old):
+        # type: (Optional[float], Optional[float]) -> str
+        if new is None or old is None or old == 0:
+            return "-"
+        return "{:+.1f}%".format((new - old) * 100.0 / old)
+
+    print("\nChange since the baseline ({}):".format(baseline.get("packer_args") or "no packer args"))
+    for scenario, r in results.items():
+        old = baseline.get("scenarios", {}).get(scenario)
+        if old is None:
+            print("  {:<8} not in the baseline".format(scenario))
+            continue
+        if old["input_bytes"] != r["input_bytes"]:
+            print("  {:<8} generated with different settings, not comparable".format(scenario))
+            continue
+
+        steps = ", ".join("{} {}".format(step, Change(seconds, old["timings"].get(step)))
+                          for step, seconds in r["timings"].items() if step != "total")
+        print("  {:<8} wall {}, packer total {}, peak RSS {}, pack size {}".format(
+            scenario, Change(r["wall_seconds"], old["wall_seconds"]),
+            Change(r["timings"]["total"], old["timings"].get("total")),
+            Change(r["peak_rss"], old["peak_rss"]), Change(r["pack_size"], old["pack_size"])))
+        print("  {:<8} {}".format("", steps))
+
+
+def main():
+
+    print("\n")
+    print("8BM VMUPro packer benchmark")
+    print("\n")
+
+    parser = argparse.ArgumentParser(
+        description="Time the packer and measure its memory use on generated projects")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, required=False,
+                        default=["pngs", "wavs", "tree", "lua"],
+                        help="Which projects to generate and pack")
+    parser.add_argument("--pngs", type=int, required=False, default=500,
+                        help="Number of PNG sprites")
+    parser.add_argument("--png-size", type=int, required=False, default=32,
+                        help="Width and height of each PNG sprite")
+    parser.add_argument("--wavs", type=int, required=False, default=3,
+                        help="Number of WAV tracks")
+    parser.add_argument("--wav-seconds", type=float, required=False, default=30.0,
+                        help="Length of each WAV track")
+    parser.add_argument("--wav-rate", type=int, required=False, default=22050,
+                        help="Sample rate of each WAV track")
+    parser.add_argument("--depth", type=int, required=False, default=6,
+                        help="Depth of the folder tree")
+    parser.add_argument("--fanout", type=int, required=False, default=3,
+                        help="Sub folders per folder in the tree")
+    parser.add_argument("--folder-files", type=int, required=False, default=4,
+                        help="Files in each folder of the tree")
+    parser.add_argument("--lua-kb", type=int, required=False, default=400,
+                        help="Size of the large Lua entry point in KB")
+    parser.add_argument("--seed", type=int, required=False, default=1,
+                        help="Seed for the generated content")
+    parser.add_argument("--repeats", type=int, required=False, default=3,
+                        help="Pack each project this many times")
+    parser.add_argument("--packer-args", required=False, default="",
+                        help="Extra packer arguments, e.g. --packer-args=\"--compress --jobs 1\"")
+    parser.add_argument("--workdir", required=False,
+                        help="Generate the projects here and keep them (default: a temporary folder)")
+    parser.add_argument("--json", required=False,
+                        help="Write the results to this JSON file")
+    parser.add_argument("--baseline", required=False,
+                        help="Compare against the results of an earlier --json run")
+
+    args = parser.parse_args()
+
+    if args.repeats < 1:
+        print("--repeats must be 1 or more")
+        sys.exit(1)
+
+    baseline = None
+    if args.baseline:
+        try:
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+        except Exception as e:
+            print("Failed to read {}: {}".format(args.baseline, e))
+            sys.exit(1)
+
+    if args.workdir:
+        absWorkDir = Path(args.workdir).resolve()
+        os.makedirs(absWorkDir, exist_ok=True)
+    else:
+        absWorkDir = Path(tempfile.mkdtemp(prefix="packbench_"))
+
+    try:
+        results = {}
+        for scenario in args.scenarios:
+            results[scenario] = BenchScenario(absWorkDir, scenario, args)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(absWorkDir, ignore_errors=True)
+
+    PrintResults(results)
+
+    if baseline is not None:
+        CompareToBaseline(results, baseline)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "version": BENCH_VERSION,
+                "machine": {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "cpus": os.cpu_count(),
+                },
+                "packer_args": args.packer_args,
+                "settings": {key: getattr(args, key) for key in (
+                    "pngs", "png_size", "wavs", "wav_seconds", "wav_rate", "depth",
+                    "fanout", "folder_files", "lua_kb", "seed", "repeats")},
+                "scenarios": results,
+            }, f, indent=4)
+        print("\nWrote {}".format(args.json))
+
+
+if __name__ == "__main__":
+    main()
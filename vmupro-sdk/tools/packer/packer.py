@@ -4,12 +4,38 @@
 
 import sys
 import argparse
+import copy
 import os
 import json
 import struct
-from typing import Any, Dict, List, Tuple
+import hashlib
+import shutil
+import atexit
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple, Union
 from PIL import Image
 from pathlib import Path
+from buildcache import (LoadBuildCache, SaveBuildCache, FileStamp, HashBytes,
+                        LookupResource, RecordResource, GetPreviousResourceOffset,
+                        LoadCachedIcon, StoreCachedIcon, CanPatchPreviousPack,
+                        RecordPack, GetObjectsDir, PruneObjects, CACHE_DIR_NAME)
+from imagecodec import encode_rgb565
+from compression import (LoadCompressionPolicy, GetCompressionStage,
+                         CompressionPolicyError)
+from spriteconvert import LoadSpritePolicy, GetSpriteStage, SpritePolicyError
+from quantize import (LoadIndexedPolicy, GetIndexedStage, BuildSharedPalettes,
+                      IndexedPolicyError)
+from mipmap import LoadMipmapPolicy, GetMipmapStage, MipmapPolicyError
+from alignment import (LoadAlignmentPolicy, GetResourceAlignment, GetAlignedOffset,
+                       AlignmentPolicyError)
+from directory import BuildDirectory, GetMaxProbes
+from luaminify import LoadLuaPolicy, GetLuaStage, LuaPolicyError
+from audioconvert import LoadAudioPolicy, GetAudioStage, AudioPolicyError
+from audiostream import LoadStreamPolicy, GetStreamStage, StreamPolicyError
+from watch import TakeSnapshot, WaitForChanges
 
 
 # Rough outline for LUA apps
@@ -17,31 +43,15 @@ from pathlib import Path
 # - parse the json metadata (name, author, icon trans)
 # - load and encode the icon
 # - package everything into .vmupack format
+#
+# The packer can also be used as a library, see VmuPackBuilder
 
-# save the raw binary for each section to a file
-# (set via args)
-debugOutput = False
+# Files are copied into the pack this many bytes at a time
+COPY_CHUNK_SIZE = 1024 * 1024
 
-# Icon section
-sect_icon = bytearray()
-
-# Metadata section
-outMetaJSON = {}
-sect_outMeta = bytearray()
-
-# Resources (all combined)
-sect_allResources = bytearray()
-
-# Individual resource info
-# (names and offsets within the master resources data blob)
-resourceNameOffsetKeyVals = []
-
-# Device binding
-sect_binding = bytearray()
-
-sect_header = bytearray()
-
-finalBinary = bytearray()
+# The timed steps of a build, in the order they run
+# (the resources are read and laid out while the metadata is parsed)
+BUILD_STEPS = ("validate", "cache", "metadata", "resources", "layout", "icon", "header", "write")
 
 
 class MetadataError(Exception):
@@ -52,11 +62,17 @@ class PathException(Exception):
     pass
 
 
+# A build that couldn't be completed, details have already been printed
+class PackerError(Exception):
+    pass
+
+
 def ReadSDKVersion():
     # type: () -> Tuple[int, int, int]
     """
     Read the SDK version from the VERSION file in the SDK root directory.
     Returns a tuple of (major, minor, patch) as integers.
+    Raises PackerError if it's missing or malformed.
     """
     # Get the path to the SDK root (two levels up from packer.py location)
     scriptDir = Path(__file__).resolve().parent
@@ -66,8 +82,7 @@ def ReadSDKVersion():
     print("Reading SDK version from: {}".format(versionFile))
 
     if not os.path.isfile(versionFile):
-        print("ERROR: VERSION file not found at {}".format(versionFile))
-        sys.exit(1)
+        raise PackerError("VERSION file not found at {}".format(versionFile))
 
     try:
         with open(versionFile, "r") as f:
@@ -77,8 +92,7 @@ def ReadSDKVersion():
             # Parse version string (e.g., "1.0.5" -> (1, 0, 5))
             parts = versionStr.split(".")
             if len(parts) != 3:
-                print("ERROR: Invalid version format in VERSION file. Expected x.x.x format")
-                sys.exit(1)
+                raise PackerError("Invalid version format in VERSION file. Expected x.x.x format")
 
             major = int(parts[0])
             minor = int(parts[1])
@@ -86,20 +100,18 @@ def ReadSDKVersion():
 
             # Validate ranges (each component should fit in a byte)
             if major < 0 or major > 255 or minor < 0 or minor > 255 or patch < 0 or patch > 255:
-                print("ERROR: Version components must be in range 0-255")
-                sys.exit(1)
+                raise PackerError("Version components must be in range 0-255")
 
             return (major, minor, patch)
 
+    except PackerError:
+        raise
     except Exception as e:
-        print("ERROR: Failed to read VERSION file: {}".format(e))
-        sys.exit(1)
+        raise PackerError("Failed to read VERSION file: {}".format(e))
 
 
 def main():
 
-    global debugOutput
-
     print("\n")
     print("8BM VMUPro LUA Packer")
     print("Run py packer_lua.py -h for help or a full list of supported arguments")
@@ -112,7 +124,11 @@ def main():
     #
     # Read SDK version from VERSION file
     #
-    sdkVersion = ReadSDKVersion()
+    try:
+        sdkVersion = ReadSDKVersion()
+    except PackerError as e:
+        print("ERROR: {}".format(e))
+        sys.exit(1)
     print("SDK version loaded: {}.{}.{}\n".format(sdkVersion[0], sdkVersion[1], sdkVersion[2]))
 
     #
@@ -125,515 +141,2289 @@ def main():
                         help="Root folder containing your LUA app")
     parser.add_argument("--appname", required=True,
                         help="Application name for output file, e.g. 'hello_world' for 'hello_world.vmupack'")
-    parser.add_argument("--meta", required=True,
-                        help="Relative path .JSON metadata for your package: metadata.json from projectdir")
+    parser.add_argument("--meta", required=True, nargs="+",
+                        help="Relative path .JSON metadata for your package: metadata.json from projectdir. "
+                             "Several build one pack per file, e.g. metadata_level1.json -> <appname>_level1.vmupack")
     parser.add_argument("--icon", required=True,
                         help="Relative path to a 76x76 BMP icon from projectdir")
     parser.add_argument("--debug", required=False,
                         help="true = Save the raw binary for each section to a file in the 'debug' folder")
+    parser.add_argument("--incremental", action="store_true", required=False, default=False,
+                        help="Reuse unchanged resources and the encoded icon from the previous build (cached in vmupacker_cache)")
+    parser.add_argument("--jobs", type=int, required=False, default=None,
+                        help="Number of threads reading resources, 1 = serial (default: based on CPU count)")
+    parser.add_argument("--no-dedupe", action="store_true", required=False, default=False,
+                        help="Store every resource separately, even if its content is identical to another")
+    parser.add_argument("--compress", action="store_true", required=False, default=False,
+                        help="Compress resources per the metadata's build.compression policy, or the default policy if there isn't one")
+    parser.add_argument("--native-sprites", action="store_true", required=False, default=False,
+                        help="Convert PNG resources to native RGB565 sprites per the metadata's build.sprites policy, or all of them if there isn't one")
+    parser.add_argument("--indexed", required=False, default=None, choices=["4bpp", "8bpp"],
+                        help="Quantize PNG and BMP resources to palette images per the metadata's build.indexed policy, or all of them at this depth if there isn't one")
+    parser.add_argument("--load-trace", required=False, default=None,
+                        help="Relative path from projectdir to a recorded load order (one resource path per line) to lay the resources out in")
+    parser.add_argument("--tight-packing", action="store_true", required=False, default=False,
+                        help="Pack small resources into shared sectors per the metadata's build.alignment policy, or the default policy if there isn't one")
+    parser.add_argument("--minify-lua", action="store_true", required=False, default=False,
+                        help="Strip comments and whitespace from Lua scripts per the metadata's build.lua policy, or all of them if there isn't one")
+    parser.add_argument("--adpcm", action="store_true", required=False, default=False,
+                        help="Resample PCM WAV resources and encode them as IMA ADPCM per the metadata's build.audio policy, or the default policy if there isn't one")
+    parser.add_argument("--stream-music", action="store_true", required=False, default=False,
+                        help="Lay long WAV tracks out in sector aligned, independently decodable chunks per the metadata's build.streaming policy, or the default policy if there isn't one")
+    parser.add_argument("--directory", action="store_true", required=False, default=False,
+                        help="Also write a binary hash table of the resources for fast lookup on the device")
+    parser.add_argument("--compact-meta", action="store_true", required=False, default=False,
+                        help="Write the metadata JSON without indentation or spaces")
+    parser.add_argument("--quiet", action="store_true", required=False, default=False,
+                        help="Don't print the details of every resource file, only totals and errors")
+    parser.add_argument("--stats", required=False, default=None,
+                        help="Write build statistics (step timings, section sizes, padding, resource counts) to this JSON file")
+    parser.add_argument("--watch", action="store_true", required=False, default=False,
+                        help="Keep running and repack whenever the metadata, icon or a resource changes (implies --incremental)")
+    parser.add_argument("--send", action="store_true", required=False, default=False,
+                        help="Upload the pack to the VMUPro over serial after each build, keeping the port open between uploads (needs pyserial)")
+    parser.add_argument("--remotefile", required=False, default=None,
+                        help="Path on the VMUPro SD card for --send (default: apps/<appname>.vmupack)")
+    parser.add_argument("--comport", required=False, default=None,
+                        help="Serial port for --send, e.g. COM18, /dev/ttyxxx (default: the one saved in comport.txt)")
+    parser.add_argument("--exec", action="store_true", required=False, default=False,
+                        help="Run the app on the VMUPro after each --send")
 
     args = parser.parse_args()
 
-    if args.debug:
-        debugOutput = True
+    if len(args.meta) > 1 and (args.watch or args.send):
+        print("--watch and --send take a single --meta")
+        sys.exit(1)
 
-    #
-    # Validate paths
-    #
+    options = VmuPackOptions(args.projectdir, args.appname, args.meta[0], args.icon)
+    options.sdkVersion = sdkVersion
+    options.debugOutput = bool(args.debug)
+    options.incremental = args.incremental
+    options.jobs = args.jobs
+    options.dedupe = not args.no_dedupe
+    options.compress = args.compress
+    options.nativeSprites = args.native_sprites
+    options.indexed = args.indexed
+    options.loadTrace = args.load_trace
+    options.tightPacking = args.tight_packing
+    options.minifyLua = args.minify_lua
+    options.adpcm = args.adpcm
+    options.streamMusic = args.stream_music
+    options.directory = args.directory
+    options.compactMetadata = args.compact_meta
+    options.quiet = args.quiet
+
+    # only changed resources are re-read between watched builds
+    if args.watch:
+        options.incremental = True
+
+    if len(args.meta) > 1:
+        variantOptions = []
+        for metaPath in args.meta:
+            variant = copy.copy(options)
+            variant.metaPath = metaPath
+            variant.appName = GetVariantAppName(args.appname, metaPath)
+            variantOptions.append(variant)
 
-    print("Validating paths...")
+        try:
+            results = BuildVariants(variantOptions)
+        except PackerError as e:
+            print(e)
+            sys.exit(1)
 
-    projectDir = args.projectdir
-    if not os.path.isdir(projectDir):
-        print("  projectdir doesn't appear to exist at {}".format(projectDir))
-        sys.exit(1)
-    projectDir = Path(projectDir)
+        if args.stats:
+            WriteStats(args.stats, {"variants": [result.stats for result in results]})
 
-    absProjectDir = projectDir.resolve()
-    if not os.path.isdir(absProjectDir):
-        print("  Can't confirm absolute path to base dir {}".format(absProjectDir))
-        sys.exit(1)
+        print("\nExiting with code 0 (success!)\n")
+        sys.exit(0)
 
-    appName = args.appname
+    builder = VmuPackBuilder(options)
 
-    try:
-        absMetaPath = ValidatePath(absProjectDir, args.meta)
-        print("  Using abs metadata path: {}".format(absMetaPath))
+    upload = None
+    pollDevice = None
+    if args.send:
+        try:
+            upload, pollDevice = OpenUploader(args)
+        except PackerError as e:
+            print(e)
+            sys.exit(1)
 
-        absIconPath = ValidatePath(absProjectDir, args.icon)
-        print("  Using abs icon path: {}".format(absIconPath))
+    if args.watch:
+        WatchProject(builder, upload, pollDevice)
+        sys.exit(0)
 
-    except Exception as e:
-        print("  Exception: {}".format(e))
-        print("  Failed to combine paths, see above errors")
+    try:
+        result = builder.Build()
+    except PackerError as e:
+        print(e)
         sys.exit(1)
 
-    #
-    # Read and validate the metadata.json
-    #
+    if args.stats:
+        WriteStats(args.stats, result.stats)
 
-    res = ParseMetadata(absMetaPath, absProjectDir)
-    if not res:
-        print("Failed to prepare the metadata, see previous errors")
-        sys.exit(1)
+    if upload is not None and not upload(result):
+        sys.exit(2)
 
-    # Verify this is a LUA application
-    if outMetaJSON.get("app_mode", 0) != 1:
-        print("Error: This packer is for LUA applications only (app_mode must be 1)")
-        sys.exit(1)
+    print("\nExiting with code 0 (success!)\n")
+    sys.exit(0)
 
-    #
-    # Read or create the icon
-    #
 
-    res = AddIcon(absProjectDir, absIconPath, outMetaJSON["icon_transparency"])
-    if not res:
-        print("Failed to prepare the icon, see previous errors")
-        sys.exit(1)
+def WriteStats(path, stats):
+    # type: (str, Dict[str, Any]) -> None
 
-    #
-    # Add device-specific bindings (stub)
-    #
-    res = AddBinding()
-    if not res:
-        print("Failed to add device bindings, see previous errors")
+    try:
+        with open(path, "w") as f:
+            json.dump(stats, f, indent=2)
+            f.write("\n")
+    except Exception as e:
+        print("Failed to write build statistics to {}: {}".format(path, e))
         sys.exit(1)
 
-    res = CreateHeader(absProjectDir, appName, sdkVersion)
-    if not res:
-        print("Failed to create header, see previous errors")
-        sys.exit(1)
+    print("Wrote build statistics to {}".format(path))
 
-    print("\nExiting with code 0 (success!)\n")
-    sys.exit(0)
 
+def GetVariantAppName(appName, metaPath):
+    # type: (str, str) -> str
+    """
+    Output name for one of several metadata files:
+    metadata.json -> appName, metadata_level1.json -> appName_level1
+    """
 
-def GetOutputFilenameAbs(absProjectDir, appName):
-    # type: (str,str)->Path
-    absOutputVMUPack = os.path.join(
-        absProjectDir, appName + ".vmupack")
-    absOutputVMUPack = Path(absOutputVMUPack).resolve()
-    return absOutputVMUPack
+    stem = Path(metaPath).stem
+    if stem.startswith("metadata"):
+        stem = stem[len("metadata"):].lstrip("_-.")
 
+    return "{}_{}".format(appName, stem) if stem else appName
 
-def ValidatePath(base, tail):
-    # type: (Union[str, Path], Union[str, Path]) -> str
 
-    joined = base / tail
-    resolved = Path.resolve(joined)
+def BuildVariants(variantOptions):
+    # type: (List[VmuPackOptions]) -> List[VmuPackResult]
+    """
+    Build several packs of the same project, e.g. one per level, one after
+    the other. Resources (and the icon) used by more than one of them are
+    only read, hashed and transformed for the first.
+    """
 
-    print("  Validating path: {}".format(resolved))
+    names = {}
+    for options in variantOptions:
+        if options.appName in names:
+            raise PackerError("{} and {} would both be written to {}.vmupack".format(
+                names[options.appName], options.metaPath, options.appName))
+        names[options.appName] = options.metaPath
 
-    if not os.path.isfile(resolved):
-        raise PathException(
-            "projectdir ({}) + tail ({}) didn't form a valid absolute path!".format(base, tail))
+    sharedInputs = NewSharedInputs()
+    results = []
+    numEntries = 0
 
-    return str(joined)
+    for options in variantOptions:
+        print("\nBuilding variant {} from {}\n".format(options.appName, options.metaPath))
+        builder = VmuPackBuilder(options, sharedInputs)
+        results.append(builder.Build())
+        numEntries += len(builder.resourceNameOffsetKeyVals)
 
+    print("\nVariant sizes:")
+    for options, result in zip(variantOptions, results):
+        print("  {:<24} {:>12,} bytes, resources {:>12,} bytes, {:.2f}s  ({})".format(
+            options.appName + ".vmupack", result.size, result.sections["resources"][1],
+            result.timings["total"], options.metaPath))
+    print("  {} resource files read for {} resources across {} packs".format(
+        len(sharedInputs["resources"]), numEntries, len(results)))
+
+    return results
 
-def DeleteFileNoError(absPath, label):
-    # type: (Path, str)->None
+
+def OpenUploader(args):
+    # type: (argparse.Namespace) -> Tuple[Callable[[VmuPackResult], bool], Callable[[], None]]
+    """
+    Open the serial port for --send once, as send.py would.
+    Returns a function that uploads a build result over it and
+    one that prints whatever the VMUPro has written to its console.
+    """
 
     try:
-        print("  Checking '{}' ...".format(absPath))
-        if os.path.isfile(absPath):
-            os.remove(absPath)
-        print("  deleted...")
+        import send
+    except ImportError as e:
+        raise PackerError("--send needs pyserial (pip install pyserial): {}".format(e))
+
+    comPort = send.CheckComPort(args)
+    remoteFile = args.remotefile or "apps/{}.vmupack".format(args.appname)
 
+    try:
+        send.OpenUploadPort(comPort)
     except Exception as e:
-        print("  Couldn't remove {} (non fatal error)".format(label))
-        print("  Exception: {}".format(e))
+        print("Error initing the serial port: {}".format(e))
+        raise PackerError("Hint: is the ESP IDF or another console using the COM port?")
 
+    # sha1 of the last pack uploaded, an unchanged pack isn't sent again
+    lastSent = [None]
 
-def PrepDebugDir(absProjectDir, fileName):
-    # type (str, str)->str
+    def Upload(result):
+        # type: (VmuPackResult) -> bool
 
-    absDebugDir = os.path.join(absProjectDir, "vmupacker_debug")
-    if not os.path.isdir(absDebugDir):
-        os.makedirs(absDebugDir)
-    absFilePath = os.path.join(absDebugDir, fileName)
-    return absFilePath
+        packBytes = result.ReadBytes()
+        packSha1 = HashBytes(packBytes)
+        if packSha1 == lastSent[0]:
+            print("Pack unchanged since the last upload, not sending")
+            return True
 
+        print("Uploading {} to {} on {}".format(result.path, remoteFile, comPort))
+        try:
+            if not send.UploadBytes(packBytes, remoteFile, args.exec):
+                return False
+        except Exception as e:
+            print("Upload failed: {}".format(e))
+            return False
 
-def AddIcon(absProjectDir, absIconPath, transparentBit):
-    # type: (str, str, bool)->bool
+        lastSent[0] = packSha1
+        return True
+
+    return Upload, send.Monitor2Way
+
+
+def WatchProject(builder, upload, pollDevice):
+    # type: (VmuPackBuilder, Optional[Callable[[VmuPackResult], bool]], Optional[Callable[[], None]]) -> None
+    """
+    Build, then rebuild (and upload) whenever one of the files the last
+    build read changes, until Ctrl+C. A failed build is reported and
+    the next change is waited for as usual.
+    """
 
-    global sect_icon
+    options = builder.options
+    absProjectDir = Path(options.projectDir).resolve()
+    absOutPath = GetOutputFilenameAbs(absProjectDir, options.appName)
 
-    print("  Loading icon")
-    print("    Path: {}".format(absIconPath))
+    # the packer's own output, in case the whole project folder is a resource
+    ignore = {absOutPath, Path(str(absOutPath) + ".tmp"),
+              absProjectDir / CACHE_DIR_NAME, absProjectDir / "vmupacker_debug"}
 
-    if not os.path.isfile(absIconPath):
-        print("Failed to load icon at path {}".format(absIconPath))
-        return False
+    # the metadata and icon are watched even if the first build can't read them
+    watched = {(absProjectDir / options.metaPath).resolve(),
+               (absProjectDir / options.iconPath).resolve()}
 
     try:
+        while True:
+            # anything that changes during the build triggers the next one
+            snapshot = TakeSnapshot(watched, ignore)
+
+            try:
+                result = builder.Build()
+                print("Packed {} ({:,} bytes) in {:.2f}s".format(
+                    result.path, result.size, result.timings["total"]))
+                if upload is not None and not upload(result):
+                    print("Upload failed, it will be retried after the next change")
+            except PackerError as e:
+                print(e)
+                print("Build failed, fix the above and save to try again")
+            except Exception as e:
+                print("Build failed: {}".format(e))
+
+            newPaths = set(builder.inputPaths) - watched
+            watched |= newPaths
+            snapshot.update(TakeSnapshot(newPaths, ignore))
+
+            print("\nWatching {} files for changes, Ctrl+C to stop\n".format(len(snapshot)))
+            changed, _ = WaitForChanges(watched, ignore, snapshot, pollDevice)
+
+            for path in changed[:10]:
+                print("  Changed: {}".format(path))
+            if len(changed) > 10:
+                print("  ... and {} more".format(len(changed) - 10))
+
+    except KeyboardInterrupt:
+        print("\nStopped watching")
+
+
+class VmuPackOptions:
+    """
+    Everything the command line would pass in for one build.
+    The paths other than projectDir are relative to projectDir.
+    """
 
-        im = Image.open(absIconPath)
-        pix = im.load()
+    def __init__(self, projectDir, appName, metaPath, iconPath):
+        # type: (Union[str, Path], str, str, str) -> None
 
-        width = im.size[0]
-        height = im.size[1]
-        dummy = 0
+        self.projectDir = projectDir
+        # output file name without .vmupack
+        self.appName = appName
+        self.metaPath = metaPath
+        self.iconPath = iconPath
 
-        if (width != 76 or height != 76):
-            print("Error, expecting a 76x76px icon")
-            return False
+        # (major, minor, patch), None = read the SDK's VERSION file
+        self.sdkVersion = None  # type: Optional[Tuple[int, int, int]]
 
-        # add width, height, trans bit and a dummy field
-        sect_icon.extend(b'ICON')
-        sect_icon.extend(dummy.to_bytes(4, byteorder='little'))
-        sect_icon.extend(dummy.to_bytes(4, byteorder='little'))
-        sect_icon.extend(dummy.to_bytes(4, byteorder='little'))
-        sect_icon.extend(width.to_bytes(4, byteorder='little'))
-        sect_icon.extend(height.to_bytes(4, byteorder='little'))
-        sect_icon.extend(transparentBit.to_bytes(4, byteorder='little'))
-        sect_icon.extend(dummy.to_bytes(4, byteorder='little'))
+        # save the raw binary for each section to a file
+        self.debugOutput = False
 
-        for row in range(height):
-            for col in range(width):
+        # reuse unchanged resources and the encoded icon
+        # from the previous build (cached in vmupacker_cache)
+        self.incremental = False
 
-                x = col
-                y = row
+        # number of threads used to read and hash resources,
+        # None lets the thread pool decide
+        self.jobs = None  # type: Optional[int]
 
-                if y < height:
-                    rgb = pix[x, y]
-                else:
-                    rgb = (0, 0, 0)
+        # store byte-identical resources once
+        self.dedupe = True
 
-                # Convert the RGB value into a 16 bit 565 value
-                red = (rgb[0] >> 3) & 0x1F  # 5 bits for red
-                green = (rgb[1] >> 2) & 0x3F  # 6 bits for green
-                blue = (rgb[2] >> 3) & 0x1F  # 5 bits for blue
+        # use the default policy for each of these if the
+        # metadata's "build" section doesn't have one
+        self.compress = False
+        self.nativeSprites = False
+        self.indexed = None  # type: Optional[str]
+        self.tightPacking = False
+        self.minifyLua = False
+        self.adpcm = False
+        self.streamMusic = False
 
-                # Pack the RGB 565 into 16 bits
-                pixVal = (red << 11) | (green << 5) | blue
+        # recorded load order to lay the resources out in,
+        # None = the metadata's build.load_trace or metadata order
+        self.loadTrace = None  # type: Optional[str]
 
-                # Append the high and low bytes of the 16-bit value
-                sect_icon.append((pixVal >> 8) & 0xFF)
-                sect_icon.append(pixVal & 0xFF)
+        # write the binary resource directory section, and the
+        # metadata JSON without indentation
+        self.directory = False
+        self.compactMetadata = False
 
-    except Exception as e:
-        print("Error {}".format(e))
-        return False
+        # only print totals and errors, not the details of every resource
+        self.quiet = False
 
-    sect_iconSize = len(sect_icon)
 
-    print("    Encoded icon from {}".format(absIconPath))
-    print(
-        "    Size: {:,} / {} bytes".format(sect_iconSize, hex(sect_iconSize)))
+def NewSharedInputs():
+    # type: () -> Dict[str, Any]
+    """
+    What builders in the same process can share with each other:
+    ingested resources by (absolute path, stamp, transform key)
+    and encoded icons by (absolute path, stamp, transparency)
+    """
 
-    if debugOutput:
-        absFilePath = PrepDebugDir(absProjectDir, "icon.bin")
-        with open(absFilePath, "wb") as f:
-            f.write(sect_icon)
-        print("    DEBUG: Wrote {}".format(absFilePath))
+    return {"resources": {}, "icons": {}}
 
-    return True
 
-# Read metadata such as the app name and author
-# we then repackage this with some extra info
-# such as the offsets of each asset into the resources blob
+class VmuPackResult:
+    """
+    What a build produced: the pack's path and size, the (offset, length)
+    of each of its sections, how long each step took, in seconds, and
+    the build statistics
+    """
 
+    def __init__(self, path, size, sections, timings, stats):
+        # type: (Path, int, Dict[str, Tuple[int, int]], Dict[str, float], Dict[str, Any]) -> None
 
-def ParseMetadata(absMetaPath, absProjectDir):
-    # type: (str, str)->bool
+        self.path = path
+        self.size = size
+        self.sections = sections
+        self.timings = timings
+        # everything --stats writes, see GetBuildStats
+        self.stats = stats
 
-    print("Loading metadata json")
-    print("  path {}".format(absMetaPath))
+    def ReadBytes(self):
+        # type: () -> bytes
 
-    if not os.path.isfile(absMetaPath):
-        print("Metadata file not found!")
-        return False
+        with open(self.path, "rb") as f:
+            return f.read()
 
-    jsonData = None
-    try:
-        with open(absMetaPath, "r") as f:
-            jsonData = json.load(f)
-    except Exception as e:
-        print("Error {}".format(e))
-        return False
 
-    res = ValidateMetadata(jsonData, absMetaPath, absProjectDir)
+class VmuPackBuilder:
+    """
+    Packs a project per its options, as many times as Build() is called.
+    The build cache (with incremental builds) and the transformed resources
+    are kept in memory / on disk between builds, so repacking from the same
+    process only redoes what changed:
+
+        options = VmuPackOptions("examples/hello_world", "hello_world", "metadata.json", "icon.bmp")
+        builder = VmuPackBuilder(options)
+        result = builder.Build()
+        print(result.path, result.sections["resources"])
+    """
 
-    if not res:
-        print("Failed to validate metadata json @ {}".format(absMetaPath))
-        return False
+    def __init__(self, options, sharedInputs=None):
+        # type: (VmuPackOptions, Optional[Dict[str, Any]]) -> None
 
-    return True
+        self.options = options
 
-# We could use jsonschema here, but due to legibility
-# and flexibility concerns, let's manually review and
-# try to throw meaningful errors, to help the user
+        # Resources and icons already read by other builders in this
+        # process (see BuildVariants), None to read everything
+        self.sharedInputs = sharedInputs
 
+        # Persistent build cache, None for a clean build
+        # and the (project dir, app name) it was loaded for
+        self.buildCache = None  # type: Optional[Dict[str, Any]]
+        self.buildCacheKey = None  # type: Optional[Tuple[Path, str]]
 
-def ValidateMetadata(inJsonData, absMetaFileName, absProjectDir):
-    # type: (Dict[str,any], str, str) -> bool
+        # Temp folder for transformed resources without a build cache,
+        # reused by later builds as its objects are named by content
+        self.tempStagingDir = None  # type: Optional[Path]
 
-    global outMetaJSON
-    global sect_outMeta
-    global debugOutput
+        self.ResetBuildState()
+
+    def ResetBuildState(self):
+        # type: () -> None
+        """
+        Everything a build produces starts over each time,
+        only the build cache and staging folder carry over
+        """
+
+        options = self.options
+
+        # save the raw binary for each section to a file
+        self.debugOutput = options.debugOutput
+
+        # Icon section
+        self.sect_icon = bytearray()
+
+        # Metadata section
+        self.outMetaJSON = {}  # type: Dict[str, Any]
+        self.sect_outMeta = bytearray()
+
+        # Binary resource directory, empty if not enabled
+        self.sect_directory = bytearray()
+
+        # Resources (all combined)
+        # Only the layout is held in memory, one block per file with its offset,
+        # size and padding; the data is streamed from disk into the output file
+        self.resourceBlocks = []  # type: List[Dict[str, Any]]
+        self.resourcesLength = 0
+
+        # Individual resource info
+        # (names and offsets within the master resources data blob)
+        self.resourceNameOffsetKeyVals = []  # type: List[Tuple[str, int]]
+
+        # Device binding
+        self.sect_binding = bytearray()
+
+        self.sect_header = bytearray()
+
+        # Offset of the resource section in the previous pack,
+        # or None if its blocks can't be reused
+        self.prevResourceOffset = None  # type: Optional[int]
+
+        # Store byte-identical resources once and point
+        # every path with that content at the same block
+        self.dedupeResources = options.dedupe
+
+        # Number of threads used to read and hash resources
+        # (None lets the thread pool decide)
+        self.ingestJobs = options.jobs
+
+        # Per-resource compression policy, None = store everything raw
+        # (set via the options or the "build" section of the metadata)
+        self.compressWithDefaults = options.compress
+        self.compressionPolicy = None  # type: Optional[Dict[str, Any]]
+
+        # PNG to native RGB565 sprite policy, None = keep sprites as PNG
+        # (set via the options or the "build" section of the metadata)
+        self.nativeSpritesWithDefaults = options.nativeSprites
+        self.spritePolicy = None  # type: Optional[Dict[str, Any]]
+
+        # Palette quantization policy, None = keep images as they are
+        # (set via the options or the "build" section of the metadata)
+        self.indexedDefaultMode = options.indexed
+        self.indexedPolicy = None  # type: Optional[Dict[str, Any]]
+        # Shared palettes by name, built from all their images before ingesting
+        self.sharedPalettes = {}  # type: Dict[str, Any]
 
-    print("  Parsing metadata from {}".format(absMetaFileName))
+        # Textures to replace with their mip chain, None = no mipmaps
+        # (set via the "build" section of the metadata)
+        self.mipmapPolicy = None  # type: Optional[Dict[str, Any]]
 
-    try:
-        metaVersion = inJsonData["metadata_version"]
-    except Exception as e:
-        print("Failed to read 'metadata_version' from {}".format(absMetaFileName))
-        return False
+        # Recorded load order to lay the resources out in, relative to the
+        # project dir, None = metadata order
+        # (set via the options or the "build" section of the metadata)
+        self.loadTraceName = options.loadTrace
 
-    if metaVersion != 1:
-        print("Unexpected metadata_version '{}', expected '1'".format(metaVersion))
-        return False
+        # Per-resource alignment, None = every resource on a 512 byte boundary
+        # (set via the options or the "build" section of the metadata)
+        self.tightPackingWithDefaults = options.tightPacking
+        self.alignmentPolicy = None  # type: Optional[Dict[str, Any]]
 
-    # version looks good, let's validate the rest
+        # Lua minification policy, None = ship scripts as written
+        # (set via the options or the "build" section of the metadata)
+        self.minifyLuaWithDefaults = options.minifyLua
+        self.luaPolicy = None  # type: Optional[Dict[str, Any]]
+
+        # WAV resampling / ADPCM policy, None = keep sounds as they are
+        # (set via the options or the "build" section of the metadata)
+        self.adpcmWithDefaults = options.adpcm
+        self.audioPolicy = None  # type: Optional[Dict[str, Any]]
+
+        # Long tracks to lay out in sector aligned chunks, None = as they are
+        # (set via the options or the "build" section of the metadata)
+        self.streamMusicWithDefaults = options.streamMusic
+        self.streamPolicy = None  # type: Optional[Dict[str, Any]]
+
+        # Write the binary resource directory section, and the
+        # metadata JSON without indentation
+        # (set via the options or the "build" section of the metadata)
+        self.writeDirectory = options.directory
+        self.compactMetadata = options.compactMetadata
+
+        # Where transformed resources are written before being streamed into
+        # the pack: the build cache's objects folder, or a temp folder
+        self.stagingDir = self.tempStagingDir
+
+        # Where the pack was written and the (offset, length) of its
+        # icon, metadata, directory, resources and binding sections
+        self.absOutPath = None  # type: Optional[Path]
+        self.finalBinarySize = 0
+        self.sectionTable = []  # type: List[Tuple[int, int]]
+
+        # Every file and folder the build read, for --watch
+        self.inputPaths = []  # type: List[Path]
+
+        # Only print totals and errors, not the details of every resource
+        self.quiet = options.quiet
+
+        # Seconds spent in each step of the build, see Build()
+        self.timings = {}  # type: Dict[str, float]
+        # Section lengths before they were padded out to a sector
+        self.unpaddedSizes = {}  # type: Dict[str, int]
+        # Per-resource read times and sizes, for the statistics
+        self.resourceStats = []  # type: List[Dict[str, Any]]
+
+    def Build(self):
+        # type: () -> VmuPackResult
+        """
+        Pack the project, replacing any previous output.
+        Raises PackerError if it can't, after printing why.
+        """
+
+        options = self.options
+        buildStart = time.perf_counter()
+
+        self.ResetBuildState()
+        timings = self.timings
+
+        if options.jobs is not None and options.jobs < 1:
+            raise PackerError("jobs must be 1 or more")
+
+        sdkVersion = options.sdkVersion
+        if sdkVersion is None:
+            sdkVersion = ReadSDKVersion()
+
+        #
+        # Validate paths
+        #
+
+        print("Validating paths...")
+
+        projectDir = options.projectDir
+        if not os.path.isdir(projectDir):
+            raise PackerError("projectdir doesn't appear to exist at {}".format(projectDir))
+        projectDir = Path(projectDir)
+
+        absProjectDir = projectDir.resolve()
+        if not os.path.isdir(absProjectDir):
+            raise PackerError("Can't confirm absolute path to base dir {}".format(absProjectDir))
+
+        appName = options.appName
 
-    def readStr(key, minLength):
-        # type: (str, int) -> str
         try:
-            print("  Reading '{}'".format(key))
-            val = inJsonData[key]
-            if (len(val) < minLength or len(val) > 255):
-                raise MetadataError(
-                    "Expected key '{}' between 1 and 255 chars")
+            absMetaPath = ValidatePath(absProjectDir, options.metaPath)
+            print("  Using abs metadata path: {}".format(absMetaPath))
+
+            absIconPath = ValidatePath(absProjectDir, options.iconPath)
+            print("  Using abs icon path: {}".format(absIconPath))
+
+            if options.loadTrace:
+                ValidatePath(absProjectDir, options.loadTrace)
 
         except Exception as e:
-            raise MetadataError(
-                "Failed to parse key string '{}' from {}".format(key, absMetaFileName))
+            print("  Exception: {}".format(e))
+            raise PackerError("Failed to combine paths, see above errors")
 
-        outMetaJSON[key] = val
-        print("    {} = {}".format(key, val))
-        return val
+        self.inputPaths.append(Path(absMetaPath).resolve())
+        self.inputPaths.append(Path(absIconPath).resolve())
+
+        timings["validate"] = time.perf_counter() - buildStart
+        stepStart = time.perf_counter()
+
+        #
+        # Load the build cache from the previous run,
+        # or keep the one from the previous Build()
+        #
+
+        if not options.incremental:
+            self.buildCache = None
+            self.buildCacheKey = None
+        else:
+            if self.buildCache is None or self.buildCacheKey != (absProjectDir, appName):
+                print("Loading build cache...")
+                self.buildCache = LoadBuildCache(absProjectDir, appName)
+                self.buildCacheKey = (absProjectDir, appName)
+            self.prevResourceOffset = GetPreviousResourceOffset(
+                self.buildCache, GetOutputFilenameAbs(absProjectDir, appName))
+            self.stagingDir = GetObjectsDir(absProjectDir, appName)
+
+        timings["cache"] = time.perf_counter() - stepStart
 
-    def readBool(key):
-        # type: (str) -> bool
         try:
-            print("  Reading '{}'".format(key))
-            val = inJsonData[key]
+            stepStart = time.perf_counter()
+
+            #
+            # Read and validate the metadata.json
+            #
+
+            res = self.ParseMetadata(absMetaPath, absProjectDir)
+            if not res:
+                raise PackerError("Failed to prepare the metadata, see previous errors")
+
+            # Verify this is a LUA application
+            if self.outMetaJSON.get("app_mode", 0) != 1:
+                raise PackerError("Error: This packer is for LUA applications only (app_mode must be 1)")
+
+            # reading the resources and laying them out are timed on their own
+            timings["metadata"] = (time.perf_counter() - stepStart
+                                   - timings.get("resources", 0) - timings.get("layout", 0))
+            stepStart = time.perf_counter()
+
+            #
+            # Read or create the icon
+            #
+
+            res = self.AddIcon(absProjectDir, appName, absIconPath, self.outMetaJSON["icon_transparency"])
+            if not res:
+                raise PackerError("Failed to prepare the icon, see previous errors")
+
+            #
+            # Add device-specific bindings (stub)
+            #
+            res = self.AddBinding()
+            if not res:
+                raise PackerError("Failed to add device bindings, see previous errors")
+
+            timings["icon"] = time.perf_counter() - stepStart
+            stepStart = time.perf_counter()
+
+            res = self.CreateHeader(absProjectDir, appName, sdkVersion)
+            if not res:
+                raise PackerError("Failed to create header, see previous errors")
+
+            # the write is timed on its own
+            timings["header"] = time.perf_counter() - stepStart - timings.get("write", 0)
+
+        except Exception:
+            # the in-memory cache may be half updated, reload it next time
+            self.buildCache = None
+            self.buildCacheKey = None
+            raise
+
+        timings["total"] = time.perf_counter() - buildStart
+
+        sections = {"header": (0, len(self.sect_header))}
+        for name, section in zip(("icon", "metadata", "directory", "resources", "binding"),
+                                 self.sectionTable):
+            sections[name] = section
+
+        return VmuPackResult(self.absOutPath, self.finalBinarySize, sections, timings,
+                             self.GetBuildStats(sections))
+
+    def GetBuildStats(self, sections):
+        # type: (Dict[str, Tuple[int, int]]) -> Dict[str, Any]
+        """
+        Machine-readable summary of the finished build, for --stats:
+        step timings, section sizes and padding, resource counts
+        and how long each resource took to read
+        """
+
+        resourceIndex = self.outMetaJSON.get("resource_index") or []
+        owned = [e for e in resourceIndex if "alias_of" not in e]
+        storedBytes = sum(e["size"] for e in owned)
+
+        sectionStats = {}
+        for name, (offset, length) in sections.items():
+            used = storedBytes if name == "resources" else self.unpaddedSizes.get(name, length)
+            sectionStats[name] = {"offset": offset, "length": length, "padding": length - used}
+
+        return {
+            "app_name": self.options.appName,
+            "metadata": self.options.metaPath,
+            "pack": str(self.absOutPath),
+            "pack_size": self.finalBinarySize,
+            "timings": {name: round(self.timings.get(name, 0), 4) for name in BUILD_STEPS + ("total",)},
+            "sections": sectionStats,
+            "padding_bytes": sum(s["padding"] for s in sectionStats.values()),
+            "resources": {
+                "count": len(resourceIndex),
+                "stored": len(owned),
+                "aliases": len(resourceIndex) - len(owned),
+                "compressed": sum(1 for e in resourceIndex if "codec" in e),
+                "converted": sum(1 for e in resourceIndex if "format" in e),
+                "cached": sum(1 for r in self.resourceStats if r["cached"]),
+                "source_bytes": sum(r["size"] for r in self.resourceStats),
+                "stored_bytes": storedBytes,
+                "padding_bytes": sum(e["padded_size"] - e["size"] for e in owned),
+            },
+            "files": self.resourceStats,
+        }
+
+    def AddIcon(self, absProjectDir, appName, absIconPath, transparentBit):
+        # type: (str, str, str, bool)->bool
+
+        print("  Loading icon")
+        print("    Path: {}".format(absIconPath))
+
+        if not os.path.isfile(absIconPath):
+            print("Failed to load icon at path {}".format(absIconPath))
+            return False
+
+        cachedIcon = None
+        if self.buildCache is not None:
+            cachedIcon = LoadCachedIcon(
+                self.buildCache, absProjectDir, appName, absIconPath, transparentBit)
+
+        sharedIcon = None
+        if self.sharedInputs is not None:
+            iconKey = (str(Path(absIconPath).resolve()), FileStamp(absIconPath), transparentBit)
+            sharedIcon = self.sharedInputs["icons"].get(iconKey)
+
+        if cachedIcon is not None:
+            print("    Reusing encoded icon from build cache")
+            self.sect_icon.extend(cachedIcon)
+        else:
+            if sharedIcon is not None:
+                print("    Reusing icon encoded for a previous variant")
+                self.sect_icon.extend(sharedIcon)
+            elif not self.EncodeIcon(absIconPath, transparentBit):
+                return False
+            if self.buildCache is not None:
+                StoreCachedIcon(self.buildCache, absProjectDir, appName,
+                                absIconPath, transparentBit, self.sect_icon)
+
+        if self.sharedInputs is not None:
+            self.sharedInputs["icons"][iconKey] = bytes(self.sect_icon)
+
+        sect_iconSize = len(self.sect_icon)
+
+        print("    Encoded icon from {}".format(absIconPath))
+        print(
+            "    Size: {:,} / {} bytes".format(sect_iconSize, hex(sect_iconSize)))
+
+        if self.debugOutput:
+            absFilePath = PrepDebugDir(absProjectDir, "icon.bin")
+            with open(absFilePath, "wb") as f:
+                f.write(self.sect_icon)
+            print("    DEBUG: Wrote {}".format(absFilePath))
+
+        return True
+
+    def EncodeIcon(self, absIconPath, transparentBit):
+        # type: (str, bool)->bool
+
+        try:
+
+            im = Image.open(absIconPath)
+
+            width = im.size[0]
+            height = im.size[1]
+            dummy = 0
+
+            if (width != 76 or height != 76):
+                print("Error, expecting a 76x76px icon")
+                return False
+
+            # add width, height, trans bit and a dummy field
+            self.sect_icon.extend(b'ICON')
+            self.sect_icon.extend(dummy.to_bytes(4, byteorder='little'))
+            self.sect_icon.extend(dummy.to_bytes(4, byteorder='little'))
+            self.sect_icon.extend(dummy.to_bytes(4, byteorder='little'))
+            self.sect_icon.extend(width.to_bytes(4, byteorder='little'))
+            self.sect_icon.extend(height.to_bytes(4, byteorder='little'))
+            self.sect_icon.extend(transparentBit.to_bytes(4, byteorder='little'))
+            self.sect_icon.extend(dummy.to_bytes(4, byteorder='little'))
+
+            # Pixel data as 16 bit big-endian RGB 565
+            self.sect_icon.extend(encode_rgb565(im))
+
         except Exception as e:
-            raise MetadataError(
-                "Failed to parse key bool '{}' from {}".format(
-                    key, absMetaFileName)
-            )
-        outMetaJSON[key] = val
-        print("    {} = {}".format(key, val))
-        return val
-
-    def readUInt32(key):
-        # type (str) -> int
+            print("Error {}".format(e))
+            return False
+
+        return True
+
+    def PrintDetail(self, text):
+        # type: (str) -> None
+        """
+        Per-resource output, which --quiet leaves out
+        """
+
+        if not self.quiet:
+            print(text)
+
+    # Read metadata such as the app name and author
+    # we then repackage this with some extra info
+    # such as the offsets of each asset into the resources blob
+
+    def ParseMetadata(self, absMetaPath, absProjectDir):
+        # type: (str, str)->bool
+
+        print("Loading metadata json")
+        print("  path {}".format(absMetaPath))
+
+        if not os.path.isfile(absMetaPath):
+            print("Metadata file not found!")
+            return False
+
+        jsonData = None
         try:
-            print("  Reading '{}'".format(key))
-            val = inJsonData[key]
-            if not isinstance(val, int):
-                raise MetadataError(
-                    "Expected key '{}' to be an int".format(key))
-            if val < 0 or val > 0xFFFFFFFF:
-                raise MetadataError(
-                    "Expected key '{}' to be an unsigned 32 bit int".format(key))
+            with open(absMetaPath, "r") as f:
+                jsonData = json.load(f)
         except Exception as e:
-            raise MetadataError(
-                "Failed to parse key uint32_t '{}' from {}".format(key, absMetaFileName))
-        outMetaJSON[key] = val
-        print("    {} = {}".format(key, val))
-        return val
+            print("Error {}".format(e))
+            return False
 
-    #
-    # Read in the main vals
-    #
+        res = self.ValidateMetadata(jsonData, absMetaPath, absProjectDir)
 
-    try:
-        app_name = readStr("app_name", 1)
-        app_author = readStr("app_author", 1)
-        app_version = readStr("app_version", 5)
-        app_entry_point = readStr("app_entry_point", 1)
-        icon_trans = readBool("icon_transparency")
-        app_mode = readUInt32("app_mode")
-        app_environment = readStr("app_environment", 3)
+        if not res:
+            print("Failed to validate metadata json @ {}".format(absMetaPath))
+            return False
 
-    except Exception as e:
-        print("Parse error: {}".format(e))
-        return False
+        return True
 
-    #
-    # Validate the version string
-    #
+    # We could use jsonschema here, but due to legibility
+    # and flexibility concerns, let's manually review and
+    # try to throw meaningful errors, to help the user
+
+    def ValidateMetadata(self, inJsonData, absMetaFileName, absProjectDir):
+        # type: (Dict[str,any], str, str) -> bool
+
+        print("  Parsing metadata from {}".format(absMetaFileName))
+
+        try:
+            metaVersion = inJsonData["metadata_version"]
+        except Exception as e:
+            print("Failed to read 'metadata_version' from {}".format(absMetaFileName))
+            return False
 
-    versionSplits = app_version.split(".")
-    if len(versionSplits) != 3:
-        return False
-    validVersion = all(split.isdigit() for split in versionSplits)
-    if not validVersion:
-        print("Expected version in the form ?.?.?")
-        return False
+        if metaVersion != 1:
+            print("Unexpected metadata_version '{}', expected '1'".format(metaVersion))
+            return False
 
-    res = ParseResources(inJsonData, absMetaFileName, absProjectDir)
-    if not res:
-        return False
+        # version looks good, let's validate the rest
 
-    jsonString = json.dumps(outMetaJSON, indent=4)
-    jsonBytes = bytearray(jsonString, "ascii")
-    sect_outMeta.extend(jsonBytes)
+        def readStr(key, minLength):
+            # type: (str, int) -> str
+            try:
+                print("  Reading '{}'".format(key))
+                val = inJsonData[key]
+                if (len(val) < minLength or len(val) > 255):
+                    raise MetadataError(
+                        "Expected key '{}' between 1 and 255 chars")
 
-    if debugOutput:
-        absFilePath = PrepDebugDir(absProjectDir, "resources.json")
-        # The accompanying json
-        with open(absFilePath, "w") as f:
-            f.write(jsonString)
-        print("    DEBUG: Wrote {}".format(absFilePath))
+            except Exception as e:
+                raise MetadataError(
+                    "Failed to parse key string '{}' from {}".format(key, absMetaFileName))
+
+            self.outMetaJSON[key] = val
+            print("    {} = {}".format(key, val))
+            return val
+
+        def readBool(key):
+            # type: (str) -> bool
+            try:
+                print("  Reading '{}'".format(key))
+                val = inJsonData[key]
+            except Exception as e:
+                raise MetadataError(
+                    "Failed to parse key bool '{}' from {}".format(
+                        key, absMetaFileName)
+                )
+            self.outMetaJSON[key] = val
+            print("    {} = {}".format(key, val))
+            return val
+
+        def readUInt32(key):
+            # type (str) -> int
+            try:
+                print("  Reading '{}'".format(key))
+                val = inJsonData[key]
+                if not isinstance(val, int):
+                    raise MetadataError(
+                        "Expected key '{}' to be an int".format(key))
+                if val < 0 or val > 0xFFFFFFFF:
+                    raise MetadataError(
+                        "Expected key '{}' to be an unsigned 32 bit int".format(key))
+            except Exception as e:
+                raise MetadataError(
+                    "Failed to parse key uint32_t '{}' from {}".format(key, absMetaFileName))
+            self.outMetaJSON[key] = val
+            print("    {} = {}".format(key, val))
+            return val
 
-    return True
+        #
+        # Read in the main vals
+        #
 
+        try:
+            app_name = readStr("app_name", 1)
+            app_author = readStr("app_author", 1)
+            app_version = readStr("app_version", 5)
+            app_entry_point = readStr("app_entry_point", 1)
+            icon_trans = readBool("icon_transparency")
+            app_mode = readUInt32("app_mode")
+            app_environment = readStr("app_environment", 3)
 
-def ParseResources(inJsonData, absMetaFileName, absProjectDir):
-    # type: (Dict[str,any], str, str) -> bool
+        except Exception as e:
+            print("Parse error: {}".format(e))
+            return False
 
-    global outMetaJSON
-    # all resources combined
-    global sect_allResources
-    # individual resources offsets
-    global resourceNameOffsetKeyVals
+        #
+        # Validate the version string
+        #
 
-    print("  Parsing metadata resources...")
+        versionSplits = app_version.split(".")
+        if len(versionSplits) != 3:
+            return False
+        validVersion = all(split.isdigit() for split in versionSplits)
+        if not validVersion:
+            print("Expected version in the form ?.?.?")
+            return False
 
-    if (inJsonData["resources"] is None):
-        print("    No resources section, skipping")
-        return True
+        res = self.ReadBuildOptions(inJsonData, absMetaFileName)
+        if not res:
+            return False
 
-    inJsonResArray = inJsonData["resources"]
-    outMetaJSON["resources"] = []
-    outMetaJSON["resource_index"] = []  # New: index of all files with metadata
-
-    allFiles = []  # Collect all files from resources (including folders)
-
-    # Process each resource entry (can be file or folder)
-    for r in inJsonResArray:
-        print("    Processing resource entry: {}".format(r))
-
-        absResPath = absProjectDir / r
-        absResPath = Path(absResPath).resolve()
-
-        if os.path.isfile(absResPath):
-            # Single file
-            allFiles.append((r, absResPath))
-            print("      Added file: {}".format(r))
-        elif os.path.isdir(absResPath):
-            # Folder - recursively scan for all files
-            print("      Scanning folder: {}".format(r))
-            folderFiles = ScanFolderRecursive(absProjectDir, r)
-            allFiles.extend(folderFiles)
-            print("      Found {} files in folder".format(len(folderFiles)))
+        res = self.ParseResources(inJsonData, absMetaFileName, absProjectDir)
+        if not res:
+            return False
+
+        if self.compactMetadata:
+            jsonString = json.dumps(self.outMetaJSON, separators=(",", ":"))
         else:
-            print("      ERROR: Resource {} is neither file nor folder at {}".format(r, absResPath))
+            jsonString = json.dumps(self.outMetaJSON, indent=4)
+        jsonBytes = bytearray(jsonString, "ascii")
+        self.sect_outMeta.extend(jsonBytes)
+        if self.compactMetadata:
+            print("  Compact metadata: {} / {} bytes, vs {} indented".format(
+                len(jsonBytes), hex(len(jsonBytes)), len(json.dumps(self.outMetaJSON, indent=4))))
+
+        if self.debugOutput:
+            absFilePath = PrepDebugDir(absProjectDir, "resources.json")
+            # The accompanying json
+            with open(absFilePath, "w") as f:
+                f.write(jsonString)
+            print("    DEBUG: Wrote {}".format(absFilePath))
+
+        if self.writeDirectory:
+            res = self.AddDirectory(absProjectDir)
+            if not res:
+                return False
+
+        return True
+
+    def AddDirectory(self, absProjectDir):
+        # type: (str) -> bool
+        """
+        Hash table of the resource_index, so the device can find
+        a resource without parsing and searching the JSON
+        """
+
+        resourceIndex = self.outMetaJSON.get("resource_index", [])
+        self.sect_directory = BuildDirectory(resourceIndex)
+        print("  Added resource directory: {} entries, {} / {} bytes, at most {} probes per lookup".format(
+            len(resourceIndex), len(self.sect_directory), hex(len(self.sect_directory)), GetMaxProbes(self.sect_directory)))
+
+        if self.debugOutput:
+            absFilePath = PrepDebugDir(absProjectDir, "directory.bin")
+            with open(absFilePath, "wb") as f:
+                f.write(self.sect_directory)
+            print("    DEBUG: Wrote {}".format(absFilePath))
+
+        return True
+
+    def ReadBuildOptions(self, inJsonData, absMetaFileName):
+        # type: (Dict[str,any], str) -> bool
+        """
+        Optional "build" section with packer settings for this app
+        (it's not copied into the packed metadata)
+        """
+
+        buildOptions = inJsonData.get("build", {})
+        if not isinstance(buildOptions, dict):
+            print("Expected 'build' to be an object in {}".format(absMetaFileName))
             return False
 
-    # Process all collected files
-    for relativePath, absResPath in allFiles:
-        print("    Packing file: {}".format(relativePath))
-        print("      Located @: {}".format(absResPath))
+        if self.compressWithDefaults or "compression" in buildOptions:
+            try:
+                self.compressionPolicy = LoadCompressionPolicy(buildOptions.get("compression"))
+            except CompressionPolicyError as e:
+                print("Invalid build.compression in {}: {}".format(absMetaFileName, e))
+                return False
+            print("  Compressing resources, types: {}".format(
+                ", ".join("{}={}".format(k, v) for k, v in sorted(self.compressionPolicy["types"].items()))))
+
+        if self.nativeSpritesWithDefaults or "sprites" in buildOptions:
+            try:
+                self.spritePolicy = LoadSpritePolicy(buildOptions.get("sprites"))
+            except SpritePolicyError as e:
+                print("Invalid build.sprites in {}: {}".format(absMetaFileName, e))
+                return False
+            print("  Converting PNG sprites to native RGB565, default: {}, {} per-file overrides".format(
+                self.spritePolicy["default"], len(self.spritePolicy["files"])))
+
+        if self.indexedDefaultMode is not None or "indexed" in buildOptions:
+            try:
+                self.indexedPolicy = LoadIndexedPolicy(buildOptions.get("indexed"), self.indexedDefaultMode)
+            except IndexedPolicyError as e:
+                print("Invalid build.indexed in {}: {}".format(absMetaFileName, e))
+                return False
+            print("  Quantizing images to palettes, types: {}, dither: {}".format(
+                ", ".join("{}={}".format(k, v) for k, v in sorted(self.indexedPolicy["types"].items())),
+                self.indexedPolicy["dither"]))
+
+        if "mipmaps" in buildOptions:
+            try:
+                self.mipmapPolicy = LoadMipmapPolicy(buildOptions["mipmaps"])
+            except MipmapPolicyError as e:
+                print("Invalid build.mipmaps in {}: {}".format(absMetaFileName, e))
+                return False
+            print("  Generating {} filtered mip chains down to {}px for: {}".format(
+                self.mipmapPolicy["filter"], self.mipmapPolicy["min_size"], ", ".join(self.mipmapPolicy["paths"])))
+
+        # the command line wins
+        if self.loadTraceName is None and "load_trace" in buildOptions:
+            if not isinstance(buildOptions["load_trace"], str):
+                print("Expected 'build.load_trace' to be a path in {}".format(absMetaFileName))
+                return False
+            self.loadTraceName = buildOptions["load_trace"]
+
+        if self.tightPackingWithDefaults or "alignment" in buildOptions:
+            try:
+                self.alignmentPolicy = LoadAlignmentPolicy(buildOptions.get("alignment"))
+            except AlignmentPolicyError as e:
+                print("Invalid build.alignment in {}: {}".format(absMetaFileName, e))
+                return False
+            print("  Packing resources under {} bytes on {} byte boundaries".format(
+                self.alignmentPolicy["small_threshold"], self.alignmentPolicy["small_alignment"]))
+
+        if self.minifyLuaWithDefaults or "lua" in buildOptions:
+            try:
+                self.luaPolicy = LoadLuaPolicy(buildOptions.get("lua"))
+            except LuaPolicyError as e:
+                print("Invalid build.lua in {}: {}".format(absMetaFileName, e))
+                return False
+            print("  Minifying Lua scripts, {} constants, {} debug functions to drop".format(
+                len(self.luaPolicy["constants"]), len(self.luaPolicy["drop_functions"])))
+
+        if self.adpcmWithDefaults or "audio" in buildOptions:
+            try:
+                self.audioPolicy = LoadAudioPolicy(buildOptions.get("audio"))
+            except AudioPolicyError as e:
+                print("Invalid build.audio in {}: {}".format(absMetaFileName, e))
+                return False
+            print("  Converting PCM WAVs to {} at up to {} Hz, {} per-file overrides".format(
+                self.audioPolicy["codec"], self.audioPolicy["rate"], len(self.audioPolicy["files"])))
+
+        if self.streamMusicWithDefaults or "streaming" in buildOptions:
+            try:
+                self.streamPolicy = LoadStreamPolicy(buildOptions.get("streaming"))
+            except StreamPolicyError as e:
+                print("Invalid build.streaming in {}: {}".format(absMetaFileName, e))
+                return False
+            print("  Laying out tracks of {}s or more in {} byte chunks".format(
+                self.streamPolicy["min_seconds"], self.streamPolicy["chunk_size"]))
+
+        for key in ("directory", "compact_metadata"):
+            if key in buildOptions and not isinstance(buildOptions[key], bool):
+                print("Expected 'build.{}' to be true or false in {}".format(key, absMetaFileName))
+                return False
+
+        # either one turns it on
+        self.writeDirectory = self.writeDirectory or buildOptions.get("directory", False)
+        self.compactMetadata = self.compactMetadata or buildOptions.get("compact_metadata", False)
 
-        try:
-            with open(absResPath, "rb") as f:
-                data = bytearray(f.read())
-                dataLen = len(data)
-                print("      Read {} / {} bytes".format(dataLen, hex(dataLen)))
+        return True
+
+    def ParseResources(self, inJsonData, absMetaFileName, absProjectDir):
+        # type: (Dict[str,any], str, str) -> bool
+
+        # all resources combined
+        # individual resources offsets
+
+        print("  Parsing metadata resources...")
+
+        if (inJsonData["resources"] is None):
+            print("    No resources section, skipping")
+            return True
+
+        inJsonResArray = inJsonData["resources"]
+        self.outMetaJSON["resources"] = []
+        self.outMetaJSON["resource_index"] = []  # New: index of all files with metadata
+
+        allFiles = []  # Collect all files from resources (including folders)
+
+        # Process each resource entry (can be file or folder)
+        for r in inJsonResArray:
+            self.PrintDetail("    Processing resource entry: {}".format(r))
+
+            absResPath = absProjectDir / r
+            absResPath = Path(absResPath).resolve()
+            self.inputPaths.append(absResPath)
+
+            if os.path.isfile(absResPath):
+                # Single file
+                allFiles.append((r, absResPath))
+                self.PrintDetail("      Added file: {}".format(r))
+            elif os.path.isdir(absResPath):
+                # Folder - recursively scan for all files
+                self.PrintDetail("      Scanning folder: {}".format(r))
+                try:
+                    folderFiles = ScanFolderRecursive(absProjectDir, r, self.PrintDetail)
+                except Exception as e:
+                    print("      ERROR: Failed to scan folder {}: {}".format(absResPath, e))
+                    return False
+                allFiles.extend(folderFiles)
+                self.PrintDetail("      Found {} files in folder".format(len(folderFiles)))
+            else:
+                print("      ERROR: Resource {} is neither file nor folder at {}".format(r, absResPath))
+                return False
+
+        # Physically order the blob by when the app loads each
+        # resource, so loads become mostly sequential reads
+        loadTrace = None
+        metadataOrder = [f[0] for f in allFiles]
+        if self.loadTraceName is not None:
+            self.inputPaths.append((absProjectDir / self.loadTraceName).resolve())
+            loadTrace = ReadLoadTrace(absProjectDir / self.loadTraceName, allFiles)
+            if loadTrace is None:
+                return False
+            allFiles = OrderByLoadTrace(allFiles, loadTrace)
+
+        numReused = 0
+
+        # First block laid out for each content hash
+        # (resource_index entry), for deduplication
+        sharedBlocks = {}
+        numDeduped = 0
+        dedupeSavedBytes = 0
+
+        # Resource index entries sharing another's block, their
+        # padded_size is only final once the blob is laid out
+        aliasEntries = []
+
+        # Last block that owns its data, and its resource index entry,
+        # so its padding can be extended when the next file needs
+        # to start on a later boundary
+        lastBlock = None
+        lastFileInfo = None
+
+        # Padding actually used vs padding every file to 512
+        paddingBytes = 0
+        sectorPaddingBytes = 0
+
+        # Palette images vs the same images as RGB565
+        numIndexed = 0
+        indexedBytes = 0
+        indexedRgb565Bytes = 0
+
+        if not self.PrepStagingDir():
+            return False
 
-                # Record file metadata
-                startOffset = len(sect_allResources)
+        if not self.PrepSharedPalettes(allFiles):
+            return False
+
+        # Read, hash and transform every file across a thread pool so the work
+        # overlaps, results come back in metadata order so the layout is unaffected
+        print("    Reading {} files...".format(len(allFiles)))
+        ingestStart = time.perf_counter()
+        ingested = self.IngestResources(allFiles)
+        self.timings["resources"] = time.perf_counter() - ingestStart
+        layoutStart = time.perf_counter()
+
+        # Lay out all collected files
+        # only the sizes are needed here, the data itself is
+        # streamed into the output when the pack is written
+        for info in ingested:
+            relativePath = info["path"]
+            absResPath = info["absPath"]
+            self.PrintDetail("    Packing file: {}".format(relativePath))
+            self.PrintDetail("      Located @: {}".format(absResPath))
+
+            if info["error"] is not None:
+                print("Failed to open file @ {}".format(absResPath))
+                print("Exception: {}".format(info["error"]))
+                return False
+
+            stamp = info["stamp"]
+            dataLen = info["size"]
+            self.resourceStats.append({
+                "path": relativePath,
+                "size": stamp[0],
+                "stored_size": dataLen,
+                "read_seconds": round(info["seconds"], 5),
+                "cached": info["cached"] is not None,
+            })
+            self.PrintDetail("      Size {} / {} bytes".format(stamp[0], hex(stamp[0])))
+            if info["fields"]:
+                # (nested fields like a stream's chunk index are too long to list)
+                self.PrintDetail("      Stored as {} / {} bytes ({})".format(
+                    dataLen, hex(dataLen), ", ".join("{}={}".format(k, "{...}" if isinstance(v, dict) else v)
+                                                     for k, v in info["fields"].items())))
+            if info["report"]:
+                self.PrintDetail("      Report: {}".format(", ".join("{}={}".format(k, v) for k, v in info["report"].items())))
+            if info["fields"].get("format") == "indexed":
+                numIndexed += 1
+                indexedBytes += dataLen
+                indexedRgb565Bytes += info["report"]["rgb565_size"]
+
+            # Unchanged since the last build?
+            # then its block can be copied from the previous pack
+            cached = info["cached"]
+            if cached is not None:
+                numReused += 1
+                self.PrintDetail("      Unchanged since the previous build")
+
+            # Same content as a file we've already laid out?
+            # then just point this path at the existing block
+            sharedInfo = sharedBlocks.get(info["sha1"]) if self.dedupeResources else None
+            if sharedInfo is not None:
+                startOffset = sharedInfo["offset"]
 
-                # Legacy format for backward compatibility
                 kvp = (relativePath, startOffset)
-                resourceNameOffsetKeyVals.append(kvp)
-                outMetaJSON["resources"].append(kvp)
+                self.resourceNameOffsetKeyVals.append(kvp)
+                self.outMetaJSON["resources"].append(kvp)
 
-                # New detailed resource index
-                fileInfo = {
+                aliasInfo = {
                     "path": relativePath,
                     "offset": startOffset,
                     "size": dataLen,
-                    "padded_size": 0  # Will be filled after padding
+                    "padded_size": sharedInfo["padded_size"],
                 }
+                aliasInfo.update(info["fields"])
+                aliasInfo["alias_of"] = sharedInfo["path"]
+                self.outMetaJSON["resource_index"].append(aliasInfo)
+                aliasEntries.append((aliasInfo, sharedInfo))
+
+                self.resourceBlocks.append(MakeResourceBlock(info, startOffset, 0, sharedInfo["path"]))
+
+                numDeduped += 1
+                self.PrintDetail("      Identical to {}, sharing its data @ {} / {}".format(
+                    sharedInfo["path"], startOffset, hex(startOffset)))
+                continue
+
+            # Record file metadata
+            alignment = GetResourceAlignment(self.alignmentPolicy, relativePath, dataLen)
+            # streamed tracks' chunks are only sector aligned if the track is
+            if "stream" in info["fields"]:
+                alignment = 512
+            startOffset = GetAlignedOffset(self.resourcesLength, dataLen, alignment)
+            if startOffset > self.resourcesLength:
+                extraPadding = startOffset - self.resourcesLength
+                PadLastBlock(lastBlock, lastFileInfo, extraPadding)
+                paddingBytes += extraPadding
+                self.resourcesLength = startOffset
+                self.PrintDetail("      Padding the previous file by {} bytes to start on a {} byte boundary".format(
+                    extraPadding, 512 if startOffset % 512 == 0 else alignment))
+
+            # Legacy format for backward compatibility
+            kvp = (relativePath, startOffset)
+            self.resourceNameOffsetKeyVals.append(kvp)
+            self.outMetaJSON["resources"].append(kvp)
+
+            # New detailed resource index
+            fileInfo = {
+                "path": relativePath,
+                "offset": startOffset,
+                "size": dataLen,
+                "padded_size": 0  # Will be filled after padding
+            }
+
+            self.PrintDetail("      Data starts at {} / {} bytes".format(startOffset, hex(startOffset)))
+
+            # Pad the data out to 512 byte boundaries for much faster SD access
+            # (or less for small files with an alignment policy)
+            paddingLength = GetPaddingLength(startOffset + dataLen, alignment)
+            fileInfo["padded_size"] = dataLen + paddingLength
+            paddingBytes += paddingLength
+            sectorPaddingBytes += GetPaddingLength(dataLen, 512)
+            fileInfo.update(info["fields"])
+            self.resourcesLength += fileInfo["padded_size"]
+
+            # Add to resource index
+            self.outMetaJSON["resource_index"].append(fileInfo)
+            sharedBlocks[info["sha1"]] = fileInfo
+
+            lastBlock = MakeResourceBlock(info, startOffset, paddingLength, None)
+            lastFileInfo = fileInfo
+            self.resourceBlocks.append(lastBlock)
+
+            self.PrintDetail("      Padding data end by {} bytes to {} boundary @ {}".format(
+                paddingLength, alignment, hex(self.resourcesLength)))
+
+        # The next section starts on a sector boundary
+        endPadding = GetPaddingLength(self.resourcesLength, 512)
+        if endPadding > 0:
+            PadLastBlock(lastBlock, lastFileInfo, endPadding)
+            paddingBytes += endPadding
+            self.resourcesLength += endPadding
+
+        for aliasInfo, sharedInfo in aliasEntries:
+            aliasInfo["padded_size"] = sharedInfo["padded_size"]
+            dedupeSavedBytes += sharedInfo["padded_size"]
+
+        numResources = len(self.resourceNameOffsetKeyVals)
+        print("    Laid out resource blob of size {} / {} with {} files".format(
+            self.resourcesLength, hex(self.resourcesLength), numResources))
+
+        if self.dedupeResources:
+            print("    Deduplicated {} files with identical content, saved {} / {} bytes".format(
+                numDeduped, dedupeSavedBytes, hex(dedupeSavedBytes)))
+
+        if self.indexedPolicy is not None:
+            print("    Quantized {} images to {} / {} bytes, {} / {} as RGB565".format(
+                numIndexed, indexedBytes, hex(indexedBytes), indexedRgb565Bytes, hex(indexedRgb565Bytes)))
+
+        if self.alignmentPolicy is not None:
+            print("    Padding: {} / {} bytes, vs {} / {} bytes with every file on a 512 byte boundary".format(
+                paddingBytes, hex(paddingBytes), sectorPaddingBytes, hex(sectorPaddingBytes)))
+
+        if loadTrace is not None:
+            self.ReportLoadTraceSeeks(loadTrace, metadataOrder, ingested)
+
+        if self.buildCache is not None:
+            print("    {} of {} files unchanged since the previous build".format(numReused, numResources))
+
+        self.timings["layout"] = time.perf_counter() - layoutStart
+
+        return True
+
+    def EstimateSeeks(self, loadTrace, order, infoByPath):
+        # type: (List[str], List[str], Dict[str, Dict[str, Any]]) -> Tuple[int, int]
+        """
+        Replay the trace against a layout of the resources in the given order.
+        Returns (seeks, bytes skipped over), where a seek is any read that
+        doesn't start where the previous one ended.
+        """
+
+        offsets = {}
+        shared = {}
+        endOffset = 0
+        for relativePath in order:
+            info = infoByPath[relativePath]
+            if self.dedupeResources and info["sha1"] in shared:
+                offsets[relativePath] = shared[info["sha1"]]
+                continue
+            paddedSize = info["size"] + GetPaddingLength(info["size"], 512)
+            offsets[relativePath] = (endOffset, paddedSize)
+            shared[info["sha1"]] = offsets[relativePath]
+            endOffset += paddedSize
+
+        seeks = 0
+        skipped = 0
+        pos = None
+        for relativePath in loadTrace:
+            offset, paddedSize = offsets[relativePath]
+            if offset != pos:
+                seeks += 1
+                if pos is not None:
+                    skipped += abs(offset - pos)
+            pos = offset + paddedSize
+
+        return seeks, skipped
+
+    def ReportLoadTraceSeeks(self, loadTrace, metadataOrder, ingested):
+        # type: (List[str], List[str], List[Dict[str, Any]]) -> None
+
+        infoByPath = {info["path"]: info for info in ingested}
+        layoutOrder = [info["path"] for info in ingested]
+
+        oldSeeks, oldSkipped = self.EstimateSeeks(loadTrace, metadataOrder, infoByPath)
+        newSeeks, newSkipped = self.EstimateSeeks(loadTrace, layoutOrder, infoByPath)
+
+        print("    Load trace replay: {} seeks over {} / {} bytes in metadata order, {} seeks over {} / {} bytes as laid out".format(
+            oldSeeks, oldSkipped, hex(oldSkipped), newSeeks, newSkipped, hex(newSkipped)))
+        print("    Saved an estimated {} of {} seeks".format(oldSeeks - newSeeks, len(loadTrace)))
+
+    def PrepStagingDir(self):
+        # type: () -> bool
+        """
+        Transformed resources need somewhere to live until they're streamed
+        into the pack; use a temp folder unless the build cache provides one
+        """
+
+        if all(p is None for p in (self.compressionPolicy, self.spritePolicy, self.indexedPolicy, self.mipmapPolicy, self.luaPolicy,
+                                   self.audioPolicy, self.streamPolicy)):
+            return True
+
+        try:
+            if self.stagingDir is None:
+                self.stagingDir = Path(tempfile.mkdtemp(prefix="vmupacker_"))
+                self.tempStagingDir = self.stagingDir
+                atexit.register(shutil.rmtree, str(self.stagingDir), True)
+            elif not os.path.isdir(self.stagingDir):
+                os.makedirs(self.stagingDir)
+        except Exception as e:
+            print("Failed to create a folder for transformed resources: {}".format(e))
+            return False
+
+        return True
+
+    def PrepSharedPalettes(self, allFiles):
+        # type: (List[Tuple[str, Path]]) -> bool
+        """
+        Shared palettes depend on every image that uses them,
+        so they're built before any one image is quantized
+        """
+
+        if self.indexedPolicy is None or not self.indexedPolicy["shared_palettes"]:
+            return True
+
+        try:
+            self.sharedPalettes = BuildSharedPalettes(self.indexedPolicy, allFiles)
+        except Exception as e:
+            print("Failed to build shared palettes: {}".format(e))
+            return False
+
+        for name, palette in sorted(self.sharedPalettes.items()):
+            print("    Built shared palette '{}' with {} colors".format(name, len(palette["colors"])))
+
+        return True
+
+    def GetTransformStages(self, relativePath):
+        # type: (str) -> List[Tuple[str, Callable[[Path, Path], Optional[Dict[str, Any]]]]]
+        """
+        The (key, function) stages this resource goes through before packing,
+        in order. Each function converts one file into another and returns the
+        fields it adds to the resource_index entry, or None to pass its input
+        through untouched.
+        """
+
+        stages = []
+
+        # an image is stored as a mip chain, quantized
+        # or converted to native RGB565, only one of them
+        stage = None
+        if self.mipmapPolicy is not None:
+            stage = GetMipmapStage(self.mipmapPolicy, relativePath)
+        if stage is None and self.indexedPolicy is not None:
+            stage = GetIndexedStage(self.indexedPolicy, self.sharedPalettes, relativePath)
+        if stage is None and self.spritePolicy is not None:
+            stage = GetSpriteStage(self.spritePolicy, relativePath)
+        if stage is not None:
+            stages.append(stage)
+
+        if self.luaPolicy is not None:
+            stage = GetLuaStage(self.luaPolicy, relativePath)
+            if stage is not None:
+                stages.append(stage)
+
+        if self.audioPolicy is not None:
+            stage = GetAudioStage(self.audioPolicy, relativePath)
+            if stage is not None:
+                stages.append(stage)
+
+        # after any transcoding, so the chunks hold the final samples
+        streamed = False
+        if self.streamPolicy is not None:
+            stage = GetStreamStage(self.streamPolicy, relativePath)
+            if stage is not None:
+                stages.append(stage)
+                streamed = True
+
+        # last, so it sees the final form of the data
+        # (not streamed tracks, their chunks must stay seekable)
+        if self.compressionPolicy is not None and not streamed:
+            stage = GetCompressionStage(self.compressionPolicy, relativePath, COPY_CHUNK_SIZE)
+            if stage is not None:
+                stages.append(stage)
+
+        return stages
+
+    def IngestResources(self, allFiles):
+        # type: (List[Tuple[str, Path]]) -> List[Dict[str, Any]]
+        """
+        Stat, hash and transform each (relative_path, absolute_path) on a
+        thread pool. Returns one info dict per file in the same order as allFiles.
+        """
+
+        with ThreadPoolExecutor(max_workers=self.ingestJobs) as pool:
+            return list(pool.map(lambda f: self.IngestFile(f[0], f[1]), allFiles))
+
+    def IngestFile(self, relativePath, absResPath):
+        # type: (str, Path) -> Dict[str, Any]
+        """
+        Runs on the ingest threads, so no printing here:
+        any error is returned in the info dict for the caller to report
+        """
+
+        info = {
+            "path": relativePath,
+            "absPath": absResPath,
+            "stamp": None,
+            # of the data as it will be stored in the pack
+            "dataPath": absResPath,
+            "size": None,
+            "sha1": None,
+            # of the file on disk
+            "source_sha1": None,
+            "transform": None,
+            "fields": {},
+            # build-only notes from the transforms, e.g. image quality
+            "report": {},
+            "cached": None,
+            "error": None,
+            # time spent reading, hashing and transforming it
+            "seconds": 0.0,
+        }
+
+        readStart = time.perf_counter()
+
+        try:
+            # stamp before reading so an edit made mid-build is picked up next time
+            info["stamp"] = FileStamp(absResPath)
+            info["size"] = info["stamp"][0]
+
+            stages = self.GetTransformStages(relativePath)
+            if len(stages) > 0:
+                info["transform"] = "+".join(key for key, _ in stages)
+
+            canReuse = self.buildCache is not None and self.prevResourceOffset is not None
+
+            if canReuse:
+                cached = LookupResource(self.buildCache, relativePath, info["stamp"], info["transform"])
+                if cached is not None and self.ApplyCachedEntry(info, cached):
+                    info["seconds"] = time.perf_counter() - readStart
+                    return info
+
+            # same file with the same transforms in another variant
+            sharedKey = (str(absResPath), info["stamp"], info["transform"])
+            shared = None
+            if self.sharedInputs is not None:
+                shared = self.sharedInputs["resources"].get(sharedKey)
+
+            if shared is not None:
+                self.UseSharedResource(info, shared)
+            else:
+                readBuffer = bytearray(COPY_CHUNK_SIZE)
+                info["source_sha1"] = HashFile(absResPath, readBuffer)
+                info["sha1"] = info["source_sha1"]
+
+                if info["transform"] is not None:
+                    self.TransformResource(info, stages, readBuffer)
+
+                if self.sharedInputs is not None:
+                    self.sharedInputs["resources"][sharedKey] = info
+
+            # Touched but not edited, the old block is still good
+            if canReuse:
+                prevEntry = self.buildCache["resources"].get(relativePath)
+                if (prevEntry is not None and prevEntry["source_sha1"] == info["source_sha1"]
+                        and prevEntry["transform"] == info["transform"]):
+                    info["cached"] = prevEntry
+
+        except Exception as e:
+            info["error"] = e
+
+        info["seconds"] = time.perf_counter() - readStart
+
+        return info
+
+    def UseSharedResource(self, info, shared):
+        # type: (Dict[str, Any], Dict[str, Any]) -> None
+        """
+        Fill in the info from another variant's read of the same file.
+        Transformed data is copied into this build's objects folder if it
+        has its own, as its build cache only looks for objects in there.
+        """
+
+        for key in ("dataPath", "size", "sha1", "source_sha1", "fields", "report"):
+            info[key] = shared[key]
+
+        if (self.buildCache is None or shared["dataPath"] == shared["absPath"]
+                or Path(shared["dataPath"]).parent == self.stagingDir):
+            return
+
+        absObjPath = self.stagingDir / Path(shared["dataPath"]).name
+        # unique per thread, identical files may be copied at the same time
+        tempSuffix = ".{}.tmp".format(threading.get_ident())
+        for srcPath, dstPath in ((shared["dataPath"], absObjPath),
+                                 (str(shared["dataPath"]) + ".json", str(absObjPath) + ".json")):
+            if not os.path.isfile(dstPath):
+                shutil.copyfile(srcPath, str(dstPath) + tempSuffix)
+                os.replace(str(dstPath) + tempSuffix, dstPath)
+        info["dataPath"] = absObjPath
+
+    def ApplyCachedEntry(self, info, cached):
+        # type: (Dict[str, Any], Dict[str, Any]) -> bool
+        """
+        Fill in the info from the build cache instead of reading the file.
+        Transformed data must still be in the objects folder, as that's
+        where it gets re-read from if the previous pack's copy is bad.
+        """
+
+        if cached["fields"]:
+            absObjPath = self.stagingDir / "{}.{}".format(cached["source_sha1"], cached["transform"])
+            if not os.path.isfile(absObjPath):
+                return False
+            info["dataPath"] = absObjPath
+
+        info["size"] = cached["stored_size"]
+        info["sha1"] = cached["sha1"]
+        info["source_sha1"] = cached["source_sha1"]
+        info["fields"] = cached["fields"]
+        info["report"] = cached.get("report") or {}
+        info["cached"] = cached
+        return True
+
+    def TransformResource(self, info, stages, readBuffer):
+        # type: (Dict[str, Any], List[Tuple[str, Any]], bytearray) -> None
+        """
+        Run the source file through each stage, leaving the result in the
+        staging folder as <source sha1>.<transform key> with a .json sidecar
+        holding its resource_index fields and report, so it can be reused
+        as-is. Leaves the info pointing at the source if no stage was applied.
+        """
+
+        absObjPath = self.stagingDir / "{}.{}".format(info["source_sha1"], info["transform"])
+        absSidecarPath = Path(str(absObjPath) + ".json")
+        # unique per thread, identical files may be transformed at the same time
+        tempSuffix = ".{}.tmp".format(threading.get_ident())
+
+        fields = None
+        report = {}
+        reuse = False
+        if os.path.isfile(absSidecarPath):
+            with open(absSidecarPath, "r") as f:
+                sidecar = json.load(f)
+            if isinstance(sidecar, dict) and "fields" in sidecar:
+                fields = sidecar["fields"]
+                report = sidecar["report"]
+                # the object itself may have been cleaned up, just redo it
+                reuse = fields is None or os.path.isfile(absObjPath)
+
+        if not reuse:
+            fields = {}
+            report = {}
+            curPath = info["absPath"]
+            for i, (key, stageFn) in enumerate(stages):
+                outPath = Path("{}.{}{}".format(absObjPath, i, tempSuffix))
+                stageFields = stageFn(curPath, outPath)
+                if stageFields is None:
+                    # no benefit, carry on with the input as-is
+                    if os.path.isfile(outPath):
+                        os.remove(outPath)
+                    continue
+                if curPath != info["absPath"]:
+                    os.remove(curPath)
+                curPath = outPath
+                report.update(stageFields.pop("report", {}))
+                fields.update(stageFields)
+
+            if curPath == info["absPath"]:
+                fields = None
+                report = {}
+            else:
+                os.replace(curPath, absObjPath)
+
+            with open(str(absSidecarPath) + tempSuffix, "w") as f:
+                json.dump({"fields": fields, "report": report}, f)
+            os.replace(str(absSidecarPath) + tempSuffix, absSidecarPath)
+
+        if fields is None:
+            return
+
+        info["dataPath"] = absObjPath
+        info["size"] = os.path.getsize(absObjPath)
+        info["sha1"] = HashFile(absObjPath, readBuffer)
+        info["fields"] = fields
+        info["report"] = report
+
+    # Placeholder for now
+    # 00-04: reserved0
+    # 04-08: reserved1
+    # 08-0C: reserved2
+    # 0C-0F: reserved3
+    def AddBinding(self):
+        # type: () -> bool
+
+        print("  Adding dummy binding")
+
+        self.sect_binding = bytearray(16)
+
+        return True
+
+    def PrintSectionSizes(self, printVal):
+        # type: (str)->None
+
+        if not self.debugOutput:
+            return
+
+        print(printVal)
+        print("  Header   : {} / {}".format(len(self.sect_header), hex(len(self.sect_header))))
+        print("  Icon     : {} / {}".format(len(self.sect_icon), hex(len(self.sect_icon))))
+        print("  MetaData : {} / {}".format(len(self.sect_outMeta), hex(len(self.sect_outMeta))))
+        print("  Directory: {} / {}".format(len(self.sect_directory), hex(len(self.sect_directory))))
+        print("  Binding  : {} / {}".format(len(self.sect_binding), hex(len(self.sect_binding))))
+        print("  LUA Resources : {} / {}".format(self.resourcesLength, hex(self.resourcesLength)))
+
+        # 00-08: uint8_t magic[8] = "VMUPACK\0"
+        # 08-0C: uint8_t vmuPackVersion = 1
+        #        uint8_t targetDevice = 0
+        #        uint8_t productBindingVersion
+        #        uint8_t deviceBindingVersion
+        # 0C-10: uint8_t sdkVersionMajor
+        #        uint8_t sdkVersionMinor
+        #        uint8_t sdkVersionPatch
+        #        uint8_t reserved
+        #
+        # 10-30: uint8_t appName[32] = "My awesome app\0"
+        #
+        # 30-34: uint32_t appMode        # 1= applet, 2= fullscreen
+        # 34-38: uint32_t appEnv         # 0 = native, 1 = LUA
+        # 38-38: uint32_t reserved
+        # 3C-40: uint32_t fileSizeBytesMinusSignature    # aka SignaturePos
+        #
+        # 40-44: uint32_t iconOffset
+        # 44-48: uint32_t iconLength
+        #
+        # 48-4C: uint32_t metadataOffset
+        # 4C-50: uint32_t metadataLength
+        #
+        # 50-54: uint32_t resourceOffset
+        # 54-58: uint32_t resourceLength
+        #
+        # 58-5C: uint32_t bindingOffset
+        # 5C-60: uint32_t bindingLength
+        #
+        # 60-64: uint32_t elfOffset
+        # 64-68: uint32_t elfLength
+        #
+        # 68-6C: uint32_t directoryOffset    # 0 = no directory
+        # 6C-70: uint32_t directoryLength
+        #
+        # 70-78: uint32_t reserved[2]
+        #
+        # padded to 512 bytes
+
+    def CreateHeader(self, absProjectDir, appName, sdkVersion):
+        # type: (str, str, Tuple[int, int, int]) -> bool
+
+        # 0-8: magic
+        magic = b"VMUPACK\0"
+        self.sect_header.extend(magic)
+
+        # Add the values we know immediately
+
+        # 8-C: version, targ device,
+        vmuPackVersion = 1
+        self.sect_header.extend(vmuPackVersion.to_bytes(1, 'little'))
+        targDevice = 0
+        self.sect_header.extend(targDevice.to_bytes(1,'little'))
+        prodBindingVersion = 0
+        self.sect_header.extend(prodBindingVersion.to_bytes(1,'little'))
+        devBindingversion = 0
+        self.sect_header.extend(devBindingversion.to_bytes(1,'little'))
+
+        # C-10: SDK version (major.minor.patch) + 1 reserved byte
+        print("  Writing SDK version {}.{}.{} to header".format(
+            sdkVersion[0], sdkVersion[1], sdkVersion[2]))
+        self.sect_header.extend(sdkVersion[0].to_bytes(1, 'little'))  # Major
+        self.sect_header.extend(sdkVersion[1].to_bytes(1, 'little'))  # Minor
+        self.sect_header.extend(sdkVersion[2].to_bytes(1, 'little'))  # Patch
+        self.sect_header.extend((0).to_bytes(1, 'little'))            # Reserved
+
+        # 10-30 - mini header identifier
+        appNameHeader = self.outMetaJSON["app_name"]
+        appNameHeader = bytearray(appNameHeader, "ascii")
+        # clamp it at 31 chars
+        if (len(appNameHeader) > 31):
+            appNameHeader = appNameHeader[:31]
+        # pad it to exactly 32 chars
+        PadByteArray(appNameHeader, 32)
+        self.sect_header.extend(appNameHeader)
+
+        # 30-34 - app mode
+        # 0 = AUTO (not applicable for ext apps)
+        # 1 = APPLET (WIP)
+        # 2 = FULLSCREEN
+        # 3 = EXCLUSIVE (not applicable)
+        # Pick 2 for now!
+        appMode = self.outMetaJSON["app_mode"]
+        modePacked = struct.pack("<I", appMode)
+        self.sect_header.extend(modePacked)
+
+        # 34-38 app env
+        envStr = self.outMetaJSON["app_environment"]
+        envVal = 0
+        if envStr == "native":
+            envVal = 0
+        elif envStr == "lua":
+            envVal = 1
+        else:
+            envVal = 0xFFFFFFFF
+        envPacked = struct.pack("<I", envVal)
+        self.sect_header.extend(envPacked)
+
+        # 2 reserved fields
+        # then we'll start adding the other sections
+        res1Packed = struct.pack("<I", 0)
+        res2Packed = struct.pack("<I", 0)
+        self.sect_header.extend(res1Packed)
+        self.sect_header.extend(res2Packed)
+
+        headerFieldPos = len(self.sect_header)
+        print("Continuing header from offset {}".format(headerFieldPos))
+
+        #
+        # Pad out some byte arrays and then let's start piecing them together
+        #
+
+        self.PrintSectionSizes("Section sizes:")
+        self.unpaddedSizes = {
+            "header": len(self.sect_header),
+            "icon": len(self.sect_icon),
+            "metadata": len(self.sect_outMeta),
+            "directory": len(self.sect_directory),
+            "binding": len(self.sect_binding),
+        }
+        PadByteArray(self.sect_header, 512)
+        PadByteArray(self.sect_icon, 512)
+        PadByteArray(self.sect_outMeta, 512)
+        PadByteArray(self.sect_directory, 512)
+        PadByteArray(self.sect_binding, 512)
+        # (each resource was already padded as it was laid out)
+        self.PrintSectionSizes("Padded section sizes:")
+
+        #
+        # Every section offset follows from the sizes alone,
+        # so fill in the whole header before anything is written
+        #
+
+        iconStart = len(self.sect_header)
+        headerFieldPos += AddToArray(self.sect_header, headerFieldPos, iconStart)
+        headerFieldPos += AddToArray(self.sect_header, headerFieldPos, len(self.sect_icon))
+        print("  Placed icon at pos {} size {}".format(
+            hex(iconStart), hex(len(self.sect_icon))))
+
+        metaStart = iconStart + len(self.sect_icon)
+        headerFieldPos += AddToArray(self.sect_header, headerFieldPos, metaStart)
+        headerFieldPos += AddToArray(self.sect_header,
+                                     headerFieldPos, len(self.sect_outMeta))
+        print("  Placed metadata at pos {} size {}".format(
+            hex(metaStart), hex(len(self.sect_outMeta))))
+
+        # the directory (if any) sits between the metadata and the
+        # resources, its header fields come after the ELF's below
+        directoryStart = metaStart + len(self.sect_outMeta)
+
+        resStart = directoryStart + len(self.sect_directory)
+        headerFieldPos += AddToArray(self.sect_header, headerFieldPos, resStart)
+        headerFieldPos += AddToArray(self.sect_header,
+                                     headerFieldPos, self.resourcesLength)
+        print("  Placed LUA resources at pos {} size {}".format(
+            hex(resStart), hex(self.resourcesLength)))
+
+        bindingStart = resStart + self.resourcesLength
+        headerFieldPos += AddToArray(self.sect_header, headerFieldPos, bindingStart)
+        headerFieldPos += AddToArray(self.sect_header,
+                                     headerFieldPos, len(self.sect_binding))
+        print("  Placed binding at pos {} size {}".format(
+            hex(bindingStart), hex(len(self.sect_binding))))
+
+        # For LUA apps, we don't have ELF data, so write empty section
+        luaStart = bindingStart + len(self.sect_binding)
+        headerFieldPos += AddToArray(self.sect_header, headerFieldPos, luaStart)
+        headerFieldPos += AddToArray(self.sect_header, headerFieldPos, 0)  # Zero length
+        print("  Placed LUA section (empty) at pos {} size 0".format(hex(luaStart)))
+
+        if len(self.sect_directory) > 0:
+            headerFieldPos += AddToArray(self.sect_header, headerFieldPos, directoryStart)
+            headerFieldPos += AddToArray(self.sect_header, headerFieldPos, len(self.sect_directory))
+            print("  Placed resource directory at pos {} size {}".format(
+                hex(directoryStart), hex(len(self.sect_directory))))
+
+        sect_finalBinarySize = luaStart
+        print("Final binary size: {} / {}".format(
+            sect_finalBinarySize, hex(sect_finalBinarySize)))
+
+        absOutPath = GetOutputFilenameAbs(absProjectDir, appName)
+        sectionTable = [
+            (iconStart, len(self.sect_icon)),
+            (metaStart, len(self.sect_outMeta)),
+            (directoryStart, len(self.sect_directory)),
+            (resStart, self.resourcesLength),
+            (bindingStart, len(self.sect_binding)),
+        ]
+        self.absOutPath = absOutPath
+        self.finalBinarySize = sect_finalBinarySize
+        self.sectionTable = sectionTable
+        # header, icon, metadata (incl. every resource offset and size) and directory
+        inputsSha1 = HashBytes(self.sect_header + self.sect_icon + self.sect_outMeta + self.sect_directory)
+        newCacheEntries = {}
+
+        # Patching in place is only safe if every reused block is still
+        # where it was, as moved ones would be read from the file being written
+        canPatch = (self.buildCache is not None
+                    and CanPatchPreviousPack(self.buildCache, absOutPath, sectionTable, sect_finalBinarySize)
+                    and all(b["cached"] is None or (b["cached"]["offset"] == b["offset"]
+                                                    and b["cached"].get("padding") == b["padding"])
+                            for b in self.resourceBlocks if b["alias_of"] is None))
+
+        writeStart = time.perf_counter()
+
+        if canPatch:
+            res = self.PatchPack(absOutPath, resStart,
+                                 inputsSha1 != self.buildCache["inputs_sha1"], newCacheEntries)
+        else:
+            res = self.WritePack(absOutPath, resStart, newCacheEntries)
+        if not res:
+            return False
+
+        print("Write file to: {}".format(absOutPath))
+
+        if self.debugOutput:
+            absFilePath = PrepDebugDir(absProjectDir, "resources.bin")
+            # The binary data
+            # (the json offsets will be amongst the metadata)
+            with open(absOutPath, "rb", buffering=0) as packFile, open(absFilePath, "wb", buffering=0) as f:
+                CopyFileRange(packFile, resStart, f, self.resourcesLength,
+                              bytearray(COPY_CHUNK_SIZE), None)
+            print("    DEBUG: Wrote {}".format(absFilePath))
+
+        if self.buildCache is not None:
+            self.buildCache["resources"] = newCacheEntries
+            RecordPack(self.buildCache, absOutPath, sectionTable,
+                       resStart, self.resourcesLength, inputsSha1)
+            SaveBuildCache(absProjectDir, appName, self.buildCache)
+            PruneObjects(self.buildCache, self.stagingDir)
+
+        self.timings["write"] = time.perf_counter() - writeStart
+
+        return True
+
+    def WritePack(self, absOutPath, resStart, newCacheEntries):
+        # type: (Path, int, Dict[str, Any])->bool
+        """
+        Write the whole pack to a temp file next to the output then swap it in,
+        which leaves the previous pack readable for cached blocks until the end
+        """
+
+        absTempPath = Path(str(absOutPath) + ".tmp")
+        prevPackFile = None
 
-                # Add the file to the blob
-                sect_allResources.extend(data)
+        try:
+            if self.buildCache is not None and self.prevResourceOffset is not None:
+                prevPackFile = open(absOutPath, "rb", buffering=0)
 
-                print("      Data starts at {} / {} bytes".format(startOffset, hex(startOffset)))
+            with open(absTempPath, "wb", buffering=0) as outFile:
+                WriteAll(outFile, self.sect_header)
+                WriteAll(outFile, self.sect_icon)
+                WriteAll(outFile, self.sect_outMeta)
+                WriteAll(outFile, self.sect_directory)
+                res = self.StreamResources(outFile, resStart, self.resourceBlocks,
+                                           prevPackFile, newCacheEntries)
+                WriteAll(outFile, self.sect_binding)
 
-                # Pad the data out to 512 byte boundaries for much faster SD access
-                paddingLength = PadByteArray(sect_allResources, 512)
-                fileInfo["padded_size"] = dataLen + paddingLength
+            if prevPackFile is not None:
+                prevPackFile.close()
+                prevPackFile = None
 
-                # Add to resource index
-                outMetaJSON["resource_index"].append(fileInfo)
+            if not res:
+                DeleteFileNoError(absTempPath, "partial pack")
+                return False
 
-                print("      Padding data end by {} bytes to 512 boundary @ {}".format(
-                    paddingLength, hex(len(sect_allResources))))
+            os.replace(absTempPath, absOutPath)
 
         except Exception as e:
-            print("Failed to open file @ {}".format(absResPath))
+            print("The .vmupack was successfully built but the file could not be saved to {}".format(
+                absOutPath))
+            print("Please ensure that the file is not currently open!")
             print("Exception: {}".format(e))
+            DeleteFileNoError(absTempPath, "partial pack")
             return False
 
-    sect_allResourcesSize = len(sect_allResources)
-    numResources = len(resourceNameOffsetKeyVals)
-    print("    Created resource blob of size {} / {} with {} files".format(
-        sect_allResourcesSize, hex(sect_allResourcesSize), numResources))
+        finally:
+            if prevPackFile is not None:
+                prevPackFile.close()
+
+        return True
+
+    def PatchPack(self, absOutPath, resStart, rewriteHead, newCacheEntries):
+        # type: (Path, int, bool, Dict[str, Any])->bool
+        """
+        The pack on disk has the same layout as the new one,
+        so only rewrite the header/metadata and the blocks that changed
+        """
+
+        changedBlocks = []
+        for block in self.resourceBlocks:
+            if block["cached"] is None and block["alias_of"] is None:
+                changedBlocks.append(block)
+            else:
+                RecordResource(newCacheEntries, block)
+
+        if not rewriteHead and len(changedBlocks) == 0:
+            print("Pack is up to date, nothing to write")
+            return True
 
-    if debugOutput:
-        absFilePath = PrepDebugDir(absProjectDir, "resources.bin")
-        # The binary data
-        # (the json offsets will be amongst the metadata)
-        with open(absFilePath, "wb") as f:
-            f.write(sect_allResources)
-        print("    DEBUG: Wrote {}".format(absFilePath))
+        try:
+            with open(absOutPath, "r+b", buffering=0) as outFile:
+                if rewriteHead:
+                    WriteAll(outFile, self.sect_header)
+                    WriteAll(outFile, self.sect_icon)
+                    WriteAll(outFile, self.sect_outMeta)
+                    WriteAll(outFile, self.sect_directory)
+                res = self.StreamResources(outFile, resStart, changedBlocks,
+                                           None, newCacheEntries)
+
+        except Exception as e:
+            print("The .vmupack was successfully built but the file could not be saved to {}".format(
+                absOutPath))
+            print("Please ensure that the file is not currently open!")
+            print("Exception: {}".format(e))
+            return False
 
-    return True
+        if res:
+            print("Patched {} of {} resource blocks{} in the existing pack".format(
+                len(changedBlocks), len(self.resourceBlocks),
+                " and the header/metadata" if rewriteHead else ""))
+
+        return res
+
+    def StreamResources(self, outFile, resStart, blocks, prevPackFile, newCacheEntries):
+        # type: (BinaryIO, int, List[Dict[str, Any]], Optional[BinaryIO], Dict[str, Any])->bool
+        """
+        Copy each block from disk into the pack and pad it out.
+        Cached blocks come from the previous pack if it's open,
+        everything else from the source or transformed file.
+        """
+
+        copyBuffer = bytearray(COPY_CHUNK_SIZE)
+        paddingBytes = bytes(512)
+
+        for block in blocks:
+
+            # Shares another block's data, nothing to write
+            if block["alias_of"] is not None:
+                if self.buildCache is not None:
+                    RecordResource(newCacheEntries, block)
+                continue
+
+            blockStart = resStart + block["offset"]
+            cached = block["cached"]
+            isCopied = False
+
+            if cached is not None and prevPackFile is not None:
+                outFile.seek(blockStart)
+                hasher = hashlib.sha1()
+                copied = CopyFileRange(prevPackFile, self.prevResourceOffset + cached["offset"],
+                                       outFile, block["size"], copyBuffer, hasher)
+                isCopied = copied == block["size"] and hasher.hexdigest() == block["sha1"]
+                if not isCopied:
+                    print("    Cached block for {} doesn't match, re-reading".format(block["path"]))
+
+            if not isCopied:
+                # already hashed at ingest, and most likely still in the OS cache
+                outFile.seek(blockStart)
+                try:
+                    with open(block["dataPath"], "rb", buffering=0) as srcFile:
+                        copied = CopyFileRange(srcFile, 0, outFile, block["size"],
+                                               copyBuffer, None)
+                except Exception as e:
+                    print("Failed to open file @ {}".format(block["dataPath"]))
+                    print("Exception: {}".format(e))
+                    return False
+
+                if copied != block["size"]:
+                    print("File @ {} changed size while packing ({} bytes, expected {})".format(
+                        block["dataPath"], copied, block["size"]))
+                    return False
+
+            WriteAll(outFile, paddingBytes[:block["padding"]])
+
+            if self.buildCache is not None:
+                RecordResource(newCacheEntries, block)
 
+        return True
+
+
+def GetOutputFilenameAbs(absProjectDir, appName):
+    # type: (str,str)->Path
+    absOutputVMUPack = os.path.join(
+        absProjectDir, appName + ".vmupack")
+    absOutputVMUPack = Path(absOutputVMUPack).resolve()
+    return absOutputVMUPack
+
+
+def ValidatePath(base, tail):
+    # type: (Union[str, Path], Union[str, Path]) -> str
+
+    joined = base / tail
+    resolved = Path.resolve(joined)
+
+    print("  Validating path: {}".format(resolved))
+
+    if not os.path.isfile(resolved):
+        raise PathException(
+            "projectdir ({}) + tail ({}) didn't form a valid absolute path!".format(base, tail))
+
+    return str(joined)
+
+
+def DeleteFileNoError(absPath, label):
+    # type: (Path, str)->None
+
+    try:
+        print("  Checking '{}' ...".format(absPath))
+        if os.path.isfile(absPath):
+            os.remove(absPath)
+        print("  deleted...")
 
-def ScanFolderRecursive(baseDir, folderPath):
-    # type: (Path, str) -> List[Tuple[str, Path]]
+    except Exception as e:
+        print("  Couldn't remove {} (non fatal error)".format(label))
+        print("  Exception: {}".format(e))
+
+
+def PrepDebugDir(absProjectDir, fileName):
+    # type (str, str)->str
+
+    absDebugDir = os.path.join(absProjectDir, "vmupacker_debug")
+    if not os.path.isdir(absDebugDir):
+        os.makedirs(absDebugDir)
+    absFilePath = os.path.join(absDebugDir, fileName)
+    return absFilePath
+
+
+def ReadLoadTrace(absTracePath, allFiles):
+    # type: (Path, List[Tuple[str, Path]]) -> Optional[List[str]]
+    """
+    Read a load-order trace: one path per line as the app requested it,
+    with or without the extension (e.g. "sprites/level1/warrior_front").
+    Blank lines and lines starting with # are skipped.
+    Returns the resource paths in load order, repeats included.
+    """
+
+    print("    Reading load trace {}".format(absTracePath))
+
+    try:
+        with open(absTracePath, "r") as f:
+            lines = f.read().splitlines()
+    except Exception as e:
+        print("Failed to read load trace {}: {}".format(absTracePath, e))
+        return None
+
+    # Match on the full path, or on the path without its extension;
+    # where two files only differ by extension the first listed wins
+    byPath = {}
+    for relativePath, _ in allFiles:
+        byPath.setdefault(relativePath, relativePath)
+        byPath.setdefault(os.path.splitext(relativePath)[0], relativePath)
+
+    trace = []
+    unmatched = []
+    for line in lines:
+        name = line.strip().replace('\\', '/')
+        if name.startswith("./"):
+            name = name[2:]
+        name = name.lstrip("/")
+        if not name or name.startswith("#"):
+            continue
+        if name in byPath:
+            trace.append(byPath[name])
+        else:
+            unmatched.append(name)
+
+    print("      {} loads, {} of {} resources traced".format(
+        len(trace), len(set(trace)), len(allFiles)))
+    if unmatched:
+        print("      Ignoring {} traced paths that aren't resources, e.g. {}".format(
+            len(unmatched), ", ".join(unmatched[:3])))
+
+    return trace
+
+
+def OrderByLoadTrace(allFiles, loadTrace):
+    # type: (List[Tuple[str, Path]], List[str]) -> List[Tuple[str, Path]]
+    """
+    Traced resources first, in the order they were first loaded,
+    then the rest in metadata order
+    """
+
+    firstLoad = {}
+    for i, relativePath in enumerate(loadTrace):
+        firstLoad.setdefault(relativePath, i)
+
+    traced = sorted((f for f in allFiles if f[0] in firstLoad), key=lambda f: firstLoad[f[0]])
+    untraced = [f for f in allFiles if f[0] not in firstLoad]
+    return traced + untraced
+
+
+def PadLastBlock(lastBlock, lastFileInfo, numBytes):
+    # type: (Dict[str, Any], Dict[str, Any], int) -> None
+    """
+    Grow the padding after the previous file so the next one
+    (or the next section) starts on the boundary it needs
+    """
+
+    lastBlock["padding"] += numBytes
+    lastFileInfo["padded_size"] += numBytes
+
+
+def MakeResourceBlock(info, offset, padding, aliasOf):
+    # type: (Dict[str, Any], int, int, Optional[str]) -> Dict[str, Any]
+    """
+    Everything the writer needs to stream one resource into the pack
+    """
+
+    return {
+        "path": info["path"],
+        # file the stored data is streamed from
+        "dataPath": info["dataPath"],
+        "stamp": info["stamp"],
+        "offset": offset,
+        "size": info["size"],
+        "padding": padding,
+        "sha1": info["sha1"],
+        "source_sha1": info["source_sha1"],
+        "transform": info["transform"],
+        "fields": info["fields"],
+        "report": info["report"],
+        "cached": info["cached"],
+        "alias_of": aliasOf,
+    }
+
+
+def HashFile(absPath, readBuffer):
+    # type: (Path, bytearray) -> str
+
+    hasher = hashlib.sha1()
+    view = memoryview(readBuffer)
+    with open(absPath, "rb", buffering=0) as f:
+        while True:
+            numRead = f.readinto(readBuffer)
+            if not numRead:
+                break
+            hasher.update(view[:numRead])
+
+    return hasher.hexdigest()
+
+
+def ScanFolderRecursive(baseDir, folderPath, printDetail):
+    # type: (Path, str, Callable[[str], None]) -> List[Tuple[str, Path]]
     """
     Recursively scan a folder and return all files with their relative paths
     Returns list of (relative_path, absolute_path) tuples
+    Progress goes through printDetail so the caller can silence it
     """
 
     files = []
     absFolderPath = baseDir / folderPath
     absFolderPath = Path(absFolderPath).resolve()
 
-    print("        Scanning folder: {}".format(absFolderPath))
+    printDetail("        Scanning folder: {}".format(absFolderPath))
 
-    try:
-        for root, _, filenames in os.walk(absFolderPath):
-            for filename in filenames:
-                absFilePath = Path(root) / filename
-
-                # Calculate relative path from base project directory
-                relativeFromBase = absFilePath.relative_to(baseDir.resolve())
-                relativePath = str(relativeFromBase).replace('\\', '/')  # Normalize path separators
+    for root, _, filenames in os.walk(absFolderPath):
+        for filename in filenames:
+            absFilePath = Path(root) / filename
 
-                files.append((relativePath, absFilePath))
-                print("          Found: {}".format(relativePath))
+            # Calculate relative path from base project directory
+            relativeFromBase = absFilePath.relative_to(baseDir.resolve())
+            relativePath = str(relativeFromBase).replace('\\', '/')  # Normalize path separators
 
-    except Exception as e:
-        print("        Error scanning folder {}: {}".format(absFolderPath, e))
+            files.append((relativePath, absFilePath))
+            printDetail("          Found: {}".format(relativePath))
 
     return files
 
-# Placeholder for now
-# 00-04: reserved0
-# 04-08: reserved1
-# 08-0C: reserved2
-# 0C-0F: reserved3
-def AddBinding():
-    # type: () -> bool
-
-    global sect_binding
-
-    print("  Adding dummy binding")
-
-    sect_binding = bytearray(16)
-
-    return True
 
 # Pad a byte array to e.g. 512 bytes for
 # faster loading from SD card, or header alignment
@@ -643,234 +2433,84 @@ def AddBinding():
 def PadByteArray(inArray, boundary):
     # type: (bytearray, int)->int
 
-    modulo = len(inArray) % boundary
-    if (modulo != 0):
-        paddingLen = boundary - modulo
+    paddingLen = GetPaddingLength(len(inArray), boundary)
+    if (paddingLen != 0):
         paddingBytes = bytearray(paddingLen)
         inArray.extend(paddingBytes)
-        return paddingLen
 
-    return 0
+    return paddingLen
 
 
-def PrintSectionSizes(printVal):
-    # type: (str)->None
-
-    global debugOutput
-    global sect_header
-    global sect_icon
-    global sect_outMeta
-    global sect_binding
-
-    if not debugOutput:
-        return
-
-    print(printVal)
-    print("  Header   : {} / {}".format(len(sect_header), hex(len(sect_header))))
-    print("  Icon     : {} / {}".format(len(sect_icon), hex(len(sect_icon))))
-    print("  MetaData : {} / {}".format(len(sect_outMeta), hex(len(sect_outMeta))))
-    print("  Binding  : {} / {}".format(len(sect_binding), hex(len(sect_binding))))
-    print("  LUA Resources : {} / {}".format(len(sect_allResources), hex(len(sect_allResources))))
-
-    # 00-08: uint8_t magic[8] = "VMUPACK\0"
-    # 08-0C: uint8_t vmuPackVersion = 1
-    #        uint8_t targetDevice = 0
-    #        uint8_t productBindingVersion
-    #        uint8_t deviceBindingVersion
-    # 0C-10: uint8_t sdkVersionMajor
-    #        uint8_t sdkVersionMinor
-    #        uint8_t sdkVersionPatch
-    #        uint8_t reserved
-    #
-    # 10-30: uint8_t appName[32] = "My awesome app\0"
-    #
-    # 30-34: uint32_t appMode        # 1= applet, 2= fullscreen
-    # 34-38: uint32_t appEnv         # 0 = native, 1 = LUA
-    # 38-38: uint32_t reserved
-    # 3C-40: uint32_t fileSizeBytesMinusSignature    # aka SignaturePos
-    #
-    # 40-44: uint32_t iconOffset
-    # 44-48: uint32_t iconLength
-    #
-    # 48-4C: uint32_t metadataOffset
-    # 4C-50: uint32_t metadataLength
-    #
-    # 50-54: uint32_t resourceOffset
-    # 54-58: uint32_t resourceLength
-    #
-    # 58-5C: uint32_t bindingOffset
-    # 5C-60: uint32_t bindingLength
-    #
-    # 60-64: uint32_t elfOffset
-    # 64-68: uint32_t elfLength
-    #
-    # 68-78: uint32_t reserved[4]
-    #
-    # padded to 512 bytes
+def GetPaddingLength(length, boundary):
+    # type: (int, int)->int
 
-# adds to the header in the final binary
-# not the header stub
-def AddToArray(targ, pos, val):
-    # type: (bytearray, int,int)->int
+    modulo = length % boundary
+    if (modulo != 0):
+        return boundary - modulo
 
-    global finalBinary
+    return 0
 
-    bVal = struct.pack("<I", val)
-    targ[pos:pos+4] = bVal
 
-    return 4
+def WriteAll(outFile, data):
+    # type: (BinaryIO, Union[bytes, memoryview])->None
+    """
+    Unbuffered writes may be partial, keep going till it's all out
+    """
 
+    view = memoryview(data)
+    while len(view) > 0:
+        written = outFile.write(view)
+        view = view[written:]
 
-def CreateHeader(absProjectDir, appName, sdkVersion):
-    # type: (str, str, Tuple[int, int, int]) -> bool
-    #
-    global sect_header
-    global sect_icon
-    global sect_outMeta
-    global sect_binding
-    global sect_allResources
-    #
-    global finalBinary
-
-    # 0-8: magic
-    magic = b"VMUPACK\0"
-    sect_header.extend(magic)
-
-    # Add the values we know immediately
-
-    # 8-C: version, targ device,
-    vmuPackVersion = 1
-    sect_header.extend(vmuPackVersion.to_bytes(1, 'little'))
-    targDevice = 0
-    sect_header.extend(targDevice.to_bytes(1,'little'))
-    prodBindingVersion = 0
-    sect_header.extend(prodBindingVersion.to_bytes(1,'little'))
-    devBindingversion = 0
-    sect_header.extend(devBindingversion.to_bytes(1,'little'))
-
-    # C-10: SDK version (major.minor.patch) + 1 reserved byte
-    print("  Writing SDK version {}.{}.{} to header".format(
-        sdkVersion[0], sdkVersion[1], sdkVersion[2]))
-    sect_header.extend(sdkVersion[0].to_bytes(1, 'little'))  # Major
-    sect_header.extend(sdkVersion[1].to_bytes(1, 'little'))  # Minor
-    sect_header.extend(sdkVersion[2].to_bytes(1, 'little'))  # Patch
-    sect_header.extend((0).to_bytes(1, 'little'))            # Reserved
-
-    # 10-30 - mini header identifier
-    appNameHeader = outMetaJSON["app_name"]
-    appNameHeader = bytearray(appNameHeader, "ascii")
-    # clamp it at 31 chars
-    if (len(appNameHeader) > 31):
-        appNameHeader = appNameHeader[:31]
-    # pad it to exactly 32 chars
-    PadByteArray(appNameHeader, 32)
-    sect_header.extend(appNameHeader)
-
-    # 30-34 - app mode
-    # 0 = AUTO (not applicable for ext apps)
-    # 1 = APPLET (WIP)
-    # 2 = FULLSCREEN
-    # 3 = EXCLUSIVE (not applicable)
-    # Pick 2 for now!
-    appMode = outMetaJSON["app_mode"]
-    modePacked = struct.pack("<I", appMode)
-    sect_header.extend(modePacked)
-
-    # 34-38 app env
-    envStr = outMetaJSON["app_environment"]
-    envVal = 0
-    if envStr == "native":
-        envVal = 0
-    elif envStr == "lua":
-        envVal = 1
-    else:
-        envVal = 0xFFFFFFFF
-    envPacked = struct.pack("<I", envVal)
-    sect_header.extend(envPacked)
-
-    # 2 reserved fields
-    # then we'll start adding the other sections
-    res1Packed = struct.pack("<I", 0)
-    res2Packed = struct.pack("<I", 0)
-    sect_header.extend(res1Packed)
-    sect_header.extend(res2Packed)
-
-    headerFieldPos = len(sect_header)
-    print("Continuing header from offset {}".format(headerFieldPos))
 
-    #
-    # Pad out some byte arrays and then let's start piecing them together
-    #
+def CopyFileRange(srcFile, srcOffset, outFile, length, copyBuffer, hasher):
+    # type: (BinaryIO, int, BinaryIO, int, bytearray, Any)->int
+    """
+    Copy length bytes from srcFile @ srcOffset to the current position
+    of outFile (both unbuffered) holding at most one buffer in memory.
+    Uses sendfile on linux unless the data also needs hashing.
+    Returns the number of bytes copied, short if the source ran out.
+    """
 
-    PrintSectionSizes("Section sizes:")
-    PadByteArray(sect_header, 512)
-    PadByteArray(sect_icon, 512)
-    PadByteArray(sect_outMeta, 512)
-    PadByteArray(sect_binding, 512)
-    PadByteArray(sect_allResources, 512)
-    PrintSectionSizes("Padded section sizes:")
+    copied = 0
 
-    #
-    # Write Header int the final binary
-    # Update header fields as we append new sections
-    #
+    if hasher is None and sys.platform.startswith("linux"):
+        try:
+            while copied < length:
+                sent = os.sendfile(outFile.fileno(), srcFile.fileno(),
+                                   srcOffset + copied, length - copied)
+                if sent == 0:
+                    break
+                copied += sent
+            return copied
+        except OSError:
+            # not supported for this pair of files, fall back to
+            # plain reads from wherever we got to
+            pass
+
+    view = memoryview(copyBuffer)
+    srcFile.seek(srcOffset + copied)
+    while copied < length:
+        numRead = srcFile.readinto(view[:min(len(view), length - copied)])
+        if not numRead:
+            break
+        if hasher is not None:
+            hasher.update(view[:numRead])
+        WriteAll(outFile, view[:numRead])
+        copied += numRead
+
+    return copied
 
-    finalBinary.extend(sect_header)
-    
-    iconStart = len(finalBinary)
-    headerFieldPos += AddToArray(finalBinary, headerFieldPos, iconStart)
-    headerFieldPos += AddToArray(finalBinary, headerFieldPos, len(sect_icon))
-    finalBinary.extend(sect_icon)
-    print("  Wrote icon at pos {} size {}".format(
-        hex(iconStart), hex(len(sect_icon))))
-
-    metaStart = len(finalBinary)
-    headerFieldPos += AddToArray(finalBinary, headerFieldPos, metaStart)
-    headerFieldPos += AddToArray(finalBinary,
-                                 headerFieldPos, len(sect_outMeta))
-    finalBinary.extend(sect_outMeta)
-    print("  Wrote metadata at pos {} size {}".format(
-        hex(metaStart), hex(len(sect_outMeta))))
-
-    resStart = len(finalBinary)
-    headerFieldPos += AddToArray(finalBinary, headerFieldPos, resStart)
-    headerFieldPos += AddToArray(finalBinary,
-                                 headerFieldPos, len(sect_allResources))
-    finalBinary.extend(sect_allResources)
-    print("  Wrote LUA resources at pos {} size {}".format(
-        hex(resStart), hex(len(sect_allResources))))
-
-    bindingStart = len(finalBinary)
-    headerFieldPos += AddToArray(finalBinary, headerFieldPos, bindingStart)
-    headerFieldPos += AddToArray(finalBinary,
-                                 headerFieldPos, len(sect_binding))
-    finalBinary.extend(sect_binding)
-    print("  Wrote binding at pos {} size {}".format(
-        hex(bindingStart), hex(len(sect_binding))))
-
-    # For LUA apps, we don't have ELF data, so write empty section
-    luaStart = len(finalBinary)
-    headerFieldPos += AddToArray(finalBinary, headerFieldPos, luaStart)
-    headerFieldPos += AddToArray(finalBinary, headerFieldPos, 0)  # Zero length
-    print("  Wrote LUA section (empty) at pos {} size 0".format(hex(luaStart)))
-
-    sect_finalBinarySize = len(finalBinary)
-    print("Final binary size: {} / {}".format(
-        sect_finalBinarySize, hex(sect_finalBinarySize)))
-
-    absOutPath = GetOutputFilenameAbs(absProjectDir, appName)
-    try:
-        with open(absOutPath, "wb") as f:
-            f.write(finalBinary)
-    except Exception as e:
-        print("The .vmupack was successfully built but the file could not be saved to {}".format(
-            absOutPath))
-        print("Please ensure that the file is not currently open!")
-        return False
 
-    print("Write file to: {}".format(absOutPath))
+# adds to the header in the final binary
+# not the header stub
+def AddToArray(targ, pos, val):
+    # type: (bytearray, int,int)->int
 
-    return True
+    bVal = struct.pack("<I", val)
+    targ[pos:pos+4] = bVal
+
+    return 4
 
 
 if __name__ == "__main__":
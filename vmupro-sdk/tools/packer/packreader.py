@@ -0,0 +1,629 @@
+# 8BM Copyright/License notice
+# Reader, checker and extractor for built .vmupack files
+#
+# The pack is memory-mapped rather than read in, so listing, checking or
+# pulling one resource out of a large pack only touches the pages involved:
+# the header, the metadata JSON and the bytes of that resource.
+#
+# The header layout is the one written by the packer (see
+# VmuPackBuilder.PrintSectionSizes in packer.py); resource offsets come from
+# the metadata's resource_index and are relative to the resource section.
+#
+# Usage:
+#   python3 packreader.py info my_app.vmupack
+#   python3 packreader.py list my_app.vmupack --json index.json
+#   python3 packreader.py verify my_app.vmupack
+#   python3 packreader.py extract my_app.vmupack sprites/knight.png --out knight.png --decode
+#   python3 packreader.py extract my_app.vmupack --all --out unpacked
+#   python3 packreader.py diff old.vmupack new.vmupack
+#
+# verify exits with 1 if it finds a problem, diff if the packs differ,
+# so either can gate a CI job.
+
+import sys
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+from typing import Any, Dict, List, Optional, Tuple
+
+from compression import CODECS, DecompressBytes
+from directory import (DIRECTORY_MAGIC, DIRECTORY_SLOT_SIZE, FLAG_USED,
+                       GetEntryFlags, HashPath)
+
+
+PACK_MAGIC = b"VMUPACK\0"
+
+SECTOR_SIZE = 512
+
+HEADER_SIZE = 0x78
+
+ICON_HEADER_SIZE = 32
+
+# resources are hashed and extracted this many bytes at a time
+READ_CHUNK_SIZE = 1024 * 1024
+
+# section name -> header field offset of its (offset, length) pair,
+# in the order they appear in the pack
+SECTION_FIELDS = [
+    ("icon", 0x40),
+    ("metadata", 0x48),
+    ("directory", 0x68),
+    ("resources", 0x50),
+    ("binding", 0x58),
+]
+
+
+class PackFormatError(Exception):
+    pass
+
+
+class VmuPackReader:
+    """
+    A memory-mapped .vmupack. The header and metadata are parsed when it's
+    opened, resources are only read when asked for.
+
+        with VmuPackReader("my_app.vmupack") as pack:
+            for entry in pack.resourceIndex:
+                print(entry["path"], entry["size"])
+            data = pack.ReadResource("app.lua", decode=True)
+    """
+
+    def __init__(self, path):
+        # type: (str) -> None
+
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            self.size = os.fstat(self.file.fileno()).st_size
+            if self.size < HEADER_SIZE:
+                raise PackFormatError("{} is too small to be a .vmupack ({} bytes)".format(path, self.size))
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.file.close()
+            raise
+
+        try:
+            self.header = self.ReadHeader()
+            self.sections = self.header["sections"]
+            self.meta = self.ReadMetadata()
+        except Exception:
+            self.Close()
+            raise
+
+        self.resourceIndex = self.meta.get("resource_index") or []
+        self.entriesByPath = {entry.get("path"): entry for entry in self.resourceIndex}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.Close()
+
+    def Close(self):
+        # type: () -> None
+
+        self.data.close()
+        self.file.close()
+
+    def ReadHeader(self):
+        # type: () -> Dict[str, Any]
+
+        if self.data[0:8] != PACK_MAGIC:
+            raise PackFormatError("{} isn't a .vmupack (bad magic {!r})".format(self.path, self.data[0:8]))
+
+        appName = self.data[0x10:0x30].split(b"\0", 1)[0].decode("ascii", errors="replace")
+        appMode, appEnv = struct.unpack_from("<II", self.data, 0x30)
+
+        sections = {"header": (0, SECTOR_SIZE)}
+        for name, fieldPos in SECTION_FIELDS:
+            sections[name] = struct.unpack_from("<II", self.data, fieldPos)
+
+        return {
+            "version": self.data[8],
+            "target_device": self.data[9],
+            "product_binding_version": self.data[10],
+            "device_binding_version": self.data[11],
+            "sdk_version": "{}.{}.{}".format(self.data[12], self.data[13], self.data[14]),
+            "app_name": appName,
+            "app_mode": appMode,
+            "app_environment": {0: "native", 1: "lua"}.get(appEnv, hex(appEnv)),
+            "elf": struct.unpack_from("<II", self.data, 0x60),
+            "sections": sections,
+        }
+
+    def ReadMetadata(self):
+        # type: () -> Dict[str, Any]
+
+        offset, length = self.sections["metadata"]
+        if offset + length > self.size:
+            raise PackFormatError("Metadata section ({} + {}) runs past the end of the file ({})".format(
+                offset, length, self.size))
+
+        # the JSON is padded out with zeros to a whole sector
+        text = self.data[offset:offset + length].rstrip(b"\0")
+        try:
+            meta = json.loads(text.decode("utf-8"))
+        except Exception as e:
+            raise PackFormatError("Metadata section isn't valid JSON: {}".format(e))
+
+        if not isinstance(meta, dict):
+            raise PackFormatError("Metadata section isn't a JSON object")
+
+        return meta
+
+    def FindResource(self, path):
+        # type: (str) -> Optional[Dict[str, Any]]
+
+        return self.entriesByPath.get(path)
+
+    def GetResourceRange(self, entry):
+        # type: (Dict[str, Any]) -> Tuple[int, int]
+        """
+        Absolute (offset, length) of a resource's stored data in the pack
+        """
+
+        return self.sections["resources"][0] + entry["offset"], entry["size"]
+
+    def ReadResource(self, pathOrEntry, decode=False):
+        # type: (Any, bool) -> bytes
+        """
+        The resource's data as stored, or decompressed if decode
+        is set and it has a codec. Only that resource is read.
+        """
+
+        entry = pathOrEntry
+        if not isinstance(entry, dict):
+            entry = self.FindResource(pathOrEntry)
+            if entry is None:
+                raise KeyError("No resource {} in {}".format(pathOrEntry, self.path))
+
+        offset, length = self.GetResourceRange(entry)
+        data = self.data[offset:offset + length]
+
+        if decode and "codec" in entry:
+            data = DecompressBytes(entry["codec"], data)
+
+        return data
+
+    def HashResource(self, entry):
+        # type: (Dict[str, Any]) -> str
+        """
+        sha1 of the stored data, read a chunk at a time
+        """
+
+        offset, length = self.GetResourceRange(entry)
+        hasher = hashlib.sha1()
+        for pos in range(offset, offset + length, READ_CHUNK_SIZE):
+            hasher.update(self.data[pos:min(pos + READ_CHUNK_SIZE, offset + length)])
+
+        return hasher.hexdigest()
+
+    def ExtractResource(self, entry, absDstPath, decode=False):
+        # type: (Dict[str, Any], str, bool) -> int
+        """
+        Write one resource to a file. Returns the number of bytes written.
+        """
+
+        dstDir = os.path.dirname(absDstPath)
+        if dstDir and not os.path.isdir(dstDir):
+            os.makedirs(dstDir)
+
+        if decode and "codec" in entry:
+            data = self.ReadResource(entry, decode=True)
+            with open(absDstPath, "wb") as f:
+                f.write(data)
+            return len(data)
+
+        offset, length = self.GetResourceRange(entry)
+        with open(absDstPath, "wb") as f:
+            for pos in range(offset, offset + length, READ_CHUNK_SIZE):
+                f.write(self.data[pos:min(pos + READ_CHUNK_SIZE, offset + length)])
+
+        return length
+
+    def Verify(self, decode=True):
+        # type: (bool) -> List[str]
+        """
+        Check the pack's layout. Returns a list of problems, empty if
+        there are none. With decode, compressed resources are also
+        decompressed and checked against their original_size.
+        """
+
+        problems = []
+        problems.extend(self.VerifySections())
+
+        resOffset, resLength = self.sections["resources"]
+        if resOffset + resLength > self.size:
+            # nothing below can be trusted
+            return problems
+
+        problems.extend(self.VerifyResources(decode))
+
+        if self.sections["directory"][1] > 0:
+            problems.extend(self.VerifyDirectory())
+
+        return problems
+
+    def VerifySections(self):
+        # type: () -> List[str]
+
+        problems = []
+
+        if self.header["version"] != 1:
+            problems.append("Unknown pack version {}".format(self.header["version"]))
+
+        end = SECTOR_SIZE
+        for name, _ in SECTION_FIELDS:
+            offset, length = self.sections[name]
+            if name == "directory" and offset == 0 and length == 0:
+                continue
+            if offset % SECTOR_SIZE != 0:
+                problems.append("{} section offset {} isn't sector aligned".format(name, hex(offset)))
+            if length % SECTOR_SIZE != 0:
+                problems.append("{} section length {} isn't a whole number of sectors".format(name, hex(length)))
+            if offset < end:
+                problems.append("{} section at {} overlaps the section before it (which ends at {})".format(
+                    name, hex(offset), hex(end)))
+            if offset + length > self.size:
+                problems.append("{} section ({} + {}) runs past the end of the file ({})".format(
+                    name, hex(offset), hex(length), hex(self.size)))
+            end = offset + length
+
+        # the empty ELF section marks the end of the pack
+        elfOffset, elfLength = self.header["elf"]
+        if elfLength != 0 or elfOffset != end:
+            problems.append("ELF section ({} + {}) should be empty and at the end of the pack ({})".format(
+                hex(elfOffset), hex(elfLength), hex(end)))
+        if self.size != end:
+            problems.append("File is {} bytes but its sections end at {}".format(self.size, end))
+
+        iconOffset, iconLength = self.sections["icon"]
+        if iconLength >= ICON_HEADER_SIZE and iconOffset + iconLength <= self.size:
+            magic = self.data[iconOffset:iconOffset + 4]
+            width, height = struct.unpack_from("<II", self.data, iconOffset + 16)
+            if magic != b"ICON":
+                problems.append("Icon section doesn't start with 'ICON'")
+            elif ICON_HEADER_SIZE + width * height * 2 > iconLength:
+                problems.append("{}x{} icon doesn't fit its section".format(width, height))
+
+        return problems
+
+    def VerifyResources(self, decode):
+        # type: (bool) -> List[str]
+
+        problems = []
+        _, resLength = self.sections["resources"]
+
+        if not isinstance(self.meta.get("resource_index"), list):
+            return ["Metadata has no resource_index"]
+
+        # blocks that own their data, aliases point into one of them
+        blocks = {}
+        for entry in self.resourceIndex:
+            path = entry.get("path")
+            if not all(isinstance(entry.get(k), int) for k in ("offset", "size", "padded_size")):
+                problems.append("{}: missing offset, size or padded_size".format(path))
+                continue
+
+            offset = entry["offset"]
+            size = entry["size"]
+            paddedSize = entry["padded_size"]
+
+            if size > paddedSize:
+                problems.append("{}: size {} is larger than padded_size {}".format(path, size, paddedSize))
+            if offset < 0 or offset + paddedSize > resLength:
+                problems.append("{}: {} + {} is outside the resource section ({} bytes)".format(
+                    path, offset, paddedSize, resLength))
+                continue
+
+            # a resource never spans more sectors than its size needs
+            sectorsUsed = (offset + size + SECTOR_SIZE - 1) // SECTOR_SIZE - offset // SECTOR_SIZE
+            if size > 0 and sectorsUsed > (size + SECTOR_SIZE - 1) // SECTOR_SIZE:
+                problems.append("{}: at {} it spans {} sectors instead of {}".format(
+                    path, hex(offset), sectorsUsed, (size + SECTOR_SIZE - 1) // SECTOR_SIZE))
+
+            if "stream" in entry:
+                problems.extend(self.VerifyStream(entry))
+
+            if "alias_of" in entry:
+                continue
+            if offset in blocks:
+                problems.append("{}: shares offset {} with {} without being an alias".format(
+                    path, hex(offset), blocks[offset]["path"]))
+                continue
+            blocks[offset] = entry
+
+            if decode and "codec" in entry:
+                if entry["codec"] not in CODECS:
+                    problems.append("{}: unknown codec {}".format(path, entry["codec"]))
+                    continue
+                try:
+                    decodedSize = len(self.ReadResource(entry, decode=True))
+                except Exception as e:
+                    problems.append("{}: failed to decompress: {}".format(path, e))
+                    continue
+                if decodedSize != entry.get("original_size"):
+                    problems.append("{}: decompresses to {} bytes, original_size is {}".format(
+                        path, decodedSize, entry.get("original_size")))
+
+        for entry in self.resourceIndex:
+            if "alias_of" not in entry:
+                continue
+            target = self.FindResource(entry["alias_of"])
+            if target is None or "alias_of" in target:
+                problems.append("{}: alias of {}, which isn't a resource with its own data".format(
+                    entry.get("path"), entry["alias_of"]))
+            elif (target["offset"], target["size"]) != (entry.get("offset"), entry.get("size")):
+                problems.append("{}: alias of {} but at a different offset or size".format(
+                    entry.get("path"), entry["alias_of"]))
+
+        # the blocks and their padding should cover the section exactly
+        end = 0
+        for offset in sorted(blocks):
+            entry = blocks[offset]
+            if offset < end:
+                problems.append("{}: starts at {}, inside the resource before it (which ends at {})".format(
+                    entry["path"], hex(offset), hex(end)))
+            elif offset > end:
+                problems.append("{}: {} bytes unaccounted for before it".format(entry["path"], offset - end))
+            end = max(end, offset + entry["padded_size"])
+        if blocks and end != resLength:
+            problems.append("Resources end at {} but the resource section is {} bytes".format(end, resLength))
+
+        return problems
+
+    def VerifyStream(self, entry):
+        # type: (Dict[str, Any]) -> List[str]
+
+        problems = []
+        path = entry["path"]
+        stream = entry["stream"]
+
+        if entry["offset"] % SECTOR_SIZE != 0:
+            problems.append("{}: streamed track at {} isn't sector aligned".format(path, hex(entry["offset"])))
+
+        for chunkOffset, _ in stream.get("chunks", []):
+            if chunkOffset % SECTOR_SIZE != 0 or chunkOffset >= entry["size"]:
+                problems.append("{}: stream chunk at {} isn't sector aligned within the track".format(
+                    path, chunkOffset))
+                break
+
+        return problems
+
+    def VerifyDirectory(self):
+        # type: () -> List[str]
+
+        problems = []
+        dirOffset, dirLength = self.sections["directory"]
+        section = self.data[dirOffset:dirOffset + dirLength]
+
+        if section[0:4] != DIRECTORY_MAGIC:
+            return ["Directory section doesn't start with {!r}".format(DIRECTORY_MAGIC)]
+
+        numEntries, numSlots, _, slotTableOffset, namesOffset, namesLength = struct.unpack_from(
+            "<6I", section, 8)
+        if namesOffset + namesLength > dirLength or slotTableOffset + numSlots * DIRECTORY_SLOT_SIZE > namesOffset:
+            return ["Directory slot table or names run past the end of its section"]
+        if numEntries != len(self.resourceIndex):
+            problems.append("Directory has {} entries, resource_index has {}".format(
+                numEntries, len(self.resourceIndex)))
+        if numSlots == 0 or numSlots & (numSlots - 1) != 0:
+            return problems + ["Directory slot count {} isn't a power of 2".format(numSlots)]
+
+        for entry in self.resourceIndex:
+            path = entry.get("path")
+            pathHash = HashPath(path)
+            slot = pathHash & (numSlots - 1)
+            found = None
+            for _ in range(numSlots):
+                pos = slotTableOffset + slot * DIRECTORY_SLOT_SIZE
+                slotHash, nameOffset, offset, size, flags = struct.unpack_from("<5I", section, pos)
+                if flags == 0:
+                    break
+                if slotHash == pathHash and flags & FLAG_USED:
+                    nameStart = namesOffset + nameOffset
+                    nameEnd = section.find(b"\0", nameStart, namesOffset + namesLength)
+                    if nameEnd >= 0 and section[nameStart:nameEnd].decode("utf-8", errors="replace") == path:
+                        found = (offset, size, flags)
+                        break
+                slot = (slot + 1) & (numSlots - 1)
+
+            if found is None:
+                problems.append("{}: not found in the directory".format(path))
+            elif found != (entry.get("offset"), entry.get("size"), GetEntryFlags(entry)):
+                problems.append("{}: directory has offset {}, size {}, flags {}, resource_index {}, {}, {}".format(
+                    path, found[0], found[1], found[2], entry.get("offset"), entry.get("size"),
+                    GetEntryFlags(entry)))
+
+        return problems
+
+
+def PrintInfo(pack):
+    # type: (VmuPackReader) -> None
+
+    header = pack.header
+    print("{}: {:,} bytes".format(pack.path, pack.size))
+    print("  App name   : {}".format(header["app_name"]))
+    print("  App mode   : {}, environment {}".format(header["app_mode"], header["app_environment"]))
+    print("  SDK version: {}, pack version {}".format(header["sdk_version"], header["version"]))
+    for key in ("app_author", "app_version", "app_entry_point"):
+        if key in pack.meta:
+            print("  {:<11}: {}".format(key, pack.meta[key]))
+
+    print("  Sections:")
+    for name in ["header"] + [name for name, _ in SECTION_FIELDS]:
+        offset, length = pack.sections[name]
+        print("    {:<10} {:>10} {:>12,} bytes".format(name, hex(offset), length))
+
+    numAliases = sum(1 for e in pack.resourceIndex if "alias_of" in e)
+    numCompressed = sum(1 for e in pack.resourceIndex if "codec" in e)
+    numConverted = sum(1 for e in pack.resourceIndex if "format" in e)
+    storedBytes = sum(e["size"] for e in pack.resourceIndex if "alias_of" not in e)
+    paddingBytes = sum(e["padded_size"] - e["size"] for e in pack.resourceIndex if "alias_of" not in e)
+    print("  Resources  : {} ({} aliases, {} compressed, {} converted)".format(
+        len(pack.resourceIndex), numAliases, numCompressed, numConverted))
+    print("  Stored     : {:,} bytes + {:,} bytes padding".format(storedBytes, paddingBytes))
+
+
+def PrintList(pack):
+    # type: (VmuPackReader) -> None
+
+    print("{:>10} {:>10} {:>10}  {:<24} {}".format("offset", "size", "padded", "notes", "path"))
+    for entry in pack.resourceIndex:
+        notes = []
+        if "codec" in entry:
+            notes.append("{} {:,}".format(entry["codec"], entry.get("original_size", 0)))
+        if "format" in entry:
+            notes.append(entry["format"])
+        if "stream" in entry:
+            notes.append("stream")
+        if "alias_of" in entry:
+            notes.append("alias")
+        print("{:>10} {:>10,} {:>10,}  {:<24} {}".format(
+            hex(entry["offset"]), entry["size"], entry["padded_size"], ", ".join(notes), entry["path"]))
+
+
+def DiffPacks(oldPack, newPack):
+    # type: (VmuPackReader, VmuPackReader) -> bool
+    """
+    Print what changed between two packs. Returns True if anything did.
+    Resources of the same size are compared by content.
+    """
+
+    changed = False
+
+    for name in ["header"] + [name for name, _ in SECTION_FIELDS]:
+        oldLength = oldPack.sections[name][1]
+        newLength = newPack.sections[name][1]
+        if oldLength != newLength:
+            print("  {} section: {:,} -> {:,} bytes ({:+,})".format(name, oldLength, newLength, newLength - oldLength))
+            changed = True
+
+    for path in sorted(set(oldPack.entriesByPath) | set(newPack.entriesByPath)):
+        oldEntry = oldPack.FindResource(path)
+        newEntry = newPack.FindResource(path)
+        if oldEntry is None:
+            print("  + {} ({:,} bytes)".format(path, newEntry["size"]))
+        elif newEntry is None:
+            print("  - {} ({:,} bytes)".format(path, oldEntry["size"]))
+        elif oldEntry["size"] != newEntry["size"]:
+            print("  M {} ({:,} -> {:,} bytes)".format(path, oldEntry["size"], newEntry["size"]))
+        elif oldPack.HashResource(oldEntry) != newPack.HashResource(newEntry):
+            print("  M {} (same size, different content)".format(path))
+        else:
+            continue
+        changed = True
+
+    if not changed:
+        print("  Packs have the same sections and resources")
+
+    return changed
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Inspect, verify and extract resources from a built .vmupack")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    infoParser = subparsers.add_parser("info", help="Print the header, sections and resource totals")
+    infoParser.add_argument("pack")
+
+    listParser = subparsers.add_parser("list", help="List every resource")
+    listParser.add_argument("pack")
+    listParser.add_argument("--json", required=False,
+                            help="Also write the header, sections and resource_index to this JSON file")
+
+    verifyParser = subparsers.add_parser("verify", help="Check every offset and length, exit 1 on a problem")
+    verifyParser.add_argument("pack", nargs="+")
+    verifyParser.add_argument("--no-decode", action="store_true", required=False, default=False,
+                              help="Don't decompress compressed resources to check their size")
+
+    extractParser = subparsers.add_parser("extract", help="Write resources out to files")
+    extractParser.add_argument("pack")
+    extractParser.add_argument("paths", nargs="*", help="Resource paths as in resource_index")
+    extractParser.add_argument("--all", action="store_true", required=False, default=False,
+                               help="Extract every resource")
+    extractParser.add_argument("--out", required=False, default=".",
+                               help="Output folder, or file name when extracting a single resource")
+    extractParser.add_argument("--decode", action="store_true", required=False, default=False,
+                               help="Decompress compressed resources")
+
+    diffParser = subparsers.add_parser("diff", help="Compare the sections and resources of two packs, exit 1 if they differ")
+    diffParser.add_argument("old")
+    diffParser.add_argument("new")
+
+    args = parser.parse_args()
+
+    try:
+        if args.command == "info":
+            with VmuPackReader(args.pack) as pack:
+                PrintInfo(pack)
+
+        elif args.command == "list":
+            with VmuPackReader(args.pack) as pack:
+                PrintList(pack)
+                if args.json:
+                    with open(args.json, "w") as f:
+                        json.dump({"header": pack.header, "resource_index": pack.resourceIndex}, f, indent=2)
+                    print("Wrote {}".format(args.json))
+
+        elif args.command == "verify":
+            numProblems = 0
+            for path in args.pack:
+                with VmuPackReader(path) as pack:
+                    problems = pack.Verify(decode=not args.no_decode)
+                for problem in problems:
+                    print("{}: {}".format(path, problem))
+                if not problems:
+                    print("{}: OK, {} resources".format(path, len(pack.resourceIndex)))
+                numProblems += len(problems)
+            if numProblems > 0:
+                sys.exit(1)
+
+        elif args.command == "extract":
+            with VmuPackReader(args.pack) as pack:
+                if args.all:
+                    entries = pack.resourceIndex
+                else:
+                    entries = []
+                    for path in args.paths:
+                        entry = pack.FindResource(path)
+                        if entry is None:
+                            print("No resource {} in {}".format(path, args.pack))
+                            sys.exit(1)
+                        entries.append(entry)
+                if not entries:
+                    print("Nothing to extract, give resource paths or --all")
+                    sys.exit(1)
+
+                singleFile = len(entries) == 1 and not args.all and not os.path.isdir(args.out)
+                for entry in entries:
+                    parts = entry["path"].split("/")
+                    if ".." in parts or os.path.isabs(entry["path"]):
+                        print("  Skipping {}, it would be written outside {}".format(entry["path"], args.out))
+                        continue
+                    if singleFile:
+                        dstPath = args.out
+                    else:
+                        dstPath = os.path.join(args.out, *parts)
+                    numBytes = pack.ExtractResource(entry, dstPath, decode=args.decode)
+                    print("  {} -> {} ({:,} bytes)".format(entry["path"], dstPath, numBytes))
+
+        elif args.command == "diff":
+            with VmuPackReader(args.old) as oldPack, VmuPackReader(args.new) as newPack:
+                print("{} -> {}".format(args.old, args.new))
+                if DiffPacks(oldPack, newPack):
+                    sys.exit(1)
+
+    except (OSError, PackFormatError) as e:
+        print("Error: {}".format(e))
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,609 @@
+# 8BM Copyright/License notice
+# Size budget and bloat report for a LUA project or a built .vmupack
+#
+# Upload time over serial and load time from the SD card both grow with the
+# pack, so this shows where its bytes go:
+#
+#   - totals by resource, by folder and by file type, with the padding each
+#     resource is given to end on a sector (or alignment) boundary
+#   - exact duplicates: resources with the same content, which the packer
+#     stores once unless --no-dedupe was used
+#   - near duplicates: images that look the same, or the same when one is
+#     mirrored (e.g. a "_r" walk frame), compared by a 64 bit difference
+#     hash of the cropped image. A mirrored copy can be dropped and the
+#     original drawn with vmupro.sprite.kImageFlippedX
+#   - estimated savings per resource from zlib compression, palette (indexed)
+#     images or IMA ADPCM audio, for resources not already stored that way
+#
+# Given a project, the layout is the default build's: every resource padded
+# to 512 bytes and identical files stored once. Given a pack, the sizes are
+# the real ones from its resource_index, including every other section.
+#
+# The report is printed as text tables, --json also writes it as a treemap
+# (folders nest, every node has its "value" in pack bytes) for a chart.
+#
+# Usage:
+#   python3 packsize.py --projectdir ../../../"IS BUILD FILES" --meta metadata.json
+#   python3 packsize.py --pack my_app.vmupack --top 40 --json my_app_size.json
+
+import sys
+import argparse
+import hashlib
+import io
+import json
+import os
+import struct
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from pathlib import Path
+
+from PIL import Image, ImageOps
+
+from audioconvert import DEFAULT_POLICY as AUDIO_POLICY
+from audiostream import ReadWavChunks
+from compressbench import CollectResources
+from compression import CODECS, DEFAULT_POLICY as COMPRESSION_POLICY
+from packreader import SECTION_FIELDS, PackFormatError, VmuPackReader
+from quantize import INDEXED_HEADER_SIZE
+
+
+SECTOR_SIZE = 512
+
+IMAGE_TYPES = (".png", ".bmp")
+
+WAVE_FORMAT_PCM = 1
+
+# Pixels at least this opaque count towards an image's colors and shape
+ALPHA_THRESHOLD = 128
+
+# Difference hashes within this many bits of each other are near duplicates
+DEFAULT_NEAR_BITS = 8
+
+
+def GetPadding(size):
+    # type: (int) -> int
+    return -size % SECTOR_SIZE
+
+
+def MakeEntry(path, size, paddedSize, aliasOf, fields):
+    # type: (str, int, int, Optional[str], Dict[str, Any]) -> Dict[str, Any]
+
+    folder = os.path.dirname(path)
+    return {
+        "path": path,
+        "folder": folder if folder else ".",
+        "type": os.path.splitext(path)[1].lower() or "(none)",
+        "size": size,
+        # bytes it takes up in the pack: 0 for an alias of another resource
+        "pack_size": 0 if aliasOf is not None else paddedSize,
+        "padding": 0 if aliasOf is not None else paddedSize - size,
+        "alias_of": aliasOf,
+        # resource_index fields that say it's already compressed or converted
+        "fields": fields,
+        "sha1": None,
+    }
+
+
+def LoadProject(absProjectDir, metaPath):
+    # type: (Path, str) -> Tuple[List[Dict[str, Any]], Dict[str, int], Callable[[Dict[str, Any]], bytes]]
+    """
+    Entries laid out the way a default build would: 512 byte padding,
+    identical files stored once. Returns the entries, the other
+    sections (unknown here, so empty) and a function to read an entry.
+    """
+
+    absMetaPath = absProjectDir / metaPath
+    try:
+        with open(absMetaPath, "r") as f:
+            resources = json.load(f).get("resources") or []
+    except Exception as e:
+        print("Failed to read {}: {}".format(absMetaPath, e))
+        sys.exit(1)
+
+    absPaths = {}
+    entries = []
+    firstBySha1 = {}
+    for relativePath, absPath in CollectResources(absProjectDir, resources):
+        hasher = hashlib.sha1()
+        with open(absPath, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        sha1 = hasher.hexdigest()
+
+        size = os.path.getsize(absPath)
+        entry = MakeEntry(relativePath, size, size + GetPadding(size), firstBySha1.get(sha1), {})
+        entry["sha1"] = sha1
+        firstBySha1.setdefault(sha1, relativePath)
+        absPaths[relativePath] = absPath
+        entries.append(entry)
+
+    def ReadData(entry):
+        # type: (Dict[str, Any]) -> bytes
+        with open(absPaths[entry["path"]], "rb") as f:
+            return f.read()
+
+    return entries, {}, ReadData
+
+
+def LoadPack(pack):
+    # type: (VmuPackReader) -> Tuple[List[Dict[str, Any]], Dict[str, int], Callable[[Dict[str, Any]], bytes]]
+    """
+    Entries with their real sizes from the pack's resource_index,
+    and the size of every section other than the resources
+    """
+
+    entries = []
+    for indexEntry in pack.resourceIndex:
+        fields = {k: v for k, v in indexEntry.items()
+                  if k in ("codec", "format", "audio_codec", "stream")}
+        entry = MakeEntry(indexEntry["path"], indexEntry["size"], indexEntry["padded_size"],
+                          indexEntry.get("alias_of"), fields)
+        if entry["alias_of"] is None:
+            entry["sha1"] = pack.HashResource(indexEntry)
+        entries.append(entry)
+
+    sections = {name: pack.sections[name][1] for name in ["header"] + [name for name, _ in SECTION_FIELDS]
+                if name != "resources"}
+    # whatever is in the resource section but not in a resource
+    resourceBytes = sum(e["pack_size"] for e in entries)
+    sections["resources (unused)"] = pack.sections["resources"][1] - resourceBytes
+
+    def ReadData(entry):
+        # type: (Dict[str, Any]) -> bytes
+        return pack.ReadResource(entry["path"], decode=True)
+
+    return entries, sections, ReadData
+
+
+def FindDuplicates(entries):
+    # type: (List[Dict[str, Any]]) -> List[Dict[str, Any]]
+    """
+    Groups of resources with identical content. "wasted" is what the
+    copies that aren't shared with an alias cost in the pack.
+    """
+
+    groups = {}  # type: Dict[str, List[Dict[str, Any]]]
+    byPath = {e["path"]: e for e in entries}
+    for entry in entries:
+        owner = byPath.get(entry["alias_of"]) if entry["alias_of"] is not None else entry
+        if owner is None or owner["sha1"] is None:
+            continue
+        groups.setdefault(owner["sha1"], []).append(entry)
+
+    duplicates = []
+    for group in groups.values():
+        if len(group) < 2:
+            continue
+        stored = [e for e in group if e["alias_of"] is None]
+        duplicates.append({
+            "paths": [e["path"] for e in group],
+            "size": stored[0]["size"],
+            "shared": len(group) - len(stored),
+            "wasted": sum(e["pack_size"] for e in stored[1:]),
+        })
+
+    duplicates.sort(key=lambda d: (-d["wasted"], -d["size"] * len(d["paths"])))
+    return duplicates
+
+
+def OpenImage(data):
+    # type: (bytes) -> Optional[Image.Image]
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception:
+        return None
+
+    return image.convert("RGBA")
+
+
+def DifferenceHash(rgba):
+    # type: (Image.Image) -> int
+    """
+    64 bit hash of the brightness gradients of the image
+    shrunk to 9x8, transparent pixels are black
+    """
+
+    flat = Image.new("RGB", rgba.size, (0, 0, 0))
+    flat.paste(rgba, mask=rgba.getchannel("A"))
+    pixels = flat.convert("L").resize((9, 8), Image.BILINEAR).tobytes()
+
+    hashValue = 0
+    for row in range(8):
+        for col in range(8):
+            hashValue <<= 1
+            if pixels[row * 9 + col] > pixels[row * 9 + col + 1]:
+                hashValue |= 1
+
+    return hashValue
+
+
+def CountBits(value):
+    # type: (int) -> int
+    return bin(value).count("1")
+
+
+def GetMirroredName(pathA, pathB):
+    # type: (str, str) -> Optional[str]
+    """
+    If the names say one is the other facing the other way
+    (walk1.png / walk1_r.png, warrior_left.png / warrior_right.png),
+    the path of the copy, otherwise None
+    """
+
+    nameA = os.path.splitext(pathA)[0]
+    nameB = os.path.splitext(pathB)[0]
+    for name, other, path in ((nameA, nameB, pathA), (nameB, nameA, pathB)):
+        if name in (other + "_r", other + "_l") or ("right" in name and name.replace("right", "left") == other):
+            return path
+
+    return None
+
+
+def FindNearDuplicates(images, maxBits):
+    # type: (List[Dict[str, Any]], int) -> List[Dict[str, Any]]
+    """
+    Pairs of images whose difference hashes are within maxBits of
+    each other, directly ("similar") or with one mirrored ("mirrored")
+    """
+
+    pairs = []
+    for i, a in enumerate(images):
+        for b in images[i + 1:]:
+            if a["entry"]["sha1"] == b["entry"]["sha1"]:
+                continue
+            direct = CountBits(a["hash"] ^ b["hash"])
+            mirrored = CountBits(a["mirror_hash"] ^ b["hash"])
+            if min(direct, mirrored) > maxBits:
+                continue
+            pairs.append({
+                "paths": [a["entry"]["path"], b["entry"]["path"]],
+                "kind": "mirrored" if mirrored < direct else "similar",
+                "distance": min(direct, mirrored),
+                # the mirrored copy, if the names say which one it is
+                "copy": GetMirroredName(a["entry"]["path"], b["entry"]["path"]),
+                "sizes": [list(a["size"]), list(b["size"])],
+            })
+
+    pairs.sort(key=lambda p: (p["kind"] != "mirrored", p["copy"] is None, p["distance"]))
+    return pairs
+
+
+def CountRgb565Colors(rgba):
+    # type: (Image.Image) -> Tuple[Optional[int], bool]
+    """
+    Distinct RGB565 colors among the visible pixels (None if over 256),
+    and whether any pixel is transparent
+    """
+
+    rgb = rgba.convert("RGB").point([v & 0xF8 for v in range(256)] + [v & 0xFC for v in range(256)]
+                                    + [v & 0xF8 for v in range(256)])
+    visible = rgba.getchannel("A").point(lambda a: 255 if a >= ALPHA_THRESHOLD else 0)
+    hasTransparency = visible.getextrema()[0] == 0
+
+    # every transparent pixel becomes the same (0, 0, 0, 0)
+    rgb.putalpha(visible)
+    merged = Image.composite(rgb, Image.new("RGBA", rgb.size, (0, 0, 0, 0)), visible)
+
+    colors = merged.getcolors(257)
+    if colors is None:
+        return None, hasTransparency
+    return len(colors) - (1 if hasTransparency else 0), hasTransparency
+
+
+def EstimateIndexed(rgba):
+    # type: (Image.Image) -> Tuple[int, str]
+    """
+    Stored size of the image as a palette image (see quantize.py),
+    and a description of the conversion
+    """
+
+    numColors, hasTransparency = CountRgb565Colors(rgba)
+    lossy = numColors is None or numColors + hasTransparency > 256
+    if lossy:
+        paletteSize = 256
+    else:
+        paletteSize = numColors + (1 if hasTransparency else 0)
+    bitsPerPixel = 4 if paletteSize <= 16 else 8
+
+    width, height = rgba.size
+    size = INDEXED_HEADER_SIZE + paletteSize * 2 + (width * bitsPerPixel + 7) // 8 * height
+    if lossy:
+        return size, "{}bpp palette (lossy, over 256 colors)".format(bitsPerPixel)
+    return size, "{}bpp palette ({} colors)".format(bitsPerPixel, paletteSize)
+
+
+def EstimateAdpcm(data):
+    # type: (bytes) -> Optional[int]
+    """
+    Stored size of a 8 or 16 bit PCM .wav as IMA ADPCM at the --adpcm defaults,
+    None if it isn't PCM
+    """
+
+    chunks = ReadWavChunks(data)
+    if chunks is None:
+        return None
+    chunksById = dict(chunks)
+    if b"fmt " not in chunksById or b"data" not in chunksById or len(chunksById[b"fmt "]) < 16:
+        return None
+
+    formatTag, numChannels, rate, _, blockAlign, bitsPerSample = struct.unpack_from("<HHIIHH", chunksById[b"fmt "])
+    if formatTag != WAVE_FORMAT_PCM or bitsPerSample not in (8, 16) or numChannels not in (1, 2) or blockAlign == 0:
+        return None
+
+    numFrames = len(chunksById[b"data"]) // blockAlign
+    outFrames = numFrames * min(rate, AUDIO_POLICY["rate"]) // rate
+
+    # a 4 byte header per channel, then two samples per byte
+    blockSize = AUDIO_POLICY["block_size"]
+    samplesPerBlock = (blockSize - 4 * numChannels) * 2 // numChannels + 1
+    numBlocks = (outFrames + samplesPerBlock - 1) // samplesPerBlock
+
+    # RIFF, fmt and fact chunks
+    return 60 + numBlocks * blockSize
+
+
+def EstimateSavings(entries, readData, nearDuplicates, maxBits):
+    # type: (List[Dict[str, Any]], Callable[[Dict[str, Any]], bytes], List[Dict[str, Any]], int) -> List[Dict[str, Any]]
+    """
+    Best way to shrink each stored resource, and how many pack bytes it would save.
+    Fills in nearDuplicates as a side effect.
+    """
+
+    level = COMPRESSION_POLICY["level"]
+    minSaved = COMPRESSION_POLICY["min_saved_bytes"]
+    images = []
+    suggestions = {}  # type: Dict[str, Dict[str, Any]]
+
+    def Suggest(entry, newSize, how):
+        # type: (Dict[str, Any], int, str) -> None
+        saved = entry["pack_size"] - (newSize + GetPadding(newSize))
+        if newSize + minSaved > entry["size"] or saved <= 0:
+            return
+        best = suggestions.get(entry["path"])
+        if best is None or saved > best["saved"]:
+            suggestions[entry["path"]] = {"path": entry["path"], "how": how, "saved": saved}
+
+    for entry in entries:
+        if entry["alias_of"] is not None:
+            continue
+        fields = entry["fields"]
+
+        data = readData(entry)
+
+        if "codec" not in fields and "stream" not in fields:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, CODECS["zlib"])
+            Suggest(entry, len(compressor.compress(data) + compressor.flush()), "zlib")
+
+        if entry["type"] in IMAGE_TYPES and "format" not in fields:
+            rgba = OpenImage(data)
+            if rgba is not None:
+                indexedSize, how = EstimateIndexed(rgba)
+                Suggest(entry, indexedSize, how)
+
+                # the visible part, so padding around a sprite doesn't matter
+                bbox = rgba.getchannel("A").point(lambda a: 255 if a >= ALPHA_THRESHOLD else 0).getbbox()
+                cropped = rgba.crop(bbox) if bbox is not None else rgba
+                images.append({
+                    "entry": entry,
+                    "size": rgba.size,
+                    "hash": DifferenceHash(cropped),
+                    "mirror_hash": DifferenceHash(ImageOps.mirror(cropped)),
+                })
+
+        if entry["type"] == ".wav" and "audio_codec" not in fields and "stream" not in fields:
+            adpcmSize = EstimateAdpcm(data)
+            if adpcmSize is not None:
+                Suggest(entry, adpcmSize, "IMA ADPCM (--adpcm)")
+
+    nearDuplicates.extend(FindNearDuplicates(images, maxBits))
+
+    # a mirrored copy can go altogether, draw the other one flipped
+    byPath = {e["path"]: e for e in entries}
+    dropped = set()
+    for pair in nearDuplicates:
+        if pair["kind"] != "mirrored" or pair["copy"] is None:
+            continue
+        drop = pair["copy"]
+        keep = pair["paths"][1] if pair["paths"][0] == drop else pair["paths"][0]
+        if drop in dropped or keep in dropped:
+            continue
+        dropped.add(drop)
+        suggestions[drop] = {"path": drop, "how": "mirror of {} (draw it with kImageFlippedX)".format(keep),
+                             "saved": byPath[drop]["pack_size"]}
+
+    return sorted(suggestions.values(), key=lambda s: -s["saved"])
+
+
+def SumBy(entries, key):
+    # type: (List[Dict[str, Any]], str) -> List[Tuple[str, Dict[str, int]]]
+
+    totals = {}  # type: Dict[str, Dict[str, int]]
+    for entry in entries:
+        t = totals.setdefault(entry[key], {"files": 0, "size": 0, "padding": 0, "pack_size": 0})
+        t["files"] += 1
+        t["size"] += entry["size"] if entry["alias_of"] is None else 0
+        t["padding"] += entry["padding"]
+        t["pack_size"] += entry["pack_size"]
+
+    return sorted(totals.items(), key=lambda kv: -kv[1]["pack_size"])
+
+
+def MakeTreemap(name, entries, sections, suggestionsByPath):
+    # type: (str, List[Dict[str, Any]], Dict[str, int], Dict[str, Dict[str, Any]]) -> Dict[str, Any]
+    """
+    Nested folders, every node's value is its bytes in the pack
+    """
+
+    root = {"name": name, "value": 0, "size": 0, "padding": 0, "children": []}
+
+    def AddTo(node, child):
+        # type: (Dict[str, Any], Dict[str, Any]) -> None
+        node["value"] += child["value"]
+        node["size"] += child["size"]
+        node["padding"] += child["padding"]
+
+    for sectionName, length in sections.items():
+        leaf = {"name": "[{}]".format(sectionName), "value": length, "size": length, "padding": 0}
+        root["children"].append(leaf)
+        AddTo(root, leaf)
+
+    for entry in entries:
+        parts = entry["path"].split("/")
+        node = root
+        chain = [root]
+        for part in parts[:-1]:
+            child = next((c for c in node["children"] if c["name"] == part and "children" in c), None)
+            if child is None:
+                child = {"name": part, "value": 0, "size": 0, "padding": 0, "children": []}
+                node["children"].append(child)
+            node = child
+            chain.append(node)
+
+        leaf = {
+            "name": parts[-1],
+            "path": entry["path"],
+            "type": entry["type"],
+            "value": entry["pack_size"],
+            "size": entry["size"] if entry["alias_of"] is None else 0,
+            "padding": entry["padding"],
+        }
+        if entry["alias_of"] is not None:
+            leaf["alias_of"] = entry["alias_of"]
+        suggestion = suggestionsByPath.get(entry["path"])
+        if suggestion is not None:
+            leaf["suggestion"] = suggestion["how"]
+            leaf["saving"] = suggestion["saved"]
+        node["children"].append(leaf)
+        for parent in chain:
+            AddTo(parent, leaf)
+
+    return root
+
+
+def Percent(part, total):
+    # type: (int, int) -> float
+    return part * 100.0 / total if total > 0 else 0.0
+
+
+def PrintReport(entries, sections, duplicates, nearDuplicates, suggestions, top):
+    # type: (List[Dict[str, Any]], Dict[str, int], List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]], int) -> None
+
+    resourceBytes = sum(e["pack_size"] for e in entries)
+    total = resourceBytes + sum(sections.values())
+    paddingBytes = sum(e["padding"] for e in entries)
+    numAliases = sum(1 for e in entries if e["alias_of"] is not None)
+    limit = top if top > 0 else None
+
+    print("Total {:,} bytes: resources {:,} ({:.1f}%), of which {:,} bytes padding".format(
+        total, resourceBytes, Percent(resourceBytes, total), paddingBytes))
+    print("{} resources, {} stored once for another path".format(len(entries), numAliases))
+    for name, length in sections.items():
+        print("  {:<20} {:>12,} bytes".format(name, length))
+
+    for title, key in (("By file type", "type"), ("By folder", "folder")):
+        print("\n{}:".format(title))
+        print("{:<44} {:>6} {:>12} {:>10} {:>12} {:>6}".format("", "Files", "Stored", "Padding", "In pack", "%"))
+        for name, t in SumBy(entries, key)[:limit]:
+            print("{:<44} {:>6} {:>12,} {:>10,} {:>12,} {:>6.1f}".format(
+                name[-44:], t["files"], t["size"], t["padding"], t["pack_size"], Percent(t["pack_size"], total)))
+
+    suggestionsByPath = {s["path"]: s for s in suggestions}
+    print("\nLargest resources:")
+    print("{:<48} {:>10} {:>8} {:>10} {:>6}  {}".format("", "Stored", "Padding", "In pack", "%", "Could save"))
+    for entry in sorted(entries, key=lambda e: -e["pack_size"])[:limit]:
+        suggestion = suggestionsByPath.get(entry["path"])
+        print("{:<48} {:>10,} {:>8,} {:>10,} {:>6.1f}  {}".format(
+            entry["path"][-48:], entry["size"], entry["padding"], entry["pack_size"],
+            Percent(entry["pack_size"], total),
+            "" if suggestion is None else "{:,} with {}".format(suggestion["saved"], suggestion["how"])))
+
+    print("\nExact duplicates: {} groups".format(len(duplicates)))
+    for dup in duplicates[:limit]:
+        print("  {:,} bytes x {}, {} shared, {:,} bytes wasted: {}".format(
+            dup["size"], len(dup["paths"]), dup["shared"], dup["wasted"], ", ".join(dup["paths"])))
+
+    print("\nNear duplicates: {} pairs".format(len(nearDuplicates)))
+    for pair in nearDuplicates[:limit]:
+        print("  {:<8} {:>2} bits{} {} / {}".format(
+            pair["kind"], pair["distance"], ", by name" if pair["copy"] else "", pair["paths"][0], pair["paths"][1]))
+
+    print("\nEstimated savings:")
+    byHow = {}  # type: Dict[str, List[int]]
+    for s in suggestions:
+        how = s["how"].split(" (")[0] if not s["how"].startswith("mirror") else "mirrored copies"
+        byHow.setdefault(how, []).append(s["saved"])
+    for how, saved in sorted(byHow.items(), key=lambda kv: -sum(kv[1])):
+        print("  {:<24} {:>4} resources {:>12,} bytes".format(how, len(saved), sum(saved)))
+    wasted = sum(d["wasted"] for d in duplicates)
+    if wasted > 0:
+        print("  {:<24} {:>4} groups    {:>12,} bytes (pack without --no-dedupe)".format("duplicates", len(duplicates), wasted))
+    totalSaved = sum(s["saved"] for s in suggestions) + wasted
+    print("  {:<24} {:>22,} bytes ({:.1f}% of the pack)".format("total", totalSaved, Percent(totalSaved, total)))
+
+
+def main():
+
+    print("\n")
+    print("8BM VMUPro pack size report")
+    print("\n")
+
+    parser = argparse.ArgumentParser(
+        description="Show where the bytes of a pack go and what could be saved")
+    parser.add_argument("--pack", required=False,
+                        help="A built .vmupack to report on")
+    parser.add_argument("--projectdir", required=False,
+                        help="Root folder containing your LUA app, to report on its metadata instead")
+    parser.add_argument("--meta", required=False, default="metadata.json",
+                        help="Relative path .JSON metadata for your package: metadata.json from projectdir")
+    parser.add_argument("--top", type=int, required=False, default=20,
+                        help="Rows per table, 0 for all of them")
+    parser.add_argument("--near-bits", type=int, required=False, default=DEFAULT_NEAR_BITS,
+                        help="How different (in bits of a 64 bit image hash) near duplicate images can be")
+    parser.add_argument("--json", required=False,
+                        help="Also write the report to this JSON file as a treemap")
+
+    args = parser.parse_args()
+
+    if (args.pack is None) == (args.projectdir is None):
+        print("Give either --pack or --projectdir")
+        sys.exit(1)
+
+    pack = None
+    try:
+        if args.pack is not None:
+            pack = VmuPackReader(args.pack)
+            entries, sections, readData = LoadPack(pack)
+            name = os.path.basename(args.pack)
+        else:
+            absProjectDir = Path(args.projectdir).resolve()
+            entries, sections, readData = LoadProject(absProjectDir, args.meta)
+            name = args.meta
+
+        duplicates = FindDuplicates(entries)
+        nearDuplicates = []  # type: List[Dict[str, Any]]
+        suggestions = EstimateSavings(entries, readData, nearDuplicates, args.near_bits)
+    except (OSError, PackFormatError) as e:
+        print("Error: {}".format(e))
+        sys.exit(2)
+    finally:
+        if pack is not None:
+            pack.Close()
+
+    PrintReport(entries, sections, duplicates, nearDuplicates, suggestions, args.top)
+
+    if args.json:
+        suggestionsByPath = {s["path"]: s for s in suggestions}
+        with open(args.json, "w") as f:
+            json.dump({
+                "treemap": MakeTreemap(name, entries, sections, suggestionsByPath),
+                "duplicates": duplicates,
+                "near_duplicates": nearDuplicates,
+                "suggestions": suggestions,
+            }, f, indent=2)
+        print("\nWrote {}".format(args.json))
+
+
+if __name__ == "__main__":
+    main()
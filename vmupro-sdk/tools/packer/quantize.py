@@ -0,0 +1,413 @@
+# 8BM Copyright/License notice
+# Optional palette quantization of images for the LUA packer
+#
+# Enabled with --indexed 4bpp|8bpp, or by adding an "indexed" policy to
+# the "build" section of metadata.json:
+#
+#   "build": {
+#       "indexed": {
+#           "types": { ".png": "8bpp", ".bmp": "8bpp" },
+#           "files": { "sprites/title.png": "none" },
+#           "max_colors": 64,
+#           "dither": "ordered",
+#           "alpha_threshold": 128,
+#           "shared_palettes": { "level1": ["sprites/level1/"] }
+#       }
+#   }
+#
+# "types" maps file extensions to "4bpp", "8bpp" or "none", "files"
+# overrides individual resource paths. Palettes are built by median cut,
+# one per image unless the image's path starts with one of the prefixes
+# in "shared_palettes", in which case every image in that group gets the
+# same palette (sized for the group's smallest mode).
+#
+# Images keep their resource path, but the data is stored as:
+#
+#   32 byte header, little-endian fields:
+#     'SIDX', version, width, height, bits per pixel (4 or 8),
+#     alpha mode (0 opaque, 1 index 0 is transparent), palette colors,
+#     reserved
+#   palette colors * 16 bit big-endian RGB565
+#   pixel indices, row by row, rows padded to a whole byte,
+#     4bpp has the left pixel in the high nibble
+#
+# Converted entries in resource_index get the fields:
+#   "format": "indexed", "bpp", "width", "height", "colors", "alpha"
+#   and "palette" (the shared palette's name) where one was used
+
+import os
+import math
+import hashlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from PIL import Image, ImageChops
+
+
+INDEXED_MAGIC = b'SIDX'
+INDEXED_VERSION = 1
+INDEXED_HEADER_SIZE = 32
+
+INDEXED_MODES = {
+    "4bpp": 4,
+    "8bpp": 8,
+}
+
+DITHER_MODES = ("none", "ordered")
+
+# color stored in the palette for the transparent index
+TRANSPARENT_COLOR = (0xF8, 0x00, 0xF8)
+
+BAYER_4X4 = [
+    0, 8, 2, 10,
+    12, 4, 14, 6,
+    3, 11, 1, 9,
+    15, 7, 13, 5,
+]
+
+DEFAULT_POLICY = {
+    "types": {
+        ".png": "8bpp",
+        ".bmp": "8bpp",
+    },
+    "files": {},
+    "max_colors": None,
+    "dither": "none",
+    "alpha_threshold": 128,
+    "shared_palettes": {},
+}
+
+
+class IndexedPolicyError(Exception):
+    pass
+
+
+def LoadIndexedPolicy(inPolicy, defaultMode):
+    # type: (Optional[Dict[str, Any]], Optional[str]) -> Dict[str, Any]
+    """
+    Merge an "indexed" block from metadata.json over the defaults
+    and sanity check it. With no block, defaultMode (e.g. from the
+    command line) is used for every PNG and BMP.
+    """
+
+    policy = dict(DEFAULT_POLICY)
+    policy["types"] = dict(DEFAULT_POLICY["types"])
+    policy["files"] = {}
+    policy["shared_palettes"] = {}
+
+    if defaultMode is not None:
+        policy["types"] = {ext: defaultMode for ext in policy["types"]}
+
+    if inPolicy is not None:
+        if not isinstance(inPolicy, dict):
+            raise IndexedPolicyError("Expected 'indexed' to be an object")
+        for key, val in inPolicy.items():
+            if key not in policy:
+                raise IndexedPolicyError("Unknown indexed option '{}'".format(key))
+            policy[key] = val
+
+    for key in ("types", "files", "shared_palettes"):
+        if not isinstance(policy[key], dict):
+            raise IndexedPolicyError("Expected indexed '{}' to be an object".format(key))
+
+    for key in ("types", "files"):
+        for name, mode in policy[key].items():
+            if mode != "none" and mode not in INDEXED_MODES:
+                raise IndexedPolicyError("Unknown indexed mode '{}' for '{}', expected one of: none, {}".format(
+                    mode, name, ", ".join(sorted(INDEXED_MODES))))
+
+    policy["types"] = {ext.lower(): mode for ext, mode in policy["types"].items()}
+
+    maxColors = policy["max_colors"]
+    if maxColors is not None and (not isinstance(maxColors, int) or maxColors < 2 or maxColors > 256):
+        raise IndexedPolicyError("Expected indexed 'max_colors' between 2 and 256")
+
+    if policy["dither"] not in DITHER_MODES:
+        raise IndexedPolicyError("Expected indexed 'dither' to be one of: {}".format(", ".join(DITHER_MODES)))
+
+    threshold = policy["alpha_threshold"]
+    if not isinstance(threshold, int) or threshold < 1 or threshold > 255:
+        raise IndexedPolicyError("Expected indexed 'alpha_threshold' between 1 and 255")
+
+    for name, prefixes in policy["shared_palettes"].items():
+        if not isinstance(prefixes, list) or not all(isinstance(p, str) for p in prefixes):
+            raise IndexedPolicyError("Expected shared palette '{}' to be a list of path prefixes".format(name))
+
+    return policy
+
+
+def GetIndexedMode(policy, relativePath):
+    # type: (Dict[str, Any], str) -> Optional[str]
+    """
+    Mode ("4bpp" / "8bpp") the policy picks for this resource, or None
+    """
+
+    mode = policy["files"].get(relativePath)
+    if mode is None:
+        ext = os.path.splitext(relativePath)[1].lower()
+        mode = policy["types"].get(ext)
+
+    if mode is None or mode == "none":
+        return None
+
+    return mode
+
+
+def GetSharedPaletteName(policy, relativePath):
+    # type: (Dict[str, Any], str) -> Optional[str]
+
+    for name in sorted(policy["shared_palettes"]):
+        for prefix in policy["shared_palettes"][name]:
+            if relativePath.startswith(prefix):
+                return name
+
+    return None
+
+
+def GetPaletteSize(policy, mode):
+    # type: (Dict[str, Any], str) -> int
+    """
+    Total palette entries for a mode, including the transparent one
+    """
+
+    size = 1 << INDEXED_MODES[mode]
+    if policy["max_colors"] is not None:
+        size = min(size, policy["max_colors"])
+    return size
+
+
+def BuildSharedPalettes(policy, allFiles):
+    # type: (Dict[str, Any], List[Tuple[str, Any]]) -> Dict[str, Dict[str, Any]]
+    """
+    Median cut palette for each shared palette group, over the visible
+    pixels of every image in the group. Needs every member up front, so
+    this runs before the resources are ingested.
+    Returns {name: {"colors": [(r, g, b), ...], "key": short hash}}
+    """
+
+    members = {}
+    for relativePath, absPath in allFiles:
+        mode = GetIndexedMode(policy, relativePath)
+        name = GetSharedPaletteName(policy, relativePath)
+        if mode is None or name is None:
+            continue
+        members.setdefault(name, []).append((absPath, mode))
+
+    palettes = {}
+    for name, images in sorted(members.items()):
+        pixels = bytearray()
+        for absPath, _ in images:
+            with Image.open(absPath) as im:
+                rgba = im.convert("RGBA")
+            pixels.extend(GetVisiblePixels(rgba, policy["alpha_threshold"]))
+
+        # one entry is kept back for transparency
+        numColors = min(GetPaletteSize(policy, mode) for _, mode in images) - 1
+        colors = MedianCutPalette(pixels, numColors)
+        palettes[name] = {
+            "colors": colors,
+            "key": hashlib.sha1(bytes(c for color in colors for c in color)).hexdigest()[:12],
+        }
+
+    return palettes
+
+
+def GetIndexedStage(policy, sharedPalettes, relativePath):
+    # type: (Dict[str, Any], Dict[str, Dict[str, Any]], str) -> Optional[Tuple[str, Callable[[str, str], Optional[Dict[str, Any]]]]]
+    """
+    Packer transform stage (key, function) for this resource,
+    or None if the policy leaves it as-is
+    """
+
+    mode = GetIndexedMode(policy, relativePath)
+    if mode is None:
+        return None
+
+    paletteName = GetSharedPaletteName(policy, relativePath)
+    shared = sharedPalettes.get(paletteName) if paletteName is not None else None
+
+    # everything that changes the output goes in the key
+    key = "idx{}v{}c{}a{}".format(INDEXED_MODES[mode], INDEXED_VERSION,
+                                  GetPaletteSize(policy, mode), policy["alpha_threshold"])
+    if policy["dither"] == "ordered":
+        key += "d"
+    if shared is not None:
+        key += "p" + shared["key"]
+
+    def IndexedStage(absSrcPath, absDstPath):
+        # type: (str, str) -> Optional[Dict[str, Any]]
+        fields = EncodeIndexedImage(absSrcPath, absDstPath, INDEXED_MODES[mode],
+                                    GetPaletteSize(policy, mode), policy["dither"] == "ordered",
+                                    policy["alpha_threshold"], shared["colors"] if shared is not None else None)
+        if shared is not None:
+            fields["palette"] = paletteName
+        return fields
+
+    return (key, IndexedStage)
+
+
+def GetVisibleMask(rgba, alphaThreshold):
+    # type: (Image.Image, int) -> Image.Image
+    return rgba.getchannel("A").point([0] * alphaThreshold + [255] * (256 - alphaThreshold))
+
+
+def GetVisiblePixels(rgba, alphaThreshold):
+    # type: (Image.Image, int) -> bytes
+    """
+    RGB bytes of every visible pixel, in no particular order
+    """
+
+    binary = Image.merge("RGBA", rgba.split()[:3] + (GetVisibleMask(rgba, alphaThreshold),))
+    width, height = binary.size
+    colors = binary.getcolors(width * height) or []
+    return b"".join(bytes(c[:3]) * count for count, c in colors if c[3] == 255)
+
+
+def MedianCutPalette(pixels, numColors):
+    # type: (bytes, int) -> List[Tuple[int, int, int]]
+    """
+    Up to numColors RGB colors, at RGB565 precision, for the given RGB bytes
+    """
+
+    numPixels = len(pixels) // 3
+    if numPixels == 0:
+        return []
+
+    strip = Image.frombytes("RGB", (numPixels, 1), bytes(pixels))
+    quantized = strip.quantize(colors=numColors, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+    palette = quantized.getpalette()
+
+    colors = []
+    for _, i in sorted(quantized.getcolors(256)):
+        rgb = (palette[i * 3] & 0xF8, palette[i * 3 + 1] & 0xFC, palette[i * 3 + 2] & 0xF8)
+        if rgb not in colors:
+            colors.append(rgb)
+
+    return colors
+
+
+def OrderedDither(rgb, bitsPerPixel):
+    # type: (Image.Image, int) -> Image.Image
+    """
+    Offset each channel by a tiled 4x4 Bayer pattern centred on 0,
+    so mapping to the palette spreads the error spatially
+    """
+
+    spread = 32 if bitsPerPixel == 4 else 16
+    tile = Image.new("L", (4, 4))
+    tile.putdata([v * spread // 16 for v in BAYER_4X4])
+
+    width, height = rgb.size
+    pattern = Image.new("L", (width, height))
+    for y in range(0, height, 4):
+        for x in range(0, width, 4):
+            pattern.paste(tile, (x, y))
+
+    half = Image.new("L", (width, height), spread // 2)
+    return Image.merge("RGB", [ImageChops.subtract(ImageChops.add(c, pattern), half) for c in rgb.split()])
+
+
+def MapToPalette(rgb, colors):
+    # type: (Image.Image, List[Tuple[int, int, int]]) -> Image.Image
+    """
+    Nearest palette index for each pixel, as an "L" image
+    """
+
+    # the palette image always has 256 entries,
+    # repeat the real colors so no padding entry is ever picked
+    flat = []
+    for i in range(256):
+        flat.extend(colors[i % len(colors)])
+    paletteImage = Image.new("P", (1, 1))
+    paletteImage.putpalette(flat)
+
+    mapped = rgb.quantize(palette=paletteImage, dither=Image.Dither.NONE)
+    indices = Image.frombytes("L", mapped.size, mapped.tobytes())
+    return indices.point([i % len(colors) for i in range(256)])
+
+
+def MeasurePsnr(original, decoded, visibleMask):
+    # type: (Image.Image, Image.Image, Image.Image) -> Optional[float]
+    """
+    PSNR in dB over the visible pixels, None if identical
+    """
+
+    histogram = ImageChops.difference(original, decoded).histogram(mask=visibleMask)
+    numSamples = sum(histogram)
+    if numSamples == 0:
+        return None
+
+    squaredError = sum(count * (i % 256) ** 2 for i, count in enumerate(histogram))
+    if squaredError == 0:
+        return None
+
+    return 10 * math.log10(255 * 255 * numSamples / float(squaredError))
+
+
+def EncodeIndexedImage(absSrcPath, absDstPath, bitsPerPixel, paletteSize, dither, alphaThreshold, sharedColors):
+    # type: (str, str, int, int, bool, int, Optional[List[Tuple[int, int, int]]]) -> Dict[str, Any]
+    """
+    Quantize an image to the indexed format at absDstPath.
+    Uses sharedColors as the palette if given, else builds one for this image.
+    Returns the resource_index fields, plus a build-only "report".
+    """
+
+    with Image.open(absSrcPath) as im:
+        rgba = im.convert("RGBA")
+
+    width, height = rgba.size
+    # at RGB565 precision, so the PSNR only counts the loss from quantizing
+    rgb = Image.merge("RGB", [c.point([v & m for v in range(256)])
+                              for c, m in zip(rgba.convert("RGB").split(), (0xF8, 0xFC, 0xF8))])
+    visibleMask = GetVisibleMask(rgba, alphaThreshold)
+    hasTransparency = visibleMask.getextrema()[0] == 0
+
+    if sharedColors is not None:
+        colors = list(sharedColors)
+    else:
+        # one entry is kept back for transparency, even if unused,
+        # so index 0 means the same thing in every image
+        colors = MedianCutPalette(GetVisiblePixels(rgba, alphaThreshold), paletteSize - 1)
+
+    if len(colors) == 0:
+        colors = [(0, 0, 0)]
+
+    source = OrderedDither(rgb, bitsPerPixel) if dither else rgb
+    # shift past the transparent entry, then punch out the invisible pixels
+    indices = MapToPalette(source, colors).point([min(i + 1, 255) for i in range(256)])
+    if hasTransparency:
+        indices = Image.composite(indices, Image.new("L", rgba.size, 0), visibleMask)
+
+    palette = [TRANSPARENT_COLOR] + colors
+
+    decoded = Image.frombytes("P", rgba.size, indices.tobytes())
+    decoded.putpalette([c for color in palette for c in color])
+    psnr = MeasurePsnr(rgb, decoded.convert("RGB"), visibleMask)
+
+    rawMode = "P" if bitsPerPixel == 8 else "P;{}".format(bitsPerPixel)
+    packed = Image.frombytes("P", rgba.size, indices.tobytes()).tobytes("raw", rawMode)
+
+    header = bytearray(INDEXED_MAGIC)
+    for val in (INDEXED_VERSION, width, height, bitsPerPixel, 1 if hasTransparency else 0, len(palette), 0):
+        header.extend(val.to_bytes(4, byteorder='little'))
+
+    paletteBytes = bytearray()
+    for r, g, b in palette:
+        paletteBytes.extend((((r >> 3) << 11) | ((g >> 2) << 5) | (b >> 3)).to_bytes(2, byteorder='big'))
+
+    with open(absDstPath, "wb") as f:
+        f.write(header)
+        f.write(paletteBytes)
+        f.write(packed)
+
+    return {
+        "format": "indexed",
+        "bpp": bitsPerPixel,
+        "width": width,
+        "height": height,
+        "colors": len(palette),
+        "alpha": "colorkey" if hasTransparency else "opaque",
+        "report": {
+            "psnr_db": round(psnr, 2) if psnr is not None else "lossless",
+            "rgb565_size": INDEXED_HEADER_SIZE + width * height * 2,
+        },
+    }
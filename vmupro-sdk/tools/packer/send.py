@@ -261,6 +261,88 @@ def WriteBytesChunked(inBytes, chunkSize):
     print(f"\n\nPC: Sent {bytesSent} bytes")
 
 
+def OpenUploadPort(comPort):
+    # type: (str) -> None
+    """
+    Open the serial connection for UploadBytes without restarting
+    the VMUPro. It stays open for as many uploads as needed.
+    """
+
+    global uart
+
+    uart = serial.Serial(
+        port=comPort,
+        baudrate=921600,
+        dsrdtr=None,
+        timeout=1
+    )
+
+    # Prevent immediately restarting the VMUPro
+    uart.setRTS(False)
+    uart.setDTR(False)
+
+
+def UploadBytes(fileBytes, remoteFile, execute):
+    # type: (bytes, str, bool)->bool
+    """
+    Send a file to the VMUPro SD card over the open connection
+    and tell it whether to execute the file afterwards.
+    returns False if the VMUPro rejected the command or filename
+    """
+
+    fileSize = len(fileBytes)
+
+    ClearInputBuffer()
+
+    # Enter serial mode
+    # and send the "SEND_BIN" command
+
+    print("PC: Triggering sio mon")
+    WriteBytes(b'X')
+
+    print("PC: Sending command")
+    WriteBytes(b'SEND_BIN')
+
+    # Wait for VMUPro to react with "REQ_SIZE"
+    # then send the size
+
+    if not WaitForResponse("REQ_SIZE", "UNK_CMD!"):
+        ErrorUnknownCommand("SEND_BIN")
+        return False
+
+    print("PC: Sending file size")
+    WriteUInt32(fileSize)
+
+    # Wait for the VMUPro to react with "REQ_NAME"
+    # for the filename on the SD card
+
+    WaitForResponse("REQ_NAME", None)
+
+    WriteBytes(remoteFile.encode('ascii'))
+    WriteBytes(b'\0')
+
+    if not WaitForResponse("REQ_DATA", "FILE_ERR"):
+        ErrorHandlingFile()
+        return False
+
+    # Send the file contents
+    # in chunks of CHUNK_SIZE bytes
+
+    print("PC: Sending file")
+    WriteBytesChunked(fileBytes, CHUNK_SIZE)
+
+    # Wait for the VMUPro to ask if we want
+    # to execute the file, and send a response
+    WaitForResponse("ASK_EXEC", None)
+
+    if execute:
+        WriteUInt32(1)
+    else:
+        WriteUInt32(0)
+
+    return True
+
+
 def main():
 
     print("\n")
@@ -441,16 +523,7 @@ def SendFile():
             t.start()
 
         # Init the serial connection
-        uart = serial.Serial(
-            port=comPort,
-            baudrate=921600,
-            dsrdtr=None,
-            timeout=1
-        )
-
-        # Prevent immediately restarting the VMUPro
-        uart.setRTS(False)
-        uart.setDTR(False)
+        OpenUploadPort(comPort)
 
         with open(localFile, "rb") as f:
 
@@ -461,54 +534,9 @@ def SendFile():
             fileSize = len(bytes)
             print(f"  Loaded {fileSize} bytes from {localFile}")
 
-            ClearInputBuffer()
-
-            # Enter serial mode
-            # and send the "SEND_BIN" command
-
-            print("PC: Triggering sio mon")
-            WriteBytes(b'X')
-
-            print("PC: Sending command")
-            WriteBytes(b'SEND_BIN')
-
-            # Wait for VMUPro to react with "REQ_SIZE"
-            # then send the size
-
-            if not WaitForResponse("REQ_SIZE", "UNK_CMD!"):
-                ErrorUnknownCommand("SEND_BIN")
+            if not UploadBytes(bytes, remoteFile, args.exec):
                 sys.exit(1)
 
-            print("PC: Sending file size")
-            WriteUInt32(fileSize)
-
-            # Wait for the VMUPro to react with "REQ_NAME"
-            # for the filename on the SD card
-
-            WaitForResponse("REQ_NAME", None)
-
-            WriteBytes(remoteFile.encode('ascii'))
-            WriteBytes(b'\0')
-
-            if not WaitForResponse("REQ_DATA", "FILE_ERR"):
-                ErrorHandlingFile()
-                sys.exit(1)
-
-            # Send the file contents
-            # in chunks of CHUNK_SIZE bytes
-
-            print("PC: Sending file")
-            WriteBytesChunked(bytes, CHUNK_SIZE)
-
-            # Wait for the VMUPro to ask if we want
-            # to execute the file, and send a response
-            WaitForResponse("ASK_EXEC", None)
-
-            if args.exec:
-                WriteUInt32(1)
-            else:
-                WriteUInt32(0)
-
             # We're done
             # Open a 2-way serial
 
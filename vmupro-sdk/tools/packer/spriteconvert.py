@@ -0,0 +1,240 @@
+# 8BM Copyright/License notice
+# Optional build-time PNG to native RGB565 sprite conversion for the LUA packer
+#
+# Enabled with --native-sprites, or by adding a "sprites" policy to the
+# "build" section of metadata.json:
+#
+#   "build": {
+#       "sprites": {
+#           "default": "native",
+#           "files": { "sprites/title.png": "png" },
+#           "alpha_threshold": 128,
+#           "soft_alpha": "keep"
+#       }
+#   }
+#
+# "default" is "native" to convert every .png resource or "png" to leave
+# them as-is, "files" overrides individual resource paths either way.
+# Converted sprites keep their resource path, so they're still loaded by
+# the same name, but the data is stored pre-decoded:
+#
+#   32 byte header, little-endian fields:
+#     'S565', version, width, height, alpha mode, transparent color,
+#     mask offset (0 = no mask), reserved
+#   width * height 16 bit big-endian RGB565 pixels, row by row (as the icon)
+#   1-bit mask if alpha mode is 2: one bit per pixel, MSB first,
+#     rows padded to a whole byte, 1 = visible
+#
+# Alpha is classified as:
+#   0 "opaque":   every pixel's alpha is >= alpha_threshold
+#   1 "colorkey": transparent pixels are painted with an RGB565 value that
+#                 no visible pixel uses (magenta 0xF81F where possible)
+#   2 "mask":     no free color, visibility is in the 1-bit mask
+# PNGs with partially transparent pixels are left as PNG so the device can
+# still blend them, unless "soft_alpha" is "threshold".
+#
+# Converted entries in resource_index get the fields:
+#   "format": "rgb565", "width", "height", "alpha", and
+#   "transparent_color" for "colorkey" sprites
+
+import os
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from PIL import Image
+
+from imagecodec import encode_rgb565
+
+
+SPRITE_MAGIC = b'S565'
+SPRITE_VERSION = 1
+SPRITE_HEADER_SIZE = 32
+
+ALPHA_OPAQUE = 0
+ALPHA_COLORKEY = 1
+ALPHA_MASK = 2
+ALPHA_NAMES = {
+    ALPHA_OPAQUE: "opaque",
+    ALPHA_COLORKEY: "colorkey",
+    ALPHA_MASK: "mask",
+}
+
+# magenta, the usual "never drawn" color
+PREFERRED_COLOR_KEY = 0xF81F
+
+DEFAULT_POLICY = {
+    "default": "native",
+    "files": {},
+    "alpha_threshold": 128,
+    "soft_alpha": "keep",
+}
+
+SPRITE_FORMATS = ("native", "png")
+SOFT_ALPHA_MODES = ("keep", "threshold")
+
+
+class SpritePolicyError(Exception):
+    pass
+
+
+def LoadSpritePolicy(inPolicy):
+    # type: (Optional[Dict[str, Any]]) -> Dict[str, Any]
+    """
+    Merge a "sprites" block from metadata.json over the defaults
+    and sanity check it. None gives the default policy.
+    """
+
+    policy = dict(DEFAULT_POLICY)
+    policy["files"] = {}
+
+    if inPolicy is None:
+        return policy
+
+    if not isinstance(inPolicy, dict):
+        raise SpritePolicyError("Expected 'sprites' to be an object")
+
+    for key, val in inPolicy.items():
+        if key not in policy:
+            raise SpritePolicyError("Unknown sprites option '{}'".format(key))
+        policy[key] = val
+
+    if policy["default"] not in SPRITE_FORMATS:
+        raise SpritePolicyError("Expected sprites 'default' to be one of: {}".format(", ".join(SPRITE_FORMATS)))
+
+    if not isinstance(policy["files"], dict):
+        raise SpritePolicyError("Expected sprites 'files' to be an object")
+
+    for name, fmt in policy["files"].items():
+        if fmt not in SPRITE_FORMATS:
+            raise SpritePolicyError("Unknown sprite format '{}' for '{}', expected one of: {}".format(
+                fmt, name, ", ".join(SPRITE_FORMATS)))
+
+    threshold = policy["alpha_threshold"]
+    if not isinstance(threshold, int) or threshold < 1 or threshold > 255:
+        raise SpritePolicyError("Expected sprites 'alpha_threshold' between 1 and 255")
+
+    if policy["soft_alpha"] not in SOFT_ALPHA_MODES:
+        raise SpritePolicyError("Expected sprites 'soft_alpha' to be one of: {}".format(", ".join(SOFT_ALPHA_MODES)))
+
+    return policy
+
+
+def GetSpriteStage(policy, relativePath):
+    # type: (Dict[str, Any], str) -> Optional[Tuple[str, Callable[[str, str], Optional[Dict[str, Any]]]]]
+    """
+    Packer transform stage (key, function) for this resource,
+    or None if it isn't a PNG or the policy leaves it as one
+    """
+
+    if os.path.splitext(relativePath)[1].lower() != ".png":
+        return None
+
+    if policy["files"].get(relativePath, policy["default"]) != "native":
+        return None
+
+    # everything that changes the output goes in the key
+    key = "rgb565v{}a{}".format(SPRITE_VERSION, policy["alpha_threshold"])
+    if policy["soft_alpha"] == "threshold":
+        key += "t"
+
+    def SpriteStage(absSrcPath, absDstPath):
+        # type: (str, str) -> Optional[Dict[str, Any]]
+        return EncodeNativeSprite(absSrcPath, absDstPath,
+                                  policy["alpha_threshold"], policy["soft_alpha"] == "threshold")
+
+    return (key, SpriteStage)
+
+
+def FindColorKey(visible):
+    # type: (Image.Image) -> Optional[int]
+    """
+    An RGB565 value not used by any visible pixel, or None if they're all taken.
+    visible is an RGBA image already reduced to RGB565 precision, with
+    alpha 255 for visible pixels and 0 for transparent ones.
+    """
+
+    width, height = visible.size
+    colors = visible.getcolors(width * height) or []
+    used = set()
+    for _, (r, g, b, a) in colors:
+        if a == 255:
+            used.add(((r >> 3) << 11) | ((g >> 2) << 5) | (b >> 3))
+
+    if PREFERRED_COLOR_KEY not in used:
+        return PREFERRED_COLOR_KEY
+
+    for key in range(0x10000):
+        if key not in used:
+            return key
+
+    return None
+
+
+def EncodeNativeSprite(absSrcPath, absDstPath, alphaThreshold, thresholdSoftAlpha):
+    # type: (str, str, int, bool) -> Optional[Dict[str, Any]]
+    """
+    Convert a PNG to the native sprite format at absDstPath.
+    Returns the resource_index fields, or None to keep the PNG
+    because it has soft alpha that should be blended.
+    """
+
+    with Image.open(absSrcPath) as im:
+        rgba = im.convert("RGBA")
+
+    width, height = rgba.size
+    red, green, blue, alpha = rgba.split()
+
+    histogram = alpha.histogram()
+    if not thresholdSoftAlpha and any(histogram[1:255]):
+        return None
+
+    transparentColor = 0
+    mask = None
+
+    if not any(histogram[:alphaThreshold]):
+        alphaMode = ALPHA_OPAQUE
+        pixels = encode_rgb565(rgba)
+    else:
+        visibleMask = alpha.point([0] * alphaThreshold + [255] * (256 - alphaThreshold))
+
+        # drop the bits RGB565 can't hold, so colors are compared as stored
+        visible = Image.merge("RGBA", (
+            red.point([v & 0xF8 for v in range(256)]),
+            green.point([v & 0xFC for v in range(256)]),
+            blue.point([v & 0xF8 for v in range(256)]),
+            visibleMask))
+
+        key = FindColorKey(visible)
+        if key is not None:
+            alphaMode = ALPHA_COLORKEY
+            transparentColor = key
+            keyColor = ((key >> 11) << 3, ((key >> 5) & 0x3F) << 2, (key & 0x1F) << 3)
+        else:
+            alphaMode = ALPHA_MASK
+            keyColor = (0, 0, 0)
+            mask = visibleMask.convert("1", dither=Image.Dither.NONE).tobytes()
+
+        background = Image.new("RGB", rgba.size, keyColor)
+        pixels = encode_rgb565(Image.composite(rgba.convert("RGB"), background, visibleMask))
+
+    maskOffset = SPRITE_HEADER_SIZE + len(pixels) if mask is not None else 0
+
+    header = bytearray(SPRITE_MAGIC)
+    for val in (SPRITE_VERSION, width, height, alphaMode, transparentColor, maskOffset, 0):
+        header.extend(val.to_bytes(4, byteorder='little'))
+
+    with open(absDstPath, "wb") as f:
+        f.write(header)
+        f.write(pixels)
+        if mask is not None:
+            f.write(mask)
+
+    fields = {
+        "format": "rgb565",
+        "width": width,
+        "height": height,
+        "alpha": ALPHA_NAMES[alphaMode],
+    }
+    if alphaMode == ALPHA_COLORKEY:
+        fields["transparent_color"] = transparentColor
+
+    return fields
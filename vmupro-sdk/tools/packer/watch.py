@@ -0,0 +1,98 @@
+# 8BM Copyright/License notice
+# Change polling for the LUA packer's --watch mode
+#
+# The files a build read (the metadata, icon, load trace and every resource
+# file and folder listed in the metadata) are stat'ed every POLL_INTERVAL
+# seconds. Folders are walked, so files added to or removed from them count
+# as changes too. Once something changes, the caller is only told after
+# nothing has changed for SETTLE_SECONDS, so saving several files at once,
+# or an editor writing a file in steps, gives one rebuild instead of many.
+#
+# Plain polling keeps this dependency free; the projects are small enough
+# that a stat of every input a few times a second costs next to nothing.
+
+import os
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from buildcache import FileStamp
+
+
+POLL_INTERVAL = 0.25
+
+SETTLE_SECONDS = 0.3
+
+
+def TakeSnapshot(paths, ignore):
+    # type: (Iterable[Path], Set[Path]) -> Dict[Path, Optional[Tuple[int, int]]]
+    """
+    (size, mtime) of every file in or under the paths, None for paths that
+    don't exist. Anything in ignore (the pack itself, the build cache) is skipped.
+    """
+
+    snapshot = {}
+    for path in paths:
+        if path in ignore:
+            continue
+        if not os.path.isdir(path):
+            try:
+                snapshot[path] = FileStamp(path)
+            except OSError:
+                snapshot[path] = None
+            continue
+        for root, dirs, files in os.walk(path):
+            root = Path(root)
+            dirs[:] = [d for d in dirs if root / d not in ignore]
+            for name in files:
+                absPath = root / name
+                if absPath in ignore:
+                    continue
+                try:
+                    snapshot[absPath] = FileStamp(absPath)
+                except OSError:
+                    # removed while walking
+                    pass
+
+    return snapshot
+
+
+def GetChangedPaths(before, after):
+    # type: (Dict[Path, Optional[Tuple[int, int]]], Dict[Path, Optional[Tuple[int, int]]]) -> List[Path]
+    """
+    Paths added, removed or modified between two snapshots
+    """
+
+    return sorted(p for p in set(before) | set(after) if before.get(p) != after.get(p))
+
+
+def WaitForChanges(paths, ignore, snapshot, onIdle=None):
+    # type: (Iterable[Path], Set[Path], Dict[Path, Optional[Tuple[int, int]]], Optional[Callable[[], None]]) -> Tuple[List[Path], Dict[Path, Optional[Tuple[int, int]]]]
+    """
+    Block until something under the paths differs from the snapshot
+    and has then stopped changing. onIdle is called between polls.
+    Returns the changed paths and the snapshot they were seen in.
+    """
+
+    paths = list(paths)
+
+    while True:
+        if onIdle is not None:
+            onIdle()
+        time.sleep(POLL_INTERVAL)
+        current = TakeSnapshot(paths, ignore)
+        if GetChangedPaths(snapshot, current):
+            break
+
+    # let it settle
+    settleStart = time.monotonic()
+    while time.monotonic() - settleStart < SETTLE_SECONDS:
+        if onIdle is not None:
+            onIdle()
+        time.sleep(POLL_INTERVAL)
+        latest = TakeSnapshot(paths, ignore)
+        if latest != current:
+            current = latest
+            settleStart = time.monotonic()
+
+    return GetChangedPaths(snapshot, current), current